@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# build-region-grid.py
+#
+# build step for the region grid of the provisioning Lambda
+"""Precompute the RegionGrid of the Lambda's region table
+
+The region table is read from provisioning/lambda/lambda_function.py
+without importing it. The grid is saved next to the Lambda, which loads
+it at init (and builds it itself if the file is missing or was built for
+another region table). The grid is checked against the exact RegionTable
+lookup on random coordinates; the script exits with 1 on any difference.
+
+    build-region-grid.py                 # 0.5 degree cells, 1M checks
+    build-region-grid.py -c 0.25 -n 0    # finer grid, no check
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+from lambda_source import LAMBDA_DIR, LAMBDA_FILE, lambda_regions
+
+sys.path.insert(0, LAMBDA_DIR)
+from region_lookup import CELL_DEGREES, RegionGrid, RegionTable
+
+
+def check(grid, table, samples, seed):
+    """returns (mismatched regions, max km difference, grid secs, table secs)"""
+    rng = np.random.default_rng(seed)
+    lats = np.degrees(np.arcsin(rng.uniform(-1, 1, samples)))
+    lons = rng.uniform(-180, 180, samples)
+    start = time.perf_counter()
+    names, km = grid.nearest_batch(lats, lons)
+    grid_secs = time.perf_counter() - start
+    start = time.perf_counter()
+    expected, expected_km = table.nearest_batch(lats, lons)
+    table_secs = time.perf_counter() - start
+    mismatches = sum(1 for a, b in zip(names, expected) if a != b)
+    return mismatches, float(np.max(np.abs(km - expected_km))), grid_secs, table_secs
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Build the region grid of the provisioning Lambda')
+    parser.add_argument("-c", "--cell", action="store", dest="cell", type=float, default=CELL_DEGREES,
+                        help="cell size in degrees")
+    parser.add_argument("-o", "--output", action="store", dest="output",
+                        default=os.path.join(LAMBDA_DIR, 'region_grid.npz'))
+    parser.add_argument("-l", "--lambda-file", action="store", dest="lambda_file",
+                        default=LAMBDA_FILE)
+    parser.add_argument("-n", "--samples", action="store", dest="samples", type=int, default=1000000,
+                        help="random coordinates checked against the exact lookup")
+    parser.add_argument("-s", "--seed", action="store", dest="seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    table = RegionTable(lambda_regions(args.lambda_file))
+    start = time.perf_counter()
+    grid = RegionGrid.build(table, args.cell)
+    print("{} x {} cells of {} degrees built in {:.2f} secs, {:.1%} precomputed".format(
+        grid.rows, grid.cols, grid.cell_degrees, time.perf_counter() - start, grid.coverage()))
+
+    if args.samples:
+        mismatches, max_diff, grid_secs, table_secs = check(grid, table, args.samples, args.seed)
+        print("check of {} coordinates: {} different regions, max distance difference {:.2e} km, "
+              "grid {:.3f} secs, exact {:.3f} secs".format(
+                  args.samples, mismatches, max_diff, grid_secs, table_secs))
+        if mismatches:
+            sys.exit(1)
+
+    grid.save(args.output)
+    print("saved {} ({} bytes)".format(args.output, os.path.getsize(args.output)))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
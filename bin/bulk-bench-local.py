@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# bulk-bench-local.py
+#
+# benchmark for the whole bulk provisioning pipeline against
+# local stand-ins for S3 and the IoT registration APIs
+"""Benchmark the bulk provisioning pipeline locally
+
+Every run generates keys and CSRs, builds the bulk input file, uploads
+it (or streams it while the keys are generated with --stream), starts
+the registration task, polls it, downloads the reports and writes the
+certificates. S3 and AWS IoT are provided by moto, the registration
+task APIs by bulk_standin. The result is written as JSON with
+p50/p95/p99 per stage and can be compared with a stored baseline, which
+must have been run with the same settings.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+
+from moto import mock_aws
+
+from bulk_keygen import finish_stream, BulkWriter, generate_bulk, KEY_SIZE
+from bulk_results import split_results
+from bulk_standin import local_clients, RegistrationTaskStandIn, BUCKET, ROLE_ARN
+from bulk_task import run_bulk_task, run_sharded
+from s3_stream import S3MultipartWriter, MIN_PART_SIZE
+from stages import StageTimer
+
+REAL_DIR = os.path.dirname(os.path.realpath(__file__))
+TOLERANCE = 0.10
+MIN_DIFF_SECS = 0.05
+# settings a baseline must have been run with; template is the sha256 of the template body
+CONFIG_KEYS = ['num_things', 'runs', 'workers', 'shards', 'stream', 'part_size', 'key_size',
+               'row_delay', 'poll_min', 'poll_max', 'template']
+
+
+def percentile(values, p):
+    """nearest rank percentile"""
+    values = sorted(values)
+    rank = max(1, int(math.ceil(p / 100.0 * len(values))))
+    return values[rank - 1]
+
+
+def run_once(args, template_body, work_dir):
+    """one run of the pipeline, returns the StageTimer"""
+    timer = StageTimer()
+    out_dir = tempfile.mkdtemp(prefix='bulk-bench-', dir=work_dir)
+    try:
+        with mock_aws():
+            c_iot, c_s3 = local_clients(BUCKET)
+            stream = None
+            if args.stream:
+                stream = S3MultipartWriter(c_s3, BUCKET, 'bulk.json', part_size=args.part_size)
+            with BulkWriter(out_dir, 'bulk.json', stream=stream) as writer:
+                generate_bulk('bulk-bench-', args.num_things, writer, workers=args.workers,
+                              key_size=args.key_size, timer=timer, verbose=False)
+                if stream:
+                    finish_stream(stream, timer)
+
+            c_iot = RegistrationTaskStandIn(c_iot, c_s3, row_delay=args.row_delay)
+            if args.shards > 1:
+                _, reports, _ = run_sharded(writer.path, template_body, BUCKET, ROLE_ARN, out_dir,
+                                            args.shards, c_iot=c_iot, c_s3=c_s3,
+                                            poll_min=args.poll_min, poll_max=args.poll_max,
+                                            timer=timer)
+            else:
+                _, reports, _ = run_bulk_task(writer.path, template_body, BUCKET, ROLE_ARN, out_dir,
+                                              upload=not args.stream, c_iot=c_iot, c_s3=c_s3,
+                                              poll_min=args.poll_min,
+                                              poll_max=args.poll_max, timer=timer)
+
+        split_results(reports['RESULTS'], out_dir, errors_file=reports.get('ERRORS'),
+                      input_file=writer.path, timer=timer)
+    finally:
+        shutil.rmtree(out_dir)
+    return timer
+
+
+def summarize(runs, num_things):
+    """per stage percentiles over all runs"""
+    names = []
+    for run in runs:
+        names.extend(name for name in run.stages if name not in names)
+
+    stages = {}
+    for name in names + ['total']:
+        secs = [run.total() if name == 'total' else run.stages[name]
+                for run in runs if name == 'total' or name in run.stages]
+        p50 = percentile(secs, 50)
+        stages[name] = {
+            'p50': round(p50, 6),
+            'p95': round(percentile(secs, 95), 6),
+            'p99': round(percentile(secs, 99), 6),
+            'mean': round(sum(secs) / len(secs), 6),
+            'devices_per_sec': round(num_things / p50, 3) if p50 > 0 else None
+        }
+    return stages
+
+
+def config_mismatches(config, baseline):
+    """returns (setting, baseline value, current value) of the settings which differ"""
+    return [(key, baseline.get(key), config[key]) for key in CONFIG_KEYS
+            if baseline.get(key) != config[key]]
+
+
+def compare(result, baseline, tolerance=TOLERANCE, min_diff=MIN_DIFF_SECS):
+    """returns a list of (stage, baseline p50, current p50, ratio, regressed)"""
+    rows = []
+    for name, current in result['stages'].items():
+        base = baseline['stages'].get(name)
+        if not base:
+            continue
+        ratio = current['p50'] / base['p50'] if base['p50'] > 0 else None
+        regressed = (ratio is not None and ratio > 1 + tolerance
+                     and current['p50'] - base['p50'] > min_diff)
+        rows.append((name, base['p50'], current['p50'], ratio, regressed))
+    return rows
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the bulk provisioning pipeline against local stand-ins'
+    )
+    parser.add_argument("-n", "--num-things", action="store", dest="num_things", type=int, default=100,
+                        help="things per run")
+    parser.add_argument("-r", "--runs", action="store", dest="runs", type=int, default=5,
+                        help="number of runs")
+    parser.add_argument("-w", "--workers", action="store", dest="workers", type=int,
+                        default=os.cpu_count(), help="key generation worker processes")
+    parser.add_argument("-k", "--key-size", action="store", dest="key_size", type=int, default=KEY_SIZE,
+                        help="RSA key size")
+    parser.add_argument("-s", "--shards", action="store", dest="shards", type=int, default=1,
+                        help="concurrent registration tasks")
+    parser.add_argument("-t", "--template", action="store", dest="template",
+                        default=os.path.join(REAL_DIR, '..', 'simpleTemplateBody.json'),
+                        help="provisioning template body")
+    parser.add_argument("--stream", action="store_true", dest="stream", default=False,
+                        help="stream the bulk file into S3 while the keys are created")
+    parser.add_argument("--part-size", action="store", dest="part_size", type=int,
+                        default=MIN_PART_SIZE, help="multipart upload part size for --stream")
+    parser.add_argument("--row-delay", action="store", dest="row_delay", type=float, default=0.0,
+                        help="simulated service time per row of the registration task")
+    parser.add_argument("--poll-min", action="store", dest="poll_min", type=float, default=0.05,
+                        help="shortest interval between task polls")
+    parser.add_argument("--poll-max", action="store", dest="poll_max", type=float, default=1.0,
+                        help="longest interval between task polls")
+    parser.add_argument("-o", "--output", action="store", dest="output",
+                        help="write the result as JSON to this file")
+    parser.add_argument("-b", "--baseline", action="store", dest="baseline",
+                        help="compare with this result and exit 1 on regressions")
+    parser.add_argument("--tolerance", action="store", dest="tolerance", type=float, default=TOLERANCE,
+                        help="allowed p50 slow down against the baseline, 0.1 = 10%%")
+    parser.add_argument("-v", "--verbose", action="store_true", dest="verbose", default=False,
+                        help="show the output of the pipeline")
+    args = parser.parse_args(argv)
+    if args.stream and args.shards > 1:
+        parser.error("--stream uploads a single input file and cannot be combined with --shards")
+
+    with open(args.template) as f:
+        template_body = f.read()
+
+    config = dict((key, getattr(args, key)) for key in CONFIG_KEYS)
+    config['template'] = hashlib.sha256(template_body.encode('utf-8')).hexdigest()
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        mismatches = config_mismatches(config, baseline)
+        if mismatches:
+            parser.error("the baseline was run with other settings: {}".format(", ".join(
+                "{} {} instead of {}".format(key, base, current) for key, base, current in mismatches)))
+
+    runs = []
+    work_dir = tempfile.mkdtemp(prefix='bulk-bench-')
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    try:
+        for n in range(args.runs):
+            if args.verbose:
+                timer = run_once(args, template_body, work_dir)
+            else:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    timer = run_once(args, template_body, work_dir)
+            runs.append(timer)
+            print("run {}/{}: {:.3f} secs.".format(n + 1, args.runs, timer.total()), file=sys.stderr)
+    finally:
+        shutil.rmtree(work_dir)
+
+    result = dict(config, stages=summarize(runs, args.num_things))
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    if baseline:
+        rows = compare(result, baseline, args.tolerance)
+        print("", file=sys.stderr)
+        print("{:<24} {:>10} {:>10} {:>8}".format("stage", "base p50", "p50", "ratio"), file=sys.stderr)
+        for name, base, current, ratio, regressed in rows:
+            print("{:<24} {:>10.3f} {:>10.3f} {:>8} {}".format(
+                name, base, current, "{:.2f}".format(ratio) if ratio else "-",
+                "REGRESSION" if regressed else ""), file=sys.stderr)
+        if any(row[4] for row in rows):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# bulk-dry-run.py
+#
+# evaluates a provisioning template against a bulk input file
+# without calling AWS
+"""Offline dry run of a bulk provisioning input file"""
+
+import argparse
+import json
+import os
+import sys
+
+from bulk_template import dry_run, print_summary, TemplateError
+
+REAL_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Check a bulk input file against a provisioning template before provisioning'
+    )
+    parser.add_argument("bulk_file", help="bulk input file, one JSON document per line")
+    parser.add_argument("-t", "--template", action="store", dest="template",
+                        default=os.path.join(REAL_DIR, '..', 'simpleTemplateBody.json'),
+                        help="provisioning template body")
+    parser.add_argument("-r", "--resources", action="store", dest="resources_file",
+                        help="write the resources every row would create as JSON lines to this file")
+    parser.add_argument("-c", "--require-cn", action="store_true", dest="require_cn", default=False,
+                        help="the CN of the CSR must be the thing name")
+    parser.add_argument("-w", "--workers", action="store", dest="workers", type=int,
+                        default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("-m", "--max-errors", action="store", dest="max_errors", type=int, default=20,
+                        help="number of failed rows to print")
+    args = parser.parse_args(argv)
+
+    try:
+        with open(args.template) as f:
+            template = json.load(f)
+        stats, timer = dry_run(args.bulk_file, template, workers=args.workers,
+                               require_cn=args.require_cn, resources_file=args.resources_file,
+                               max_errors=args.max_errors)
+    except (IOError, ValueError, TemplateError) as e:
+        print("ERROR: {}".format(e))
+        sys.exit(2)
+
+    print_summary(stats, timer, args.bulk_file)
+    if stats.failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
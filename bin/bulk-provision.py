@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# bulk-provision.py
+#
+# runs a bulk provisioning task for a bulk input file,
+# downloads the reports and writes the certificates
+"""Bulk provision the things in a bulk input file"""
+
+import argparse
+import json
+import os
+import sys
+
+from bulk_results import print_summary, split_results
+from bulk_template import dry_run, print_summary as print_dry_run_summary, TemplateError
+from bulk_task import print_shards, run_bulk_task, run_sharded, DOWNLOAD_WORKERS, POLL_MAX, POLL_MIN
+from stages import StageTimer
+
+REAL_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Bulk provision things with AWS IoT Core')
+    parser.add_argument("bulk_file", help="bulk input file, one JSON document per line")
+    parser.add_argument("-b", "--bucket", action="store", dest="bucket",
+                        default=os.environ.get('S3_BUCKET'),
+                        help="S3 bucket for the input file, default: $S3_BUCKET")
+    parser.add_argument("-r", "--role-arn", action="store", dest="role_arn",
+                        default=os.environ.get('ARN_IOT_PROVISIONING_ROLE'),
+                        help="provisioning role, default: $ARN_IOT_PROVISIONING_ROLE")
+    parser.add_argument("-t", "--template", action="store", dest="template",
+                        default=os.path.join(REAL_DIR, '..', 'simpleTemplateBody.json'),
+                        help="provisioning template body")
+    parser.add_argument("-o", "--out-dir", action="store", dest="out_dir",
+                        help="directory for reports and certificates, default: directory of bulk_file")
+    parser.add_argument("-k", "--key", action="store", dest="key",
+                        help="S3 key of the input file, default: basename of bulk_file")
+    parser.add_argument("--no-upload", action="store_false", dest="upload", default=True,
+                        help="the input file is already in the bucket")
+    parser.add_argument("--no-split", action="store_false", dest="split", default=True,
+                        help="do not write certificate files from the results")
+    parser.add_argument("-w", "--workers", action="store", dest="workers", type=int,
+                        default=DOWNLOAD_WORKERS, help="concurrent report downloads")
+    parser.add_argument("--poll-min", action="store", dest="poll_min", type=float,
+                        default=POLL_MIN, help="shortest interval between task polls")
+    parser.add_argument("--poll-max", action="store", dest="poll_max", type=float,
+                        default=POLL_MAX, help="longest interval between task polls")
+    parser.add_argument("--timeout", action="store", dest="timeout", type=float,
+                        help="give up waiting for the task after this many secs")
+    parser.add_argument("-n", "--shards", action="store", dest="shards", type=int, default=1,
+                        help="split the input file into this many concurrent registration tasks")
+    parser.add_argument("--validate", action="store_true", dest="validate", default=False,
+                        help="dry run the input file against the template and stop on errors")
+    parser.add_argument("--stand-in", action="store_true", dest="stand_in", default=False,
+                        help="run against a local moto based stand-in instead of AWS")
+    args = parser.parse_args(argv)
+
+    if args.stand_in:
+        from bulk_standin import BUCKET, ROLE_ARN
+        args.bucket = args.bucket or BUCKET
+        args.role_arn = args.role_arn or ROLE_ARN
+
+    if not args.bucket:
+        parser.error("an S3 bucket is required for bulk provisioning, set S3_BUCKET or use -b")
+    if not args.role_arn:
+        parser.error("a provisioning role is required, set ARN_IOT_PROVISIONING_ROLE or use -r")
+    if not os.path.exists(args.template):
+        parser.error("cannot find provisioning template \"{}\"".format(args.template))
+    if args.shards > 1 and (args.key or not args.upload):
+        parser.error("-k and --no-upload refer to a single input file in the bucket "
+                     "and cannot be used with -n")
+
+    if args.validate:
+        try:
+            validate(args)
+        except (IOError, ValueError, TemplateError) as e:
+            parser.error("cannot validate \"{}\": {}".format(args.bulk_file, e))
+
+    if args.stand_in:
+        run_stand_in(args)
+    else:
+        run(args)
+
+
+def validate(args):
+    """runs the offline dry run and exits if a row would fail"""
+    with open(args.template) as f:
+        template = json.load(f)
+    stats, timer = dry_run(args.bulk_file, template)
+    print_dry_run_summary(stats, timer, args.bulk_file)
+    if stats.failed:
+        sys.exit("{} of {} rows would fail, not provisioning".format(stats.failed, stats.rows))
+
+
+def run_stand_in(args):
+    """runs against moto with the registration task APIs from bulk_standin"""
+    from moto import mock_aws
+    from bulk_standin import local_clients, RegistrationTaskStandIn
+
+    with mock_aws():
+        c_iot, c_s3 = local_clients(args.bucket)
+        run(args, RegistrationTaskStandIn(c_iot, c_s3), c_s3, poll_interval=0.1)
+
+
+def run_tasks(args, template_body, out_dir, c_iot, c_s3, poll_min, poll_max, timer):
+    """runs the registration task or the shards, returns (shards, tasks, reports, timer)"""
+    if args.shards > 1:
+        shards, reports, timer = run_sharded(args.bulk_file, template_body, args.bucket,
+                                             args.role_arn, out_dir, args.shards,
+                                             c_iot=c_iot, c_s3=c_s3, workers=args.workers,
+                                             poll_min=poll_min, poll_max=poll_max,
+                                             timeout=args.timeout, timer=timer)
+        tasks = [r.task for r in shards]
+    else:
+        task, reports, timer = run_bulk_task(args.bulk_file, template_body, args.bucket,
+                                             args.role_arn, out_dir, key=args.key,
+                                             upload=args.upload, c_iot=c_iot, c_s3=c_s3,
+                                             workers=args.workers, poll_min=poll_min,
+                                             poll_max=poll_max, timeout=args.timeout,
+                                             timer=timer)
+        shards = None
+        tasks = [task]
+    return shards, tasks, reports, timer
+
+
+def run(args, c_iot=None, c_s3=None, poll_interval=None):
+    with open(args.template) as f:
+        template_body = f.read()
+    out_dir = args.out_dir or os.path.dirname(args.bulk_file) or '.'
+
+    poll_min = poll_interval or args.poll_min
+    poll_max = poll_interval or args.poll_max
+
+    timer = StageTimer()
+    try:
+        shards, tasks, reports, timer = run_tasks(args, template_body, out_dir, c_iot, c_s3,
+                                                  poll_min, poll_max, timer)
+    except TimeoutError as e:
+        sys.exit("ERROR: {}".format(e))
+
+    if args.split and 'RESULTS' in reports:
+        stats, timer = split_results(reports['RESULTS'], out_dir,
+                                     errors_file=reports.get('ERRORS'),
+                                     input_file=args.bulk_file,
+                                     status_file=os.path.join(out_dir, 'status.json'),
+                                     timer=timer)
+        print_summary(stats, timer, reports['RESULTS'])
+    else:
+        timer.report()
+
+    print("")
+    print("AWS IoT bulk provisioning results")
+    print("--------------------------------------------------------------")
+    for task in tasks:
+        print("task_id: {} status: {}".format(task['taskId'], task['status']))
+    print("success: {} failure: {}".format(sum(t.get('successCount', 0) for t in tasks),
+                                           sum(t.get('failureCount', 0) for t in tasks)))
+    for report_type, path in reports.items():
+        print("{} written to: {}".format(report_type, path))
+    print("time for bulk provisioning: {:.3f} secs.".format(timer.total()))
+    if shards:
+        print_shards(shards, timer)
+
+    if any(t['status'] != 'Completed' for t in tasks) or 'ERRORS' in reports:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
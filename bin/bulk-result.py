@@ -13,36 +13,50 @@
 # express or implied. See the License for the specific language governing
 # permissions and limitations under the License.
 
-import json
-import os
+import argparse
 import sys
 
+from bulk_results import print_summary, split_results, SHARD_DEPTH
 
-def process_line(line):
-    d = json.loads(line)
-    crt = d["response"]["CertificatePem"]
-    thing = d["response"]["ResourceArns"]["thing"].split('/')[1]
-    print("creating file {}.crt for thing {}".format(thing, thing))
-    file = open(thing + ".crt", "w")
-    file.write(crt)
-    file.close()
-
-def process_results(file):
-    try:
-        with open(file) as f:
-            for line in f:
-                process_line(line)
-        f.close()
-    except Exception as e:
-        print("error opening file {}: {}".format(file,e))
-        return None
 
 def main(argv):
-    if len(argv) == 0:
-        print("usage: {} <result_filename>".format(os.path.basename(__file__)))
+    parser = argparse.ArgumentParser(
+        description='Write a certificate file for every line of a bulk provisioning result'
+    )
+    parser.add_argument("results_file", help="RESULTS report of the bulk provisioning task")
+    parser.add_argument("-e", "--errors", action="store", dest="errors_file",
+                        help="ERRORS report to join with the results")
+    parser.add_argument("-i", "--input", action="store", dest="input_file",
+                        help="bulk input file, used to find the thing names of errors")
+    parser.add_argument("-d", "--out-dir", action="store", dest="out_dir", default=".",
+                        help="base directory for the certificates")
+    parser.add_argument("-s", "--status", action="store", dest="status_file",
+                        help="write the status of every thing as JSON lines to this file")
+    parser.add_argument("-w", "--workers", action="store", dest="workers", type=int, default=8,
+                        help="number of writer threads")
+    parser.add_argument("--shard-depth", action="store", dest="shard_depth", type=int,
+                        default=SHARD_DEPTH,
+                        help="directory levels below out-dir, 0 writes all files into out-dir")
+    parser.add_argument("--no-fsync", action="store_false", dest="fsync", default=True,
+                        help="do not fsync the certificate files")
+    parser.add_argument("-v", "--verbose", action="store_true", dest="verbose", default=False,
+                        help="print every certificate file")
+    args = parser.parse_args(argv)
+
+    try:
+        stats, timer = split_results(args.results_file, args.out_dir,
+                                     errors_file=args.errors_file,
+                                     input_file=args.input_file,
+                                     status_file=args.status_file,
+                                     workers=args.workers,
+                                     shard_depth=args.shard_depth,
+                                     fsync=args.fsync,
+                                     verbose=args.verbose)
+    except (IOError, OSError) as e:
+        print("error processing file {}: {}".format(args.results_file, e))
         sys.exit(1)
 
-    process_results(argv[0])
+    print_summary(stats, timer, args.results_file)
 
 if __name__ == "__main__":
     main(sys.argv[1:])
@@ -0,0 +1,274 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# bulk_keygen.py
+#
+# parallel key/CSR generation for bulk provisioning
+"""Create keys, CSRs and the bulk provisioning input file
+
+Keys and CSRs are created in a process pool so that all cores are used.
+The parent process streams the results in thing order through a
+buffered writer into <thing>.key, <thing>.csr and the bulk JSONL file.
+The bulk JSONL can also be streamed into an S3 multipart upload, so that
+the upload overlaps with the key generation.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import itertools
+import json
+import os
+import sys
+import time
+
+import boto3
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+
+from s3_stream import S3MultipartWriter
+from stages import StageTimer
+
+# same subject as used by "openssl req -subj" in the shell scripts
+SUBJECT = [
+    (NameOID.COUNTRY_NAME, 'DE'),
+    (NameOID.STATE_OR_PROVINCE_NAME, 'Berlin'),
+    (NameOID.LOCALITY_NAME, 'Berlin'),
+    (NameOID.ORGANIZATION_NAME, 'AWS')
+]
+KEY_SIZE = 2048
+BUFFER_SIZE = 1024 * 1024
+PROGRESS_EVERY = 1000
+
+
+def generate_key_csr(thing_name, common_name=None, key_size=KEY_SIZE):
+    """returns (key_pem, csr_pem) for a new RSA key"""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+    attributes = [x509.NameAttribute(oid, value) for oid, value in SUBJECT]
+    attributes.append(x509.NameAttribute(NameOID.COMMON_NAME, common_name or thing_name))
+    csr = x509.CertificateSigningRequestBuilder().subject_name(
+        x509.Name(attributes)
+    ).sign(key, hashes.SHA256())
+
+    key_pem = key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()
+    ).decode('ascii')
+    csr_pem = csr.public_bytes(serialization.Encoding.PEM).decode('ascii')
+    return key_pem, csr_pem
+
+
+def _generate(job):
+    """process pool worker: job is (thing_name, serial, common_name, key_size)"""
+    thing_name, serial, common_name, key_size = job
+    start = time.perf_counter()
+    key_pem, csr_pem = generate_key_csr(thing_name, common_name, key_size)
+    return thing_name, serial, key_pem, csr_pem, time.perf_counter() - start
+
+
+def _generate_chunk(jobs):
+    return [_generate(job) for job in jobs]
+
+
+def bulk_line(thing_name, serial, csr_pem):
+    """one line of the bulk provisioning input file"""
+    return json.dumps({"ThingName": thing_name, "SerialNumber": str(serial), "CSR": csr_pem}) + '\n'
+
+
+class BulkWriter(object):
+    """Buffered writer for key and CSR files and the bulk JSONL file
+
+    stream is an optional file like object, e.g. an S3MultipartWriter,
+    which gets every bulk line as well. With a stream bulk_file may be
+    None to skip the local copy.
+    """
+
+    def __init__(self, out_dir, bulk_file, write_keys=True, buffer_size=BUFFER_SIZE, stream=None):
+        self.out_dir = out_dir
+        self.write_keys = write_keys
+        self.path = os.path.join(out_dir, bulk_file) if bulk_file else None
+        self.bulk = open(self.path, 'w', buffering=buffer_size) if bulk_file else None
+        self.stream = stream
+        self.count = 0
+
+    def write(self, thing_name, serial, key_pem, csr_pem):
+        if self.write_keys:
+            key_file = os.path.join(self.out_dir, thing_name + '.key')
+            fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                f.write(key_pem)
+            with open(os.path.join(self.out_dir, thing_name + '.csr'), 'w') as f:
+                f.write(csr_pem)
+        line = bulk_line(thing_name, serial, csr_pem)
+        if self.bulk:
+            self.bulk.write(line)
+        if self.stream:
+            self.stream.write(line)
+        self.count += 1
+
+    def close(self):
+        if self.bulk:
+            self.bulk.close()
+        if self.stream:
+            self.stream.close()
+
+    def abort(self):
+        if self.bulk:
+            self.bulk.close()
+        if self.stream:
+            self.stream.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+
+def iter_jobs(thing_basename, num_things, start=1, common_name=None, key_size=KEY_SIZE):
+    for i in range(start, start + num_things):
+        yield (thing_basename + str(i), i, common_name, key_size)
+
+
+def iter_generated(jobs, num_things, workers=None, in_flight=None):
+    """yields (thing_name, serial, key_pem, csr_pem, secs) in job order
+
+    Jobs are submitted in chunks; at most in_flight (default 4 * workers)
+    chunks are submitted and not yet yielded at any time, so a slow
+    consumer holds back the workers instead of piling up results.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for job in jobs:
+            yield _generate(job)
+        return
+
+    chunksize = max(1, min(64, num_things // (workers * 8)))
+    in_flight = in_flight or workers * 4
+    jobs = iter(jobs)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        while True:
+            while len(pending) < in_flight:
+                chunk = list(itertools.islice(jobs, chunksize))
+                if not chunk:
+                    break
+                pending.append(executor.submit(_generate_chunk, chunk))
+            if not pending:
+                break
+            for result in pending.popleft().result():
+                yield result
+
+
+def generate_bulk(thing_basename, num_things, writer, start=1, common_name=None,
+                  key_size=KEY_SIZE, workers=None, timer=None, verbose=True):
+    """generates num_things keys/CSRs and passes them to writer
+
+    Returns the StageTimer with the stage "generate keys and CSRs" (wall
+    clock of the whole pipeline) and the nested stages "key/csr cpu" (sum
+    over all workers) and "write output" (time spent in the writer).
+    """
+    timer = timer or StageTimer()
+    jobs = iter_jobs(thing_basename, num_things, start, common_name, key_size)
+    cpu_secs = 0.0
+    write_secs = 0.0
+
+    with timer.stage("generate keys and CSRs", num_things):
+        for n, (thing_name, serial, key_pem, csr_pem, secs) in enumerate(
+                iter_generated(jobs, num_things, workers), 1):
+            cpu_secs += secs
+            write_start = time.perf_counter()
+            writer.write(thing_name, serial, key_pem, csr_pem)
+            write_secs += time.perf_counter() - write_start
+            if verbose and (n % PROGRESS_EVERY == 0 or n == num_things):
+                print("{}/{}: created key/csr for \"{}\"".format(n, num_things, thing_name))
+
+    timer.add("key/csr cpu", cpu_secs, num_things, nested=True)
+    timer.add("write output", write_secs, num_things, nested=True)
+    return timer
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Create keys, CSRs and the input file for bulk provisioning'
+    )
+    parser.add_argument("thing_basename", help="basename of the things, the number is appended")
+    parser.add_argument("num_things", type=int, help="number of things to create")
+    parser.add_argument("-o", "--out-dir", action="store", dest="out_dir",
+                        help="output directory, default: <thing_basename>-<date_time>")
+    parser.add_argument("-f", "--bulk-file", action="store", dest="bulk_file", default="bulk.json",
+                        help="name of the bulk provisioning file in the output directory")
+    parser.add_argument("-s", "--start", action="store", dest="start", type=int, default=1,
+                        help="number of the first thing")
+    parser.add_argument("-n", "--common-name", action="store", dest="common_name",
+                        help="CN for all CSRs, default: the thing name")
+    parser.add_argument("-w", "--workers", action="store", dest="workers", type=int,
+                        default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("-k", "--key-size", action="store", dest="key_size", type=int,
+                        default=KEY_SIZE, help="RSA key size")
+    parser.add_argument("-b", "--bucket", action="store", dest="bucket",
+                        help="stream the bulk file into this S3 bucket while the keys are created")
+    parser.add_argument("-u", "--key", action="store", dest="key",
+                        help="S3 key for the bulk file, default: the bulk file name")
+    parser.add_argument("--no-spill", action="store_false", dest="spill", default=True,
+                        help="with --bucket: do not keep a local copy of the bulk file")
+    parser.add_argument("-q", "--quiet", action="store_true", dest="quiet", default=False,
+                        help="do not print progress")
+    args = parser.parse_args(argv)
+
+    out_dir = args.out_dir
+    if out_dir is None:
+        out_dir = "{}-{}".format(args.thing_basename, time.strftime("%Y-%m-%d_%H-%M-%S"))
+    os.makedirs(out_dir, exist_ok=True)
+
+    print("creating {} keys/CSRs for \"{}\" with {} workers".format(
+        args.num_things, args.thing_basename, args.workers))
+
+    stream = None
+    if args.bucket:
+        key = args.key or args.bulk_file
+        print("streaming {} to s3://{}/{}".format(args.bulk_file, args.bucket, key))
+        stream = S3MultipartWriter(boto3.client('s3'), args.bucket, key)
+
+    with BulkWriter(out_dir, args.bulk_file if args.spill or not stream else None,
+                    stream=stream) as writer:
+        timer = generate_bulk(args.thing_basename, args.num_things, writer,
+                              start=args.start, common_name=args.common_name,
+                              key_size=args.key_size, workers=args.workers,
+                              verbose=not args.quiet)
+        if stream:
+            finish_stream(stream, timer)
+
+    if writer.path:
+        print("output written to {}".format(writer.path))
+    timer.report()
+    if stream:
+        print("uploaded {} bytes in {} parts, {:.3f} secs. of {:.3f} secs. upload time "
+              "overlapped with key generation".format(
+                  stream.size, len(stream.futures), timer.stages["overlapped upload"],
+                  stream.busy_secs()))
+
+
+def finish_stream(stream, timer):
+    """completes the upload of the bulk file
+
+    Adds the stage "finish upload", the time waited for the remaining
+    parts, and the nested stage "overlapped upload", the wall clock
+    time during which parts were uploading before the key generation
+    ended, which was saved compared to uploading after writing the file.
+    """
+    finish_start = time.perf_counter()
+    with timer.stage("finish upload"):
+        stream.close()
+    timer.add("overlapped upload", stream.busy_secs(until=finish_start), nested=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,289 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# bulk_results.py
+#
+# splits the reports of a bulk provisioning task into certificate files
+"""Streaming splitter for bulk provisioning RESULTS and ERRORS reports
+
+The RESULTS report is read line by line and handed in batches to a
+thread pool which writes and closes one <thing>.crt per line in a
+sharded directory tree; the files and directories of a batch are synced
+to disk with one os.sync() at its end instead of one fsync per file.
+Only a bounded number of batches is in flight and a worker holds one
+file open at a time, so memory and file descriptors do not depend on the
+report size.
+
+Each report line carries a referenceId which is the zero based line
+number of the row in the bulk input file. ERRORS lines do not contain the
+thing name, it is looked up in the input file when one is given. The
+ERRORS report is streamed in chunks too; for a report ordered by
+referenceId the input file is read once.
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+
+from stages import StageTimer
+
+BATCH_SIZE = 500
+ERROR_CHUNK_SIZE = 10000
+SHARD_DEPTH = 2
+
+
+def shard_dir(out_dir, thing_name, depth=SHARD_DEPTH):
+    """directory for a thing: <out_dir>/ab/cd for depth 2, <out_dir> for depth 0"""
+    if depth <= 0:
+        return out_dir
+    digest = hashlib.md5(thing_name.encode('utf-8')).hexdigest()
+    return os.path.join(out_dir, *[digest[i * 2:i * 2 + 2] for i in range(depth)])
+
+
+def parse_result(line):
+    """returns (reference_id, thing_name, certificate_pem) of a RESULTS line"""
+    d = json.loads(line)
+    thing = d["response"]["ResourceArns"]["thing"].split('/')[1]
+    return d.get("referenceId"), thing, d["response"]["CertificatePem"]
+
+
+class CertificateWriter(object):
+    """writes batches of RESULTS lines as certificate files"""
+
+    def __init__(self, out_dir, shard_depth=SHARD_DEPTH, fsync=True):
+        self.out_dir = out_dir
+        self.shard_depth = shard_depth
+        self.fsync = fsync
+        self.created_dirs = set()
+        self.lock = threading.Lock()
+
+    def makedirs(self, path):
+        if path in self.created_dirs:
+            return
+        os.makedirs(path, exist_ok=True)
+        with self.lock:
+            self.created_dirs.add(path)
+
+    def write_batch(self, lines):
+        """returns a list of (reference_id, thing_name, path or None, error)"""
+        written = []
+        for line in lines:
+            try:
+                reference_id, thing, crt = parse_result(line)
+            except (ValueError, KeyError, IndexError) as e:
+                written.append((None, None, None, "invalid result line: {}".format(e)))
+                continue
+            directory = shard_dir(self.out_dir, thing, self.shard_depth)
+            self.makedirs(directory)
+            path = os.path.join(directory, thing + ".crt")
+            with open(path, "w") as f:
+                f.write(crt)
+            written.append((reference_id, thing, path, None))
+
+        if self.fsync and written:
+            os.sync()
+        return written
+
+
+def iter_batches(f, batch_size=BATCH_SIZE):
+    batch = []
+    for line in f:
+        if not line.strip():
+            continue
+        batch.append(line)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_error_chunks(errors_file, chunk_size=ERROR_CHUNK_SIZE):
+    """yields lists of the error lines of an ERRORS report, chunk_size at a time
+
+    An invalid line is passed on as the message of its error instead of a
+    dict.
+    """
+    chunk = []
+    with open(errors_file) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                error = json.loads(line)
+                if not isinstance(error, dict):
+                    raise ValueError("not a JSON object")
+            except ValueError as e:
+                error = "invalid error line: {}".format(e)
+            chunk.append(error)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def _line_number(reference_id):
+    try:
+        return int(reference_id)
+    except (TypeError, ValueError):
+        return None
+
+
+class InputLines(object):
+    """forward reader of the bulk input file, reopened when asked for an earlier line"""
+
+    def __init__(self, input_file):
+        self.input_file = input_file
+        self.f = None
+        self.n = 0
+
+    def thing_names(self, numbers):
+        """returns {line number: ThingName} of the wanted line numbers"""
+        wanted = set(numbers)
+        found = {}
+        if not wanted:
+            return found
+        if self.f is None or min(wanted) < self.n:
+            self.close()
+            self.f = open(self.input_file)
+            self.n = 0
+        last = max(wanted)
+        while self.n <= last:
+            line = self.f.readline()
+            if not line:
+                break
+            if self.n in wanted:
+                found[self.n] = json.loads(line).get("ThingName")
+            self.n += 1
+        return found
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+def iter_errors(errors_file, input_file=None, chunk_size=ERROR_CHUNK_SIZE):
+    """yields (reference_id, error line, None) of an ERRORS report
+
+    Invalid lines are yielded as (None, None, message). With an input file
+    the ThingName of the referenced input line is added to each error; at
+    most chunk_size errors are held at once.
+    """
+    lines = InputLines(input_file) if input_file else None
+    try:
+        for chunk in iter_error_chunks(errors_file, chunk_size):
+            if lines:
+                numbers = [_line_number(e.get("referenceId")) if isinstance(e, dict) else None
+                           for e in chunk]
+                names = lines.thing_names(n for n in numbers if n is not None)
+                for error, n in zip(chunk, numbers):
+                    if n in names:
+                        error["ThingName"] = names[n]
+            for error in chunk:
+                if isinstance(error, dict):
+                    yield str(error.get("referenceId")), error, None
+                else:
+                    yield None, None, error
+    finally:
+        if lines:
+            lines.close()
+
+
+class SplitStats(object):
+    def __init__(self):
+        self.lines = 0
+        self.certificates = 0
+        self.invalid = 0
+        self.errors = 0
+        self.invalid_errors = 0
+        self.failed_things = []
+
+
+def split_results(results_file, out_dir=".", errors_file=None, input_file=None,
+                  status_file=None, workers=8, shard_depth=SHARD_DEPTH, fsync=True,
+                  batch_size=BATCH_SIZE, timer=None, verbose=False):
+    """writes a certificate per RESULTS line, joins ERRORS by thing name
+
+    Returns (SplitStats, StageTimer). When status_file is given one JSON
+    line per thing with its status is written to it.
+    """
+    timer = timer or StageTimer()
+    stats = SplitStats()
+    writer = CertificateWriter(out_dir, shard_depth, fsync)
+    status = open(status_file, "w", buffering=1024 * 1024) if status_file else None
+
+    def handle(written):
+        for reference_id, thing, path, error in written:
+            stats.lines += 1
+            if error:
+                stats.invalid += 1
+                print("ERROR: {}".format(error))
+                continue
+            stats.certificates += 1
+            if verbose:
+                print("created file {} for thing {}".format(path, thing))
+            if status:
+                status.write(json.dumps({"referenceId": reference_id, "ThingName": thing,
+                                         "status": "provisioned", "certificate": path}) + "\n")
+
+    try:
+        if errors_file:
+            with timer.stage("join errors"):
+                for reference_id, error, invalid in iter_errors(errors_file, input_file):
+                    if invalid:
+                        stats.invalid_errors += 1
+                        print("ERROR: {}".format(invalid))
+                        continue
+                    stats.errors += 1
+                    thing = error.get("ThingName")
+                    if len(stats.failed_things) < 10:
+                        stats.failed_things.append(thing or "referenceId {}".format(reference_id))
+                    if status:
+                        status.write(json.dumps({"referenceId": reference_id, "ThingName": thing,
+                                                 "status": "failed",
+                                                 "errorCode": error.get("errorCode"),
+                                                 "errorMessage": error.get("errorMessage")}) + "\n")
+                timer.set_count("join errors", stats.errors)
+
+        with timer.stage("write certificates"):
+            in_flight = threading.BoundedSemaphore(workers * 2)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor, \
+                    open(results_file) as f:
+                pending = set()
+                for batch in iter_batches(f, batch_size):
+                    in_flight.acquire()
+                    future = executor.submit(writer.write_batch, batch)
+                    future.add_done_callback(lambda _: in_flight.release())
+                    pending.add(future)
+                    done = [p for p in pending if p.done()]
+                    for p in done:
+                        pending.discard(p)
+                        handle(p.result())
+                for p in concurrent.futures.as_completed(pending):
+                    handle(p.result())
+            timer.set_count("write certificates", stats.certificates)
+    finally:
+        if status:
+            status.close()
+
+    return stats, timer
+
+
+def print_summary(stats, timer, results_file):
+    print("")
+    print("bulk provisioning results: {}".format(results_file))
+    print("--------------------------------------------------------------")
+    print("result lines: {}".format(stats.lines))
+    print("certificates written: {}".format(stats.certificates))
+    print("invalid result lines: {}".format(stats.invalid))
+    print("errors: {}".format(stats.errors))
+    print("invalid error lines: {}".format(stats.invalid_errors))
+    if stats.failed_things:
+        print("failed things (first {}): {}".format(len(stats.failed_things),
+                                                   ", ".join(stats.failed_things)))
+    timer.report()
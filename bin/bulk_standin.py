@@ -0,0 +1,159 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# bulk_standin.py
+#
+# local stand-in for the bulk provisioning APIs
+"""Local stand-in for thing registration tasks
+
+moto implements S3 and the thing/certificate APIs of AWS IoT but not
+the registration task APIs. RegistrationTaskStandIn wraps an IoT and an
+S3 client and plays a registration task: it reads the input file from
+S3, creates a thing and a certificate from the CSR for every row and
+writes RESULTS and ERRORS reports back to S3. All other IoT calls are
+passed to the wrapped client. The template body is not evaluated.
+
+    with moto.mock_aws():
+        c_iot, c_s3 = local_clients(BUCKET)
+        c_iot = RegistrationTaskStandIn(c_iot, c_s3)
+"""
+
+import json
+import threading
+import time
+import uuid
+
+import boto3
+
+REGION = 'us-east-1'
+BUCKET = 'bulk-standin'
+ROLE_ARN = 'arn:aws:iam::123456789012:role/bulk-standin'
+REPORT_PREFIX = 'registration-task-reports/'
+
+
+def local_clients(bucket, region=REGION):
+    """IoT and S3 clients for moto with the bucket created"""
+    c_iot = boto3.client('iot', region_name=region)
+    c_s3 = boto3.client('s3', region_name=region)
+    c_s3.create_bucket(Bucket=bucket)
+    return c_iot, c_s3
+
+
+class RegistrationTaskStandIn(object):
+    """start/describe/list reports of registration tasks on top of c_iot and c_s3
+
+    row_delay adds a sleep per row to mimic the service side processing
+    time, rows_per_report splits the reports into several resource links
+    and page_size is the number of links per list reports page.
+    """
+
+    def __init__(self, c_iot, c_s3, row_delay=0.0, rows_per_report=1000, page_size=10):
+        self.c_iot = c_iot
+        self.c_s3 = c_s3
+        self.row_delay = row_delay
+        self.rows_per_report = rows_per_report
+        self.page_size = page_size
+        self.tasks = {}
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.c_iot, name)
+
+    def start_thing_registration_task(self, templateBody, inputFileBucket, inputFileKey, roleArn):
+        task_id = str(uuid.uuid4())
+        task = {
+            'taskId': task_id,
+            'templateBody': templateBody,
+            'inputFileBucket': inputFileBucket,
+            'inputFileKey': inputFileKey,
+            'roleArn': roleArn,
+            'status': 'InProgress',
+            'successCount': 0,
+            'failureCount': 0,
+            'percentageProgress': 0,
+            'reports': {'RESULTS': [], 'ERRORS': []}
+        }
+        with self.lock:
+            self.tasks[task_id] = task
+        threading.Thread(target=self._run, args=(task,), daemon=True).start()
+        return {'taskId': task_id}
+
+    def describe_thing_registration_task(self, taskId):
+        with self.lock:
+            task = dict(self.tasks[taskId])
+        del task['reports']
+        return task
+
+    def list_thing_registration_task_reports(self, taskId, reportType, nextToken=None, maxResults=None):
+        with self.lock:
+            keys = list(self.tasks[taskId]['reports'][reportType])
+        start = int(nextToken or 0)
+        end = start + (maxResults or self.page_size)
+        bucket = self.tasks[taskId]['inputFileBucket']
+        response = {
+            'reportType': reportType,
+            'resourceLinks': [
+                self.c_s3.generate_presigned_url('get_object', Params={'Bucket': bucket, 'Key': key})
+                for key in keys[start:end]
+            ]
+        }
+        if end < len(keys):
+            response['nextToken'] = str(end)
+        return response
+
+    def _register(self, reference_id, row):
+        thing = self.c_iot.create_thing(thingName=row['ThingName'])
+        cert = self.c_iot.create_certificate_from_csr(
+            certificateSigningRequest=row['CSR'],
+            setAsActive=True
+        )
+        self.c_iot.attach_thing_principal(thingName=row['ThingName'], principal=cert['certificateArn'])
+        return {
+            'referenceId': reference_id,
+            'response': {
+                'CertificatePem': cert['certificatePem'],
+                'ResourceArns': {'thing': thing['thingArn'], 'certificate': cert['certificateArn']}
+            }
+        }
+
+    def _flush(self, task, report_type, lines):
+        if not lines:
+            return
+        key = '{}{}/{}-{:04d}.json'.format(REPORT_PREFIX, task['taskId'], report_type.lower(),
+                                           len(task['reports'][report_type]))
+        self.c_s3.put_object(Bucket=task['inputFileBucket'], Key=key, Body=''.join(lines).encode())
+        with self.lock:
+            task['reports'][report_type].append(key)
+        del lines[:]
+
+    def _run(self, task):
+        body = self.c_s3.get_object(Bucket=task['inputFileBucket'], Key=task['inputFileKey'])['Body']
+        rows = [line for line in body.read().decode('utf-8').split('\n') if line.strip()]
+        pending = {'RESULTS': [], 'ERRORS': []}
+        for n, line in enumerate(rows):
+            reference_id = str(n)
+            try:
+                pending['RESULTS'].append(json.dumps(self._register(reference_id, json.loads(line))) + '\n')
+                counter = 'successCount'
+            except Exception as e:
+                pending['ERRORS'].append(json.dumps({
+                    'referenceId': reference_id,
+                    'errorCode': type(e).__name__,
+                    'errorMessage': str(e)
+                }) + '\n')
+                counter = 'failureCount'
+            with self.lock:
+                task[counter] += 1
+                task['percentageProgress'] = int(100 * (n + 1) / len(rows))
+            for report_type, lines in pending.items():
+                if len(lines) >= self.rows_per_report:
+                    self._flush(task, report_type, lines)
+            if self.row_delay:
+                time.sleep(self.row_delay)
+
+        for report_type, lines in pending.items():
+            self._flush(task, report_type, lines)
+        with self.lock:
+            task['status'] = 'Completed'
+            task['percentageProgress'] = 100
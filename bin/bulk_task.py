@@ -0,0 +1,356 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# bulk_task.py
+#
+# runs a bulk provisioning task and downloads its reports
+"""Bulk provisioning orchestration
+
+Uploads the bulk input file, starts the registration task, polls the
+task with an adaptive interval and downloads all RESULTS and ERRORS
+report links concurrently over one pooled HTTP session.
+
+run_sharded() splits the input file into contiguous shards which run as
+concurrent registration tasks. The shard reports are merged back into
+one results.json and errors.json with referenceIds relative to the
+original input file.
+"""
+
+import concurrent.futures
+import json
+import os
+import shutil
+import time
+
+import boto3
+import requests
+
+from stages import StageTimer
+
+FINAL_STATES = ('Completed', 'Failed', 'Cancelled')
+REPORT_TYPES = ('RESULTS', 'ERRORS')
+POLL_MIN = 1.0
+POLL_MAX = 30.0
+DOWNLOAD_WORKERS = 8
+CHUNK_SIZE = 1024 * 1024
+
+
+def upload_input(c_s3, bulk_file, bucket, key=None):
+    """uploads the bulk input file, returns the key"""
+    key = key or os.path.basename(bulk_file)
+    print("copying {} to s3://{}/{}".format(bulk_file, bucket, key))
+    c_s3.upload_file(bulk_file, bucket, key)
+    return key
+
+
+def start_task(c_iot, template_body, bucket, key, role_arn):
+    """starts a thing registration task, returns the task id"""
+    response = c_iot.start_thing_registration_task(
+        templateBody=template_body,
+        inputFileBucket=bucket,
+        inputFileKey=key,
+        roleArn=role_arn
+    )
+    print("task_id: {}".format(response['taskId']))
+    return response['taskId']
+
+
+def next_poll_delay(delay, progress, elapsed, percentage, poll_min=POLL_MIN, poll_max=POLL_MAX):
+    """interval until the next describe call
+
+    Without progress the interval doubles. With progress the interval is
+    half of the estimated remaining time, so the poll lands close to the
+    end of the task without hammering the API.
+    """
+    if not progress:
+        return min(delay * 2, poll_max)
+    if percentage and 0 < percentage < 100:
+        remaining = elapsed * (100 - percentage) / percentage
+        return max(poll_min, min(remaining / 2, poll_max))
+    return poll_min
+
+
+def wait_for_task(c_iot, task_id, poll_min=POLL_MIN, poll_max=POLL_MAX, timeout=None,
+                  sleep=time.sleep, verbose=True):
+    """polls the task until it reaches a final state, returns the last description"""
+    start = time.perf_counter()
+    delay = poll_min
+    last_done = -1
+    while True:
+        task = c_iot.describe_thing_registration_task(taskId=task_id)
+        done = task.get('successCount', 0) + task.get('failureCount', 0)
+        elapsed = time.perf_counter() - start
+        if verbose:
+            print("{:.1f}s task_id: {} status: {} success: {} failure: {} progress: {}%".format(
+                elapsed, task_id, task['status'], task.get('successCount', 0),
+                task.get('failureCount', 0), task.get('percentageProgress', 0)))
+        if task['status'] in FINAL_STATES:
+            return task
+        if timeout is not None and elapsed > timeout:
+            raise TimeoutError("task {} not finished after {} secs".format(task_id, timeout))
+
+        delay = next_poll_delay(delay, done > last_done, elapsed,
+                                task.get('percentageProgress'), poll_min, poll_max)
+        last_done = done
+        sleep(delay)
+
+
+def list_report_links(c_iot, task_id, report_type):
+    """all resource links of a report type, following nextToken"""
+    links = []
+    kwargs = {'taskId': task_id, 'reportType': report_type}
+    while True:
+        response = c_iot.list_thing_registration_task_reports(**kwargs)
+        links.extend(response.get('resourceLinks', []))
+        if not response.get('nextToken'):
+            return links
+        kwargs['nextToken'] = response['nextToken']
+
+
+def http_session(pool_size=DOWNLOAD_WORKERS):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def download(session, url, path):
+    """streams url to path, returns the number of bytes"""
+    size = 0
+    with session.get(url, stream=True, timeout=60) as r:
+        r.raise_for_status()
+        with open(path, 'wb') as f:
+            for chunk in r.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+                size += len(chunk)
+    return size
+
+
+def concat(parts, path):
+    """concatenates the downloaded report parts in order into path"""
+    with open(path, 'wb') as out:
+        for part in parts:
+            with open(part, 'rb') as f:
+                shutil.copyfileobj(f, out, CHUNK_SIZE)
+            os.remove(part)
+
+
+def download_reports(links, out_dir, workers=DOWNLOAD_WORKERS, session=None, prefix=''):
+    """downloads {report_type: [url, ...]} concurrently
+
+    Every report type is merged in link order into <prefix><type>.json in
+    out_dir, e.g. results.json and errors.json. Returns {report_type: path}
+    for all report types with at least one link and the number of bytes.
+    """
+    session = session or http_session(workers)
+    jobs = []
+    for report_type, urls in links.items():
+        for n, url in enumerate(urls):
+            part = os.path.join(out_dir, '{}{}.{:04d}.part'.format(prefix, report_type.lower(), n))
+            jobs.append((report_type, part, url))
+
+    total = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(download, session, url, part) for _, part, url in jobs]
+        for future in futures:
+            total += future.result()
+
+    reports = {}
+    for report_type, urls in links.items():
+        if not urls:
+            continue
+        path = os.path.join(out_dir, '{}{}.json'.format(prefix, report_type.lower()))
+        concat([part for t, part, _ in jobs if t == report_type], path)
+        reports[report_type] = path
+    return reports, total
+
+
+def fetch_reports(c_iot, task_id, out_dir, workers=DOWNLOAD_WORKERS, session=None, prefix=''):
+    links = {report_type: list_report_links(c_iot, task_id, report_type)
+             for report_type in REPORT_TYPES}
+    for report_type, urls in links.items():
+        print("{} report links: {}".format(report_type, len(urls)))
+    return download_reports(links, out_dir, workers, session, prefix)
+
+
+def run_bulk_task(bulk_file, template_body, bucket, role_arn, out_dir, key=None,
+                  upload=True, c_iot=None, c_s3=None, workers=DOWNLOAD_WORKERS,
+                  poll_min=POLL_MIN, poll_max=POLL_MAX, timeout=None, timer=None,
+                  sleep=time.sleep, prefix=''):
+    """upload, start, wait and download for one bulk input file
+
+    Returns (task description, {report_type: path}, StageTimer).
+    """
+    timer = timer or StageTimer()
+    c_iot = c_iot or boto3.client('iot')
+    c_s3 = c_s3 or boto3.client('s3')
+
+    if upload:
+        with timer.stage("upload input"):
+            key = upload_input(c_s3, bulk_file, bucket, key)
+    else:
+        key = key or os.path.basename(bulk_file)
+
+    with timer.stage("start task"):
+        task_id = start_task(c_iot, template_body, bucket, key, role_arn)
+
+    with timer.stage("wait for task"):
+        task = wait_for_task(c_iot, task_id, poll_min, poll_max, timeout, sleep)
+    timer.set_count("wait for task", task.get('successCount', 0) + task.get('failureCount', 0))
+
+    with timer.stage("download reports"):
+        reports, size = fetch_reports(c_iot, task_id, out_dir, workers, prefix=prefix)
+    print("downloaded {} bytes of reports".format(size))
+
+    return task, reports, timer
+
+
+def split_input(bulk_file, shards, out_dir):
+    """splits bulk_file into contiguous shards
+
+    Returns a list of (path, offset, count) where offset is the line
+    number of the first row of the shard in bulk_file.
+    """
+    with open(bulk_file) as f:
+        total = sum(1 for line in f if line.strip())
+    per_shard = max(1, -(-total // shards))
+    base = os.path.splitext(os.path.basename(bulk_file))[0]
+
+    parts = []
+    out = None
+    with open(bulk_file) as f:
+        n = 0
+        for line in f:
+            if not line.strip():
+                continue
+            if n % per_shard == 0:
+                if out:
+                    out.close()
+                path = os.path.join(out_dir, '{}.shard-{:03d}.json'.format(base, len(parts)))
+                out = open(path, 'w', buffering=CHUNK_SIZE)
+                parts.append([path, n, 0])
+            out.write(line)
+            parts[-1][2] += 1
+            n += 1
+    if out:
+        out.close()
+    return [tuple(part) for part in parts]
+
+
+def iter_sorted_lines(path):
+    """yields the lines of a report ordered by referenceId
+
+    Only the referenceId and file position of every line are held in
+    memory; the lines are read again in order.
+    """
+    index = []
+    with open(path, 'rb') as f:
+        while True:
+            position = f.tell()
+            line = f.readline()
+            if not line:
+                break
+            if line.strip():
+                index.append((int(json.loads(line)['referenceId']), position))
+        index.sort()
+        for _, position in index:
+            f.seek(position)
+            yield f.readline().decode('utf-8')
+
+
+def merge_reports(shard_reports, out_dir):
+    """merges the reports of all shards in shard order
+
+    shard_reports is a list of (offset, {report_type: path}). The
+    referenceId of every line is shifted by the offset of its shard.
+    The lines of a shard are written ordered by referenceId; the shards
+    cover contiguous ranges of the input, so the merged report is ordered
+    too. Returns {report_type: path} of the merged reports.
+    """
+    merged = {}
+    for report_type in REPORT_TYPES:
+        parts = [(offset, reports[report_type]) for offset, reports in shard_reports
+                 if report_type in reports]
+        if not parts:
+            continue
+        path = os.path.join(out_dir, '{}.json'.format(report_type.lower()))
+        with open(path, 'w', buffering=CHUNK_SIZE) as out:
+            for offset, part in parts:
+                for line in iter_sorted_lines(part):
+                    d = json.loads(line)
+                    d['referenceId'] = str(int(d['referenceId']) + offset)
+                    out.write(json.dumps(d) + '\n')
+                os.remove(part)
+        merged[report_type] = path
+    return merged
+
+
+class ShardResult(object):
+    def __init__(self, index, path, offset, count):
+        self.index = index
+        self.path = path
+        self.offset = offset
+        self.count = count
+        self.task = None
+        self.reports = {}
+        self.timer = StageTimer()
+
+    def devices_per_sec(self):
+        secs = self.timer.total()
+        return self.count / secs if secs > 0 else None
+
+
+def run_sharded(bulk_file, template_body, bucket, role_arn, out_dir, shards, c_iot=None,
+                c_s3=None, workers=DOWNLOAD_WORKERS, poll_min=POLL_MIN, poll_max=POLL_MAX,
+                timeout=None, timer=None, sleep=time.sleep):
+    """runs one registration task per shard concurrently
+
+    Returns (list of ShardResult, merged {report_type: path}, StageTimer).
+    Every shard uploads its input, runs its task and downloads its
+    reports independently of the others. An empty bulk_file starts no
+    task.
+    """
+    timer = timer or StageTimer()
+    c_iot = c_iot or boto3.client('iot')
+    c_s3 = c_s3 or boto3.client('s3')
+
+    with timer.stage("split input"):
+        parts = split_input(bulk_file, shards, out_dir)
+    results = [ShardResult(i, path, offset, count) for i, (path, offset, count) in enumerate(parts)]
+    timer.set_count("split input", sum(r.count for r in results))
+    if not results:
+        return results, {}, timer
+
+    def run_shard(result):
+        result.task, result.reports, _ = run_bulk_task(
+            result.path, template_body, bucket, role_arn, out_dir,
+            c_iot=c_iot, c_s3=c_s3, workers=max(1, workers // len(results)),
+            poll_min=poll_min, poll_max=poll_max, timeout=timeout, timer=result.timer,
+            sleep=sleep, prefix='shard-{:03d}.'.format(result.index))
+        return result
+
+    with timer.stage("sharded tasks", sum(r.count for r in results)):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(results)) as executor:
+            for future in [executor.submit(run_shard, r) for r in results]:
+                future.result()
+
+    with timer.stage("merge reports"):
+        merged = merge_reports([(r.offset, r.reports) for r in results], out_dir)
+    return results, merged, timer
+
+
+def print_shards(results, timer):
+    print("")
+    print("shard  things  status      success  failure  secs      devices/sec")
+    for r in results:
+        rate = r.devices_per_sec()
+        print("{:<6} {:<7} {:<11} {:<8} {:<8} {:<9.3f} {}".format(
+            r.index, r.count, r.task['status'], r.task.get('successCount', 0),
+            r.task.get('failureCount', 0), r.timer.total(),
+            "{:.1f}".format(rate) if rate else "-"))
+    stage = timer.as_dict().get("sharded tasks", {})
+    if stage.get("per_sec"):
+        print("aggregate: {} things in {:.3f} secs, {:.1f} devices/sec".format(
+            stage["count"], stage["secs"], stage["per_sec"]))
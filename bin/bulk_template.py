@@ -0,0 +1,312 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# bulk_template.py
+#
+# evaluates a provisioning template against the rows of a bulk input file
+"""Offline dry run of a provisioning template
+
+Every row of the bulk input file is evaluated against the template like
+the registration task would do: the Parameters of the template are
+filled from the row or their Default, Ref and Fn::Join are resolved in
+the Resources and the CSRs are parsed and their signatures checked.
+Rows are evaluated in batches in a process pool; the parent process
+checks for duplicate thing names and streams the results.
+"""
+
+import collections
+import concurrent.futures
+import json
+import os
+import re
+import sys
+
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+
+from stages import StageTimer
+
+BATCH_SIZE = 1000
+THING_NAME_RE = re.compile(r'^[a-zA-Z0-9:_-]{1,128}$')
+CERTIFICATE_STATES = ('ACTIVE', 'INACTIVE')
+
+
+class TemplateError(Exception):
+    pass
+
+
+def resolve(value, params, missing=None):
+    """resolves Ref and Fn::Join in value with params
+
+    A Ref to a name which is not in params raises TemplateError, unless a
+    list is passed as missing: then the name is appended to it and the Ref
+    resolves to None.
+    """
+    if isinstance(value, dict):
+        if len(value) == 1:
+            name, arg = next(iter(value.items()))
+            if name == 'Ref':
+                if arg not in params:
+                    if missing is None:
+                        raise TemplateError("Ref to unknown parameter \"{}\"".format(arg))
+                    missing.append(arg)
+                    return None
+                return params[arg]
+            if name == 'Fn::Join':
+                delimiter, items = arg
+                return delimiter.join(str(resolve(item, params, missing)) for item in items)
+            if name.startswith('Fn::'):
+                raise TemplateError("unsupported function \"{}\"".format(name))
+        return {k: resolve(v, params, missing) for k, v in value.items()}
+    if isinstance(value, list):
+        return [resolve(v, params, missing) for v in value]
+    return value
+
+
+def refs(value):
+    """all parameter names referenced in value"""
+    if isinstance(value, dict):
+        if len(value) == 1 and 'Ref' in value:
+            yield value['Ref']
+            return
+        for v in value.values():
+            for ref in refs(v):
+                yield ref
+    elif isinstance(value, list):
+        for v in value:
+            for ref in refs(v):
+                yield ref
+
+
+def check_template(template):
+    """static checks of the template, returns a list of errors"""
+    errors = []
+    params = template.get('Parameters', {})
+    resources = template.get('Resources')
+    if not resources:
+        errors.append("template has no Resources")
+        return errors
+    for ref in set(refs(resources)):
+        if ref not in params:
+            errors.append("Ref to unknown parameter \"{}\"".format(ref))
+    return errors
+
+
+def check_csr(pem, thing_name=None, require_cn=False):
+    """returns a list of errors of a PEM encoded CSR"""
+    try:
+        csr = x509.load_pem_x509_csr(pem.encode('ascii'))
+    except (ValueError, UnicodeEncodeError) as e:
+        return ["malformed CSR: {}".format(e)]
+    errors = []
+    if not csr.is_signature_valid:
+        errors.append("CSR signature is not valid")
+    cns = csr.subject.get_attributes_for_oid(NameOID.COMMON_NAME)
+    if not cns:
+        errors.append("CSR subject has no CN")
+    elif require_cn and thing_name and cns[0].value != thing_name:
+        errors.append("CSR CN \"{}\" does not match thing name \"{}\"".format(cns[0].value, thing_name))
+    return errors
+
+
+def evaluate_row(template, row, require_cn=False):
+    """evaluates one row
+
+    Returns (thing_name, resources, errors, warnings). resources maps the
+    logical ids of the template to their type and resolved properties.
+    """
+    errors = []
+    warnings = []
+    params = {}
+    declared = template.get('Parameters', {})
+    for name, definition in declared.items():
+        if name in row:
+            params[name] = row[name]
+        elif 'Default' in definition:
+            params[name] = definition['Default']
+    for name in row:
+        if name not in declared:
+            warnings.append("\"{}\" is not a template parameter".format(name))
+
+    resources = {}
+    for logical_id, resource in template['Resources'].items():
+        missing = []
+        try:
+            properties = resolve(resource.get('Properties', {}), params, missing)
+        except TemplateError as e:
+            errors.append("{}: {}".format(logical_id, e))
+            continue
+        if missing:
+            errors.append("{}: missing parameter {}".format(logical_id, ", ".join(sorted(set(missing)))))
+        resources[logical_id] = {'Type': resource.get('Type'), 'Properties': properties}
+
+    thing_name = None
+    for logical_id, resource in resources.items():
+        properties = resource['Properties']
+        if resource['Type'] == 'AWS::IoT::Thing':
+            thing_name = properties.get('ThingName')
+            if not isinstance(thing_name, str) or not THING_NAME_RE.match(thing_name):
+                errors.append("{}: invalid ThingName {!r}".format(logical_id, thing_name))
+        elif resource['Type'] == 'AWS::IoT::Certificate':
+            if properties.get('Status', 'ACTIVE') not in CERTIFICATE_STATES:
+                errors.append("{}: invalid Status {!r}".format(logical_id, properties.get('Status')))
+            csr = properties.get('CertificateSigningRequest')
+            if csr is not None:
+                if not isinstance(csr, str):
+                    errors.append("{}: CertificateSigningRequest is not a string".format(logical_id))
+                else:
+                    errors.extend("{}: {}".format(logical_id, e)
+                                  for e in check_csr(csr, thing_name, require_cn))
+    return thing_name, resources, errors, warnings
+
+
+_worker = {}
+
+
+def _init_worker(template, require_cn, keep_resources):
+    _worker['template'] = template
+    _worker['require_cn'] = require_cn
+    _worker['keep_resources'] = keep_resources
+
+
+def _evaluate_batch(batch):
+    """process pool worker: batch is a list of (reference_id, line)"""
+    results = []
+    for reference_id, line in batch:
+        try:
+            row = json.loads(line)
+            if not isinstance(row, dict):
+                raise ValueError("row is not a JSON object")
+        except ValueError as e:
+            results.append((reference_id, None, None, ["invalid JSON: {}".format(e)], []))
+            continue
+        thing_name, resources, errors, warnings = evaluate_row(
+            _worker['template'], row, _worker['require_cn'])
+        if not _worker['keep_resources']:
+            resources = None
+        results.append((reference_id, thing_name, resources, errors, warnings))
+    return results
+
+
+def iter_batches(f, batch_size=BATCH_SIZE):
+    batch = []
+    for n, line in enumerate(f):
+        if not line.strip():
+            continue
+        batch.append((n, line))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_evaluated(bulk_file, template, workers=None, require_cn=False, keep_resources=False,
+                   batch_size=BATCH_SIZE):
+    """yields (reference_id, thing_name, resources, errors, warnings) in input order
+
+    resources is None unless keep_resources is set. At most 2 * workers
+    batches are in flight at any time.
+    """
+    workers = workers or os.cpu_count() or 1
+    with open(bulk_file) as f:
+        if workers == 1:
+            _init_worker(template, require_cn, keep_resources)
+            for batch in iter_batches(f, batch_size):
+                for result in _evaluate_batch(batch):
+                    yield result
+            return
+
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_worker,
+                initargs=(template, require_cn, keep_resources)) as executor:
+            pending = collections.deque()
+            for batch in iter_batches(f, batch_size):
+                pending.append(executor.submit(_evaluate_batch, batch))
+                if len(pending) >= workers * 2:
+                    for result in pending.popleft().result():
+                        yield result
+            while pending:
+                for result in pending.popleft().result():
+                    yield result
+
+
+class DryRunStats(object):
+    def __init__(self):
+        self.rows = 0
+        self.failed = 0
+        self.warnings = 0
+        self.duplicates = 0
+        self.error_counts = collections.Counter()
+
+
+def dry_run(bulk_file, template, workers=None, require_cn=False, resources_file=None,
+            max_errors=20, timer=None, out=None):
+    """evaluates all rows of bulk_file, returns (DryRunStats, StageTimer)
+
+    Errors are printed for the first max_errors failed rows. When
+    resources_file is given the resolved resources of every row are
+    written to it as JSON lines.
+    """
+    timer = timer or StageTimer()
+    stats = DryRunStats()
+    template_errors = check_template(template)
+    if template_errors:
+        raise TemplateError("; ".join(template_errors))
+
+    seen = {}
+    resources_out = open(resources_file, 'w', buffering=1024 * 1024) if resources_file else None
+    try:
+        with timer.stage("evaluate rows"):
+            for reference_id, thing_name, resources, errors, warnings in iter_evaluated(
+                    bulk_file, template, workers, require_cn, resources_out is not None):
+                stats.rows += 1
+                if isinstance(thing_name, str):
+                    # invalid names are already reported by evaluate_row
+                    if thing_name in seen:
+                        errors = errors + ["duplicate ThingName \"{}\", first in row {}".format(
+                            thing_name, seen[thing_name])]
+                        stats.duplicates += 1
+                    else:
+                        seen[thing_name] = reference_id
+                if warnings:
+                    stats.warnings += 1
+                if errors:
+                    stats.failed += 1
+                    for error in errors:
+                        stats.error_counts[_error_kind(error)] += 1
+                    if stats.failed <= max_errors:
+                        print("row {} ({}): {}".format(reference_id, thing_name, "; ".join(errors)),
+                              file=out)
+                if resources_out and resources is not None:
+                    resources_out.write(json.dumps({
+                        "referenceId": str(reference_id),
+                        "ThingName": thing_name,
+                        "valid": not errors,
+                        "resources": resources
+                    }) + "\n")
+        timer.set_count("evaluate rows", stats.rows)
+    finally:
+        if resources_out:
+            resources_out.close()
+    return stats, timer
+
+
+def _error_kind(error):
+    """error message without the row specific parts, used to count errors by kind"""
+    kind = error.split(': ', 1)[-1]
+    return re.sub(r'(".*?"|\'.*?\'|\d+)', '_', kind)[:80]
+
+
+def print_summary(stats, timer, bulk_file, out=None):
+    print("", file=out)
+    print("dry run: {}".format(bulk_file), file=out)
+    print("--------------------------------------------------------------", file=out)
+    print("rows: {}".format(stats.rows), file=out)
+    print("rows with errors: {}".format(stats.failed), file=out)
+    print("rows with warnings: {}".format(stats.warnings), file=out)
+    print("duplicate thing names: {}".format(stats.duplicates), file=out)
+    for kind, count in stats.error_counts.most_common(10):
+        print("  {:>8}  {}".format(count, kind), file=out)
+    timer.report(out=out or sys.stdout)
@@ -20,16 +20,24 @@
 """Clean up workshop resources"""
 
 
+import argparse
 import os
-import time
+import sys
 
 import boto3
 
+from fleet_search import SearchStats, iter_thing_names
+from progress import Progress
+from ratelimit import NO_RETRY_CONFIG, RateLimiter, ThrottledClient, MAX_RATE, RATE
+from teardown import Teardown, WORKERS
+from teardown_journal import JOURNAL_FILE, TeardownJournal
+from teardown_plan import build_plan
+
 IOT_ENDPOINT = os.environ['IOT_ENDPOINT']
 
 #######################################################################
 QUERY_STRINGS = [
-    'bulky*', 'jitr-*', 'fleety*', 'device-client-*'
+    'bulky*', 'jitr-*', 'fleety*', 'device-client-*',
     'my-first-thing', 'my-second-thing', 'job-agent',
     'group-member', 'my-jitp-device', 'my-jitr-device',
     'dd-agent', 'tunneling-listener-agent'
@@ -42,139 +50,127 @@ POLICY_NAMES = [
 ]
 #######################################################################
 
-def delete_thing(thing_name):
-    """deletes a thing in AWS IoT Core"""
-    global POLICY_NAMES
-
-    print("  DELETING thing_name: {}".format(thing_name))
-
-    try:
-        r_principals = c_iot.list_thing_principals(thingName=thing_name)
-    except Exception as list_thing_principals_error:
-        print("ERROR listing thing principals: {}".format(list_thing_principals_error))
-        r_principals = {'principals': []}
-
-    for arn in r_principals['principals']:
-        cert_id = arn.split('/')[1]
-        print("  arn: {} cert_id: {}".format(arn, cert_id))
-
-        r_detach_thing = c_iot.detach_thing_principal(thingName=thing_name,principal=arn)
-        print("  DETACH THING: {}".format(r_detach_thing))
-
-        r_upd_cert = c_iot.update_certificate(certificateId=cert_id,newStatus='INACTIVE')
-        print("  INACTIVE: {}".format(r_upd_cert))
-
-        r_policies = c_iot.list_principal_policies(principal=arn)
-        #print("    r_policies: {}".format(r_policies))
-
-        for pol in r_policies['policies']:
-            pol_name = pol['policyName']
-            print("    pol_name: {}".format(pol_name))
-            POLICY_NAMES.append(pol_name)
-            r_detach_pol = c_iot.detach_policy(policyName=pol_name,target=arn)
-            print("    DETACH POL: {}".format(r_detach_pol))
+def search_things():
+    """yields the names of the things matching QUERY_STRINGS while they are searched"""
+    # free text queries, a thing can match more than one of them
+    return iter_thing_names(c_iot, QUERY_STRINGS, workers=args.search_workers, unique=True,
+                            stats=search_stats, verbose=args.verbose)
+
+
+def find_things():
+    """returns the names of all things matching QUERY_STRINGS"""
+    THING_NAMES.extend(search_things())
+
+    print("search: {}".format(search_stats.line()))
+    print("--------------------------------------\n")
+    print("thing names to be DELETED:\n{}\n".format(THING_NAMES))
+    print("number of things to be deleted: {}\n".format(len(THING_NAMES)))
+    print("--------------------------------------\n")
+    return THING_NAMES
+
+parser = argparse.ArgumentParser(description='Clean up workshop resources')
+parser.add_argument("-w", "--workers", action="store", dest="workers", type=int, default=WORKERS,
+                    help="number of threads deleting things")
+parser.add_argument("-r", "--rate", action="store", dest="rate", type=float, default=RATE,
+                    help="initial calls/sec per API")
+parser.add_argument("-m", "--max-rate", action="store", dest="max_rate", type=float, default=MAX_RATE,
+                    help="maximum calls/sec per API")
+parser.add_argument("-n", "--dry-run", action="store_true", dest="dry_run", default=False,
+                    help="only print the plan with the number of calls and the estimated time")
+parser.add_argument("-j", "--journal", action="store", dest="journal", default=JOURNAL_FILE,
+                    help="SQLite journal of the run, an unfinished run is resumed")
+parser.add_argument("--restart", action="store_true", dest="restart", default=False,
+                    help="ignore an unfinished run in the journal and start over")
+parser.add_argument("-s", "--stream", action="store_true", dest="stream", default=False,
+                    help="delete things while they are searched, without plan and journal")
+parser.add_argument("--search-workers", action="store", dest="search_workers", type=int, default=4,
+                    help="number of query strings searched concurrently")
+parser.add_argument("-v", "--verbose", action="store_true", dest="verbose", default=False,
+                    help="print every API response")
+args = parser.parse_args()
+
+limiter = RateLimiter(rate=args.rate, max_rate=args.max_rate)
+search_stats = SearchStats()
+c_iot = ThrottledClient(boto3.client('iot', config=NO_RETRY_CONFIG), limiter)
+c_iot_data = boto3.client('iot-data', endpoint_url='https://{}'.format(IOT_ENDPOINT))
 
-        r_del_cert = c_iot.delete_certificate(certificateId=cert_id,forceDelete=True)
-        print("  DEL CERT: {}".format(r_del_cert))
 
-    r_del_thing = c_iot.delete_thing(thingName=thing_name)
-    print("  DELETE THING: {}\n".format(r_del_thing))
+def stream_teardown():
+    """deletes the things while search_index pages through QUERY_STRINGS
 
-c_iot = boto3.client('iot')
-c_iot_data = boto3.client('iot-data', endpoint_url='https://{}'.format(IOT_ENDPOINT))
+    Only a few pages of thing names are held in memory and the first
+    things are deleted right after the first page arrived.
+    """
+    print("query strings: {}".format(QUERY_STRINGS))
+    input("THE DEVICES MATCHING THE QUERY STRINGS ABOVE WILL BE DELETED INCLUDING CERTIFICATES AND POLICIES\n== \
+press <enter> to continue, <ctrl+c> to abort!\n")
 
-for query_string in QUERY_STRINGS:
-    print("query_string: {}".format(query_string))
-
-    response = c_iot.search_index(
-        queryString=query_string,
-    )
-
-    print("response:\n{}".format(response))
-    for thing in response["things"]:
-        THING_NAMES.append(thing["thingName"])
-
-    while 'nextToken' in response:
-        next_token = response['nextToken']
-        print("next token: {}".format(next_token))
-        response = c_iot.search_index(
-            queryString=query_string,
-            nextToken=next_token
-        )
-        print("response:\n{}".format(response))
-        for thing in response["things"]:
-            THING_NAMES.append(thing["thingName"])
-
-#print("END WHILE")
+    progress = Progress("things", limiter=limiter)
+    teardown = Teardown(c_iot, workers=args.workers, progress=progress, verbose=args.verbose)
+    try:
+        deleted = teardown.delete_things(search_things())
+    finally:
+        progress.close()
+    print("deleted {} things in {:.1f} secs., {} calls, throttled {}x, API rates: {}".format(
+        deleted, progress.elapsed(), limiter.calls, limiter.throttles, limiter.current_rates()))
+    print("search: {}".format(search_stats.line()))
+
+    for thing_group in THING_GROUPS:
+        teardown.delete_thing_group(thing_group)
+    for policy_name in dict.fromkeys(POLICY_NAMES + list(teardown.policy_names)):
+        teardown.delete_policy(policy_name, keep=policy_name == os.environ['IOT_POLICY'])
+
+
+if args.stream:
+    stream_teardown()
+    sys.exit()
+
+# a dry run only reads an existing journal and never creates one
+journal = TeardownJournal(args.journal, read_only=args.dry_run)
+plan = None if args.restart else journal.load_plan()
+if plan is None:
+    find_things()
+    print("planning teardown")
+    progress = Progress("things planned", total=len(set(THING_NAMES)), limiter=limiter)
+    plan = build_plan(c_iot, THING_NAMES, policy_names=POLICY_NAMES, thing_groups=THING_GROUPS,
+                      keep_policies=[os.environ['IOT_POLICY']], workers=args.workers,
+                      progress=progress)
+    progress.close()
+    if not args.dry_run:
+        journal.start(plan)
+else:
+    print("resuming the unfinished run in {}, {} things planned".format(
+        args.journal, len(plan.things)))
+
+pending = plan.pending(journal)
 print("--------------------------------------\n")
-print("thing names to be DELETED:\n{}\n".format(THING_NAMES))
-print("number of things to be deleted: {}\n".format(len(THING_NAMES)))
+pending.report(args.rate, args.workers)
 print("--------------------------------------\n")
+if args.dry_run:
+    sys.exit()
 
 input("THE DEVICES IN THE LIST ABOVE WILL BE DELETED INCLUDING CERTIFICATES AND POLICIES\n== \
 press <enter> to continue, <ctrl+c> to abort!\n")
-#sys.exit()
 
-for THING_NAME in THING_NAMES:
-    print("THING NAME: {}".format(THING_NAME))
-    delete_thing(THING_NAME)
-    time.sleep(0.5) # avoid to run into api throttling
-
-for thing_group in THING_GROUPS:
-    print(thing_group)
-    r_del_grp = c_iot.delete_thing_group(thingGroupName=thing_group)
-    print("DELETE THING GROUP: {}".format(r_del_grp))
-
-
-for policy_name in POLICY_NAMES:
-    print("DELETE policy: {}".format(policy_name))
-    try:
-        r_targets = c_iot.list_targets_for_policy(
-            policyName=policy_name,
-            pageSize=10
-        )
-        for arn in r_targets['targets']:
-            print("DETACH: {}".format(arn))
-            r_detach_pol = c_iot.detach_policy(policyName=policy_name,target=arn)
-            print("r_detach_pol: {}\n".format(r_detach_pol))
-
-        while 'nextMarker' in r_targets:
-            r_targets = c_iot.list_targets_for_policy(
-                policyName=policy_name,
-                marker=r_targets['nextMarker'],
-                pageSize=2
-            )
-            for arn in r_targets['targets']:
-                print("DETACH: {}".format(arn))
-                r_detach_pol = c_iot.detach_policy(policyName=policy_name,target=arn)
-                print("r_detach_pol: {}\n".format(r_detach_pol))
-
-
-        r_targets = c_iot.list_targets_for_policy(policyName=policy_name, pageSize=250)
-        for arn in r_targets['targets']:
-            print("DETACH: {}".format(arn))
-            r_detach_pol = c_iot.detach_policy(policyName=policy_name,target=arn)
-            print("r_detach_pol: {}\n".format(r_detach_pol))
-
-        r_versions = c_iot.list_policy_versions(policyName=policy_name)
-        print('policy_name: {} versions: {}'.format(
-            policy_name, r_versions['policyVersions']))
-
-        for version in r_versions["policyVersions"]:
-            if not version['isDefaultVersion']:
-                print(
-                    'policy_name: {} deleting policy version: {}'.format(
-                        policy_name, version['versionId']
-                    )
-                )
-                c_iot.delete_policy_version(policyName=policy_name,
-                    policyVersionId=version['versionId'])
-
-        if policy_name == os.environ['IOT_POLICY']:
-            continue
-        r_del_pol = c_iot.delete_policy(policyName=policy_name)
-        print("r_del_pol: {}".format(r_del_pol))
-    except c_iot.exceptions.ResourceNotFoundException:
-        print("policy_name \"{}\" does not exist".format(policy_name))
-    except Exception as delete_policy_error:
-        print("ERROR: {}".format(delete_policy_error))
+progress = Progress("things", total=len(pending.things), limiter=limiter)
+teardown = Teardown(c_iot, workers=args.workers, progress=progress, verbose=args.verbose,
+                    journal=journal)
+try:
+    deleted = teardown.run_plan(pending)
+finally:
+    progress.close()
+print("deleted {} of {} things in {:.1f} secs., {} calls, throttled {}x, API rates: {}".format(
+    deleted, len(pending.things), progress.elapsed(), limiter.calls, limiter.throttles,
+    limiter.current_rates()))
+
+left = plan.pending(journal)
+if left.things or left.policies or left.thing_groups or left.orphan_certificates:
+    print("not finished: {} things, {} policies, {} thing groups, {} certificates left".format(
+        len(left.things), len(left.policies), len(left.thing_groups),
+        len(left.orphan_certificates)))
+    for kind, name, error, attempts in journal.failures():
+        print("  {} {} ({} attempts): {}".format(kind, name, attempts, error))
+    print("run {} again to retry, the journal is {}".format(sys.argv[0], args.journal))
+else:
+    journal.finish()
+journal.close()
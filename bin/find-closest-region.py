@@ -13,11 +13,17 @@
 # express or implied. See the License for the specific language governing
 # permissions and limitations under the License.
 
+import argparse
 import json
 import logging
 import requests
 import sys
-from geopy.distance import great_circle
+
+from lambda_source import LAMBDA_DIR, lambda_regions
+
+sys.path.insert(0, LAMBDA_DIR)
+from region_lookup import RegionTable
+from region_probe import TIMEOUT, RegionProber
 
 #http://geopy.readthedocs.io/en/latest/
 #https://www.latlong.net/
@@ -49,23 +55,81 @@ def get_ip_location():
     return j
 
 
-j = get_ip_location()
-lat = float(j['latitude'])
-lon = float(j['longitude'])
-logger.info("lat: {}, lon: {}".format(lat, lon))
-
-min_distance = 40000
-closest_region = None
-for r in regions:
-    logger.debug("r: {}".format(r))
-    elat = float(r["lat"])
-    elon = float(r["lon"])
-    logger.debug("elat: {}, elon: {}".format(elat, elon))
-    distance = great_circle((lat, lon), (elat, elon)).km
-    logger.debug("distance: {}".format(distance))
-    if distance <= min_distance:
-        min_distance = distance
-        closest_region = r["name"]
-    logger.debug("min_distance: {}".format(min_distance))
-
-logger.info("closest_region: {}, distance: {}".format(closest_region, min_distance))
+def closest_region(lat=None, lon=None, regions=regions):
+    if lat is None or lon is None:
+        j = get_ip_location()
+        lat = float(j['latitude'])
+        lon = float(j['longitude'])
+    logger.info("lat: {}, lon: {}".format(lat, lon))
+
+    closest_region, min_distance = RegionTable(regions).nearest(lat, lon)
+
+    logger.info("closest_region: {}, distance: {}".format(closest_region, min_distance))
+    return closest_region
+
+
+def fastest_region(prober):
+    region, secs, latencies = prober.fastest()
+    for name in sorted(latencies, key=lambda r: (latencies[r] is None, latencies[r])):
+        if latencies[name] is None:
+            logger.info("{}: failed: {}".format(name, prober.errors.get(name)))
+        else:
+            logger.info("{}: {:.1f} ms".format(name, latencies[name] * 1000))
+    if region:
+        logger.info("fastest_region: {}, handshake: {:.1f} ms".format(region, secs * 1000))
+    return region, latencies
+
+
+def parse_stand_ins(spec):
+    """region=ms,region=fail,... -> {region: secs or None}"""
+    delays = {}
+    for item in spec.split(','):
+        region, _, delay = item.partition('=')
+        delays[region] = None if delay == 'fail' else float(delay) / 1000
+    return delays
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Find the AWS region closest to this device')
+    parser.add_argument("-p", "--probe", action="store_true", dest="probe", default=False,
+                        help="pick the region with the fastest TLS handshake, distance if all probes fail")
+    parser.add_argument("-t", "--timeout", action="store", dest="timeout", type=float, default=TIMEOUT,
+                        help="seconds to wait for the probes")
+    parser.add_argument("--tcp-only", action="store_false", dest="tls", default=True,
+                        help="only measure the TCP connect")
+    parser.add_argument("--lat", action="store", dest="lat", type=float,
+                        help="latitude of the device instead of the GeoIP lookup")
+    parser.add_argument("--lon", action="store", dest="lon", type=float,
+                        help="longitude of the device instead of the GeoIP lookup")
+    parser.add_argument("--stand-in", action="store", dest="stand_in",
+                        help="probe local listeners instead, e.g. us-east-1=80,eu-central-1=20,us-west-1=fail")
+    parser.add_argument("-j", "--json", action="store_true", dest="json", default=False,
+                        help="print the region-latencies for the provisioning request")
+    args = parser.parse_args(argv)
+
+    if not args.probe:
+        closest_region(args.lat, args.lon)
+        return
+
+    endpoints = None
+    ssl_context = None
+    # probe the regions the provisioning Lambda can choose from
+    probe_regions = lambda_regions()
+    names = [r["name"] for r in probe_regions]
+    if args.stand_in:
+        from region_standin import stand_ins
+
+        endpoints, ssl_context, _ = stand_ins(parse_stand_ins(args.stand_in))
+        names = list(endpoints)
+    prober = RegionProber(names, endpoints=endpoints, timeout=args.timeout,
+                          tls=args.tls, ssl_context=ssl_context)
+    region, latencies = fastest_region(prober)
+    if region is None:
+        logger.warning("all probes failed, falling back to distance")
+        region = closest_region(args.lat, args.lon, probe_regions)
+    if args.json:
+        print(json.dumps({"region": region, "region-latencies": latencies}))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
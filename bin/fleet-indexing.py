@@ -23,6 +23,7 @@
 """
 
 import argparse
+import contextlib
 import json
 import os
 import random
@@ -30,17 +31,58 @@ import time
 
 import boto3
 
+from fleet_search import SearchStats, iter_things, prefix_partitions
+from pool import bounded_map
+from progress import Progress
+from ratelimit import NO_RETRY_CONFIG, RateLimiter, ThrottledClient, MAX_RATE, RATE
+import shadow_mqtt
+
 parser = argparse.ArgumentParser(
     description='Add shadow reported.reported.temperature to the things matching basename*'
 )
 parser.add_argument("-b", action="store", required=True, dest="thing_base_name",
                     help="Basename of the things to which the shadow document should be added.")
+parser.add_argument("-w", "--workers", action="store", dest="workers", type=int, default=32,
+                    help="number of threads updating things")
+parser.add_argument("-P", "--partitions", action="store_true", dest="partitions", default=False,
+                    help="split the search by the character after the basename and search in parallel")
+parser.add_argument("--search-workers", action="store", dest="search_workers", type=int, default=16,
+                    help="number of partitions searched concurrently")
+parser.add_argument("--shadow-rate", action="store", dest="shadow_rate", type=float, default=RATE,
+                    help="initial update_thing_shadow calls/sec")
+parser.add_argument("--registry-rate", action="store", dest="registry_rate", type=float, default=RATE,
+                    help="initial update_thing calls/sec")
+parser.add_argument("-m", "--max-rate", action="store", dest="max_rate", type=float, default=MAX_RATE,
+                    help="maximum calls/sec per API")
+parser.add_argument("-T", "--transport", action="store", dest="transport", default="https",
+                    choices=["https", "mqtt"],
+                    help="send shadow updates with update_thing_shadow or over MQTT")
+parser.add_argument("-r", "--rootCA", action="store", dest="root_ca",
+                    help="mqtt: root CA file path")
+parser.add_argument("-c", "--cert", action="store", dest="cert", help="mqtt: certificate file path")
+parser.add_argument("-k", "--key", action="store", dest="key", help="mqtt: private key file path")
+parser.add_argument("-id", "--clientId", action="store", dest="client_id", default="fleet-indexing",
+                    help="mqtt: client id, the connection number is appended")
+parser.add_argument("--connections", action="store", dest="connections", type=int, default=1,
+                    help="mqtt: number of MQTT connections")
+parser.add_argument("--in-flight", action="store", dest="in_flight", type=int,
+                    default=shadow_mqtt.IN_FLIGHT, help="mqtt: maximum unanswered shadow updates")
+parser.add_argument("--compare", action="store", dest="compare", type=int, default=0,
+                    help="mqtt: update this many shadows over HTTPS as well and compare updates/sec")
+parser.add_argument("--stand-in", action="store", dest="stand_in", type=int, default=0,
+                    help="run against a local stand-in with this many things instead of AWS IoT")
+parser.add_argument("-v", "--verbose", action="store_true", dest="verbose", default=False,
+                    help="print every shadow document and API response")
 
 args = parser.parse_args()
 thing_base_name = args.thing_base_name
+if args.transport == "mqtt" and not args.stand_in and not (args.root_ca and args.cert and args.key):
+    parser.error("--transport mqtt needs --rootCA, --cert and --key")
+if args.compare and args.transport != "mqtt":
+    parser.error("--compare compares the mqtt transport with https")
 
 
-IOT_ENDPOINT = os.environ['IOT_ENDPOINT']
+IOT_ENDPOINT = os.environ['IOT_ENDPOINT'] if not args.stand_in else None
 building_names = ['Day_One', 'Doppler', 'Kumo']
 ROOM_NUMBER = 100
 
@@ -59,45 +101,165 @@ def shadow_doc():
 }
 
 
-c_iot = boto3.client('iot')
-c_iot_data = boto3.client('iot-data', endpoint_url='https://{}'.format(IOT_ENDPOINT))
-
-query_string = "thingName:" + thing_base_name + "*"
-print("query_string: {}".format(query_string))
-response = c_iot.search_index(
-#    indexName='string',
-    queryString=query_string,
-#    nextToken='string',
-#    maxResults=123,
-#    queryVersion='string'
-)
-
-
-print("response:\n{}".format(response))
-
-for thing in response["things"]:
-    thing_name = thing["thingName"]
+def update_shadow(thing_name):
+    if shadow_writer:
+        shadow_writer.update(thing_name, shadow_doc())
+        return
     shadow_document = json.dumps(shadow_doc(), indent=4)
-    print("updating shadow for thing name: {}".format(thing_name))
-    print("shadow document: {}".format(shadow_document))
+    if args.verbose:
+        print("updating shadow for thing name: {}".format(thing_name))
+        print("shadow document: {}".format(shadow_document))
     response2 = c_iot_data.update_thing_shadow(
         thingName=thing_name,
         payload=shadow_document
     )
-    print(response2)
-    print("adding room number {} to thing attributes".format(ROOM_NUMBER))
+    if args.verbose:
+        print(response2)
+
+
+def update_attributes(thing_name, room_number):
+    if args.verbose:
+        print("adding room number {} to thing attributes of {}".format(room_number, thing_name))
     response3 = c_iot.update_thing(
         thingName=thing_name,
         attributePayload={
             'attributes': {
                 'building': building_names[random.randint(0, len(building_names) - 1)],
-                'room_number': str(ROOM_NUMBER)
+                'room_number': str(room_number)
             },
             'merge': True
         },
         removeThingType=False
     )
-    print(response3)
-    ROOM_NUMBER += 1
+    if args.verbose:
+        print(response3)
+
+
+def updates():
+    """yields the shadow and the registry update of every thing found
+
+    Both updates of a thing are separate jobs, so shadow and registry
+    calls run side by side in the pool, each limited by its own rate.
+    """
+    if args.partitions:
+        # ordered keeps the room numbers stable between runs
+        things = iter_things(c_iot, prefix_partitions(thing_base_name), workers=args.search_workers,
+                             ordered=True, stats=search_stats)
+    else:
+        things = iter_things(c_iot, [query_string], stats=search_stats)
+    for room_number, thing in enumerate(things, ROOM_NUMBER):
+        thing_name = thing["thingName"]
+        if len(sample) < args.compare:
+            sample.append(thing_name)
+        yield ('shadow', update_shadow, (thing_name,))
+        yield ('registry', update_attributes, (thing_name, room_number))
+
+
+def run(job):
+    _, fn, fn_args = job
+    return fn(*fn_args)
+
+
+def on_shadow_result(thing_name, accepted, error):
+    """result of an MQTT shadow update"""
+    if not accepted:
+        print("ERROR shadow update of {}: {}".format(thing_name, error))
+    progress.update(accepted)
+
+
+def compare_https(thing_names):
+    """updates the shadows of thing_names with update_thing_shadow, returns updates/sec"""
+    global shadow_writer
+    writer, shadow_writer = shadow_writer, None
+    start = time.perf_counter()
+    try:
+        ok = sum(1 for _, _, error in bounded_map(update_shadow, thing_names, args.workers)
+                 if error is None)
+    finally:
+        shadow_writer = writer
+    elapsed = time.perf_counter() - start
+    return ok / elapsed if elapsed > 0 else 0.0
+
+
+@contextlib.contextmanager
+def stand_in():
+    """moto for the IoT APIs and a local MQTT broker with args.stand_in things"""
+    from moto import mock_aws
+    from shadow_standin import LocalBroker
+
+    with mock_aws():
+        c_iot_local = boto3.client('iot', region_name='us-east-1')
+        for i in range(args.stand_in):
+            c_iot_local.create_thing(thingName="{}{}".format(thing_base_name, i))
+        print("stand-in: created {} things".format(args.stand_in))
+        yield LocalBroker()
+
+
+with contextlib.ExitStack() as stack:
+    broker = stack.enter_context(stand_in()) if args.stand_in else None
+    region = {'region_name': 'us-east-1'} if args.stand_in else {}
+    data_endpoint = {} if args.stand_in else {'endpoint_url': 'https://{}'.format(IOT_ENDPOINT)}
+
+    limiter = RateLimiter(
+        max_rate=args.max_rate,
+        rates={'update_thing_shadow': args.shadow_rate, 'update_thing': args.registry_rate}
+    )
+    c_iot = ThrottledClient(boto3.client('iot', config=NO_RETRY_CONFIG, **region), limiter)
+    c_iot_data = ThrottledClient(
+        boto3.client('iot-data', config=NO_RETRY_CONFIG, **dict(region, **data_endpoint)),
+        limiter
+    )
+
+    shadow_writer = None
+    if args.transport == "mqtt":
+        if broker:
+            clients = [broker.client("{}-{}".format(args.client_id, i))
+                       for i in range(args.connections)]
+            for client in clients:
+                client.connect()
+        else:
+            clients = shadow_mqtt.connect_clients(IOT_ENDPOINT, args.root_ca, args.key, args.cert,
+                                                  args.client_id, args.connections)
+        for client in clients:
+            stack.callback(client.disconnect)
+        shadow_writer = shadow_mqtt.MqttShadowWriter(clients, in_flight=args.in_flight,
+                                                     on_result=on_shadow_result)
+
+    query_string = "thingName:" + thing_base_name + "*"
+    print("query_string: {}".format(query_string))
+
+    sample = []
+    search_stats = SearchStats()
+    progress = Progress("updates", limiter=limiter)
+    failed = {'shadow': 0, 'registry': 0}
+    done = {'shadow': 0, 'registry': 0}
+    try:
+        for (kind, _, fn_args), _, error in bounded_map(run, updates(), args.workers):
+            if error:
+                print("ERROR {} update of {}: {}".format(kind, fn_args[0], error))
+                failed[kind] += 1
+            elif not (kind == 'shadow' and shadow_writer):
+                done[kind] += 1
+            if error or not (kind == 'shadow' and shadow_writer):
+                progress.update(error is None)
+        if shadow_writer:
+            shadow_writer.flush()
+            done['shadow'] = shadow_writer.accepted
+            failed['shadow'] += shadow_writer.rejected + shadow_writer.timed_out
+    finally:
+        progress.close()
 
-    time.sleep(0.5)
+    elapsed = progress.elapsed()
+    print("updated {} shadows ({} failed) and {} thing attributes ({} failed) in {:.1f} secs.".format(
+        done['shadow'], failed['shadow'], done['registry'], failed['registry'], elapsed))
+    print("search: {}".format(search_stats.line()))
+    print("{:.1f} things/sec, {} calls, throttled {}x, API rates: {}".format(
+        done['registry'] / elapsed if elapsed > 0 else 0.0, limiter.calls, limiter.throttles,
+        limiter.current_rates()))
+    if shadow_writer:
+        print("mqtt: {:.1f} shadow updates/sec over {} connections, {} rejected, {} timed out".format(
+            shadow_writer.rate(), len(shadow_writer.clients), shadow_writer.rejected,
+            shadow_writer.timed_out))
+        if sample:
+            print("https: {:.1f} shadow updates/sec for {} updates with {} workers".format(
+                compare_https(sample), len(sample), args.workers))
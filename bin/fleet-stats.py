@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# fleet-stats.py
+#
+# fleet statistics computed by the fleet index
+"""Print statistics, percentiles, cardinalities and buckets of the fleet
+
+Without aggregation options the temperature, room number and building
+attributes written by fleet-indexing.py are aggregated.
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import boto3
+
+from fleet_stats import (Aggregation, DEFAULT_AGGREGATIONS, MAX_BUCKETS, PERCENTS, TTL,
+                         TTLCache, WORKERS, fleet_stats, format_result)
+from ratelimit import NO_RETRY_CONFIG, RateLimiter, ThrottledClient
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Fleet statistics from the fleet index')
+    parser.add_argument("-q", "--query", action="store", dest="query", default="thingName:*",
+                        help="query string selecting the things")
+    parser.add_argument("--stats", action="append", dest="statistics", default=[], metavar="FIELD",
+                        help="count, average, min, max, ... of a numeric field")
+    parser.add_argument("--cardinality", action="append", dest="cardinality", default=[],
+                        metavar="FIELD", help="number of distinct values of a field")
+    parser.add_argument("--percentiles", action="append", dest="percentiles", default=[],
+                        metavar="FIELD", help="percentiles of a numeric field")
+    parser.add_argument("--buckets", action="append", dest="buckets", default=[], metavar="FIELD",
+                        help="number of things per value of a field")
+    parser.add_argument("-p", "--percents", action="store", dest="percents", type=float, nargs="+",
+                        default=PERCENTS, help="percents for --percentiles")
+    parser.add_argument("--max-buckets", action="store", dest="max_buckets", type=int,
+                        default=MAX_BUCKETS, help="number of buckets for --buckets")
+    parser.add_argument("-i", "--index", action="store", dest="index_name", help="index name")
+    parser.add_argument("--ttl", action="store", dest="ttl", type=float, default=TTL,
+                        help="seconds a result is cached")
+    parser.add_argument("--cache-file", action="store", dest="cache_file",
+                        help="share cached results between runs in this JSON file")
+    parser.add_argument("-w", "--workers", action="store", dest="workers", type=int, default=WORKERS,
+                        help="number of aggregations run concurrently")
+    parser.add_argument("--watch", action="store", dest="watch", type=float, default=0,
+                        help="print the statistics again every WATCH seconds")
+    parser.add_argument("-j", "--json", action="store_true", dest="json", default=False,
+                        help="print JSON lines instead of text")
+    args = parser.parse_args(argv)
+
+    aggregations = (
+        [Aggregation('statistics', f) for f in args.statistics] +
+        [Aggregation('cardinality', f) for f in args.cardinality] +
+        [Aggregation('percentiles', f) for f in args.percentiles] +
+        [Aggregation('buckets', f) for f in args.buckets]
+    ) or DEFAULT_AGGREGATIONS
+
+    c_iot = ThrottledClient(boto3.client('iot', config=NO_RETRY_CONFIG), RateLimiter())
+    cache = TTLCache(args.ttl, args.cache_file)
+
+    errors = 0
+    while True:
+        start = time.perf_counter()
+        results = fleet_stats(c_iot, args.query, aggregations, cache, args.workers,
+                              args.percents, args.max_buckets, args.index_name)
+        elapsed = time.perf_counter() - start
+        cache.save()
+
+        for aggregation, result, error, cached in results:
+            if error:
+                errors += 1
+            if args.json:
+                print(json.dumps({
+                    'query': args.query,
+                    'kind': aggregation.kind,
+                    'field': aggregation.field,
+                    'result': result,
+                    'error': str(error) if error else None,
+                    'cached': cached
+                }, default=str))
+            elif error:
+                print("{} {}: ERROR {}".format(aggregation.kind, aggregation.field, error))
+            else:
+                print("{} {}{}: {}".format(aggregation.kind, aggregation.field,
+                                           " (cached)" if cached else "",
+                                           format_result(aggregation, result)))
+        if not args.json:
+            print("query \"{}\": {} aggregations in {:.3f} secs., {} from cache".format(
+                args.query, len(results), elapsed, sum(1 for r in results if r[3])))
+
+        if not args.watch:
+            break
+        time.sleep(args.watch)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
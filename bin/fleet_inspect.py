@@ -0,0 +1,154 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# fleet_inspect.py
+#
+# concurrent inspection of many things for list-thing.py
+"""Fleet inspection with memoized policy lookups
+
+Inspector.inspect() runs describe_thing, list_thing_principals and
+describe_certificate for one thing; inspect_all() does so for many things
+in a bounded thread pool. describe_thing_type and get_policy go through a
+Memo, so a thing type or policy shared by thousands of things is fetched
+once, and concurrent lookups of the same key wait for the one call in
+flight instead of making their own. A failed call is not memoized, the
+next lookup of its key calls again.
+"""
+
+import concurrent.futures
+import threading
+
+from pool import bounded_map
+
+WORKERS = 16
+
+
+class Memo(object):
+    """thread safe memoization of a function of one hashable argument
+
+    Only results are kept: when fn raises, the callers waiting for it get
+    the exception and the key is forgotten.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.results = {}
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.hits = 0
+
+    def __call__(self, key):
+        with self.lock:
+            future = self.results.get(key)
+            owner = future is None
+            if owner:
+                future = self.results[key] = concurrent.futures.Future()
+                self.calls += 1
+            else:
+                self.hits += 1
+        if owner:
+            try:
+                future.set_result(self.fn(key))
+            except Exception as e:
+                with self.lock:
+                    del self.results[key]
+                future.set_exception(e)
+        return future.result()
+
+
+def _strip(response):
+    response = dict(response)
+    response.pop('ResponseMetadata', None)
+    return response
+
+
+class Inspector(object):
+    def __init__(self, c_iot, workers=WORKERS):
+        self.c_iot = c_iot
+        self.workers = workers
+        self.thing_type = Memo(self._thing_type)
+        self.policy = Memo(self._policy)
+        self.seen_policies = set()
+        self.lock = threading.Lock()
+
+    def principal_policies(self, principal):
+        """returns the names of the policies attached to principal"""
+        names = []
+        kwargs = {'principal': principal}
+        while True:
+            response = self.c_iot.list_principal_policies(**kwargs)
+            names.extend(pol['policyName'] for pol in response['policies'])
+            if not response.get('nextMarker'):
+                return names
+            kwargs['marker'] = response['nextMarker']
+
+    def _thing_type(self, thing_type_name):
+        return _strip(self.c_iot.describe_thing_type(thingTypeName=thing_type_name))
+
+    def _policy(self, policy_name):
+        return _strip(self.c_iot.get_policy(policyName=policy_name))
+
+    def inspect(self, thing_name):
+        """returns a dict with the thing, its type, its certificates and the names of their policies"""
+        c_iot = self.c_iot
+        record = {'type': 'thing', 'thingName': thing_name}
+        record['thing'] = _strip(c_iot.describe_thing(thingName=thing_name))
+        if record['thing'].get('thingTypeName'):
+            record['thingType'] = self.thing_type(record['thing']['thingTypeName'])
+        record['principals'] = []
+        for principal in c_iot.list_thing_principals(thingName=thing_name)['principals']:
+            entry = {'principal': principal}
+            if ':cert/' in principal:
+                description = c_iot.describe_certificate(
+                    certificateId=principal.split('/')[-1])['certificateDescription']
+                entry['certificate'] = {
+                    'certificateId': description['certificateId'],
+                    'status': description['status'],
+                    'creationDate': description['creationDate'],
+                    'validity': description.get('validity'),
+                    'certificateMode': description.get('certificateMode')
+                }
+            entry['policies'] = self.principal_policies(principal)
+            record['principals'].append(entry)
+        return record
+
+    def new_policies(self, record):
+        """returns the policy records of record not returned before"""
+        names = []
+        with self.lock:
+            for entry in record['principals']:
+                for name in entry['policies']:
+                    if name not in self.seen_policies:
+                        self.seen_policies.add(name)
+                        names.append(name)
+        policies = []
+        for name in names:
+            try:
+                policies.append(dict({'type': 'policy'}, **self.policy(name)))
+            except Exception as e:
+                # a later thing with this policy tries again
+                with self.lock:
+                    self.seen_policies.discard(name)
+                policies.append({'type': 'policy', 'policyName': name, 'error': str(e)})
+        return policies
+
+    def _inspect_with_policies(self, thing_name):
+        record = self.inspect(thing_name)
+        return record, self.new_policies(record)
+
+    def inspect_all(self, thing_names):
+        """yields the thing records and, once per policy, the policy records
+
+        Failed things are yielded as {'type': 'thing', 'thingName': ...,
+        'error': ...}.
+        """
+        for thing_name, result, error in bounded_map(
+                self._inspect_with_policies, thing_names, self.workers):
+            if error:
+                yield {'type': 'thing', 'thingName': thing_name, 'error': str(error)}
+                continue
+            record, policies = result
+            yield record
+            for policy in policies:
+                yield policy
@@ -0,0 +1,225 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# fleet_search.py
+#
+# concurrent fleet index search
+"""Streaming search_index pagination
+
+Every query string is paged through by its own thread and the things are
+passed through a bounded queue to the consumer as soon as a page arrives,
+so processing starts after the first page and only about queue_size
+things are held in memory no matter how many things match.
+
+    for thing in iter_things(c_iot, ['thingName:bulky*', 'thingName:jitr-*']):
+        print(thing['thingName'])
+
+A single query can be split into disjoint partitions, e.g. by the
+character after a thingName prefix or by the values of an attribute,
+which are then paged through in parallel:
+
+    stats = SearchStats()
+    for thing in iter_things(c_iot, prefix_partitions('bulky'), workers=16, stats=stats):
+        ...
+    print(stats.line())
+
+With ordered the things are yielded partition by partition in the order
+of the partitions, each partition in the order search_index returns it.
+"""
+
+import collections
+import queue
+import string
+import threading
+import time
+
+MAX_RESULTS = 100
+QUEUE_SIZE = 1000
+WORKERS = 4
+
+# characters after a prefix which get their own partition; names with other
+# characters after the prefix are found by the remainder partition
+PARTITION_CHARS = string.digits + string.ascii_letters
+
+_END = object()
+
+
+def prefix_partitions(prefix='', field='thingName', chars=PARTITION_CHARS, query=None):
+    """returns disjoint queries covering all things whose field starts with prefix
+
+    There is one query per character in chars following the prefix and
+    a remainder query for the value prefix itself and all other
+    characters. With query every partition is restricted to it.
+    """
+    terms = ["{}:{}{}*".format(field, prefix, c) for c in chars]
+    remainder = "{}:{}* AND NOT ({})".format(field, prefix, " OR ".join(terms))
+    return _restrict(terms + [remainder], query)
+
+
+def value_partitions(field, values, query=None):
+    """returns disjoint queries, one per value of field and one for all other things
+
+    values can be taken from fleet_stats buckets of field.
+    """
+    terms = ['{}:"{}"'.format(field, value) for value in values]
+    remainder = "NOT ({})".format(" OR ".join(terms)) if terms else "thingName:*"
+    return _restrict(terms + [remainder], query)
+
+
+def _restrict(partitions, query):
+    if not query:
+        return partitions
+    return ["({}) AND ({})".format(query, partition) for partition in partitions]
+
+
+class SearchStats(object):
+    """throughput of iter_things"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.end = None
+        self.pages = 0
+        self.things = 0
+        self.duplicates = 0
+        self.per_partition = collections.Counter()
+        self.lock = threading.Lock()
+
+    def page(self, query_string, things):
+        with self.lock:
+            self.pages += 1
+            self.per_partition[query_string] += things
+
+    def elapsed(self):
+        return (self.end or time.perf_counter()) - self.start
+
+    def rate(self):
+        elapsed = self.elapsed()
+        return self.things / elapsed if elapsed > 0 else 0.0
+
+    def line(self):
+        busiest = self.per_partition.most_common(1)
+        return ("{} things ({} duplicates) from {} pages of {} partitions in {:.1f} secs., "
+                "{:.1f} things/sec{}".format(
+                    self.things, self.duplicates, self.pages, len(self.per_partition),
+                    self.elapsed(), self.rate(),
+                    ", largest partition {} things".format(busiest[0][1]) if busiest else ""))
+
+
+def search_pages(c_iot, query_string, max_results=MAX_RESULTS, index_name=None):
+    """yields the list of things of every page of a search_index query"""
+    kwargs = {'queryString': query_string, 'maxResults': max_results}
+    if index_name:
+        kwargs['indexName'] = index_name
+    while True:
+        response = c_iot.search_index(**kwargs)
+        yield response['things']
+        if not response.get('nextToken'):
+            return
+        kwargs['nextToken'] = response['nextToken']
+
+
+class _Error(object):
+    def __init__(self, query_string, error):
+        self.query_string = query_string
+        self.error = error
+
+
+def iter_things(c_iot, query_strings, workers=WORKERS, max_results=MAX_RESULTS,
+                queue_size=QUEUE_SIZE, unique=False, ordered=False, index_name=None,
+                stats=None, verbose=False):
+    """yields the things matching any of query_strings while they are searched
+
+    Up to workers query strings (partitions) are paged through
+    concurrently. With unique a thing matching several query strings is
+    yielded once; this keeps the name of every thing yielded, so only
+    ask for it when query strings overlap (the partitions of
+    prefix_partitions and value_partitions are disjoint). With ordered
+    all things of a query string are yielded before the things of the
+    next one; later partitions are searched ahead until their queues are
+    full. An error of a query is raised in the consumer after the things
+    found before it. stats, a SearchStats, collects the throughput.
+    """
+    query_strings = list(dict.fromkeys(query_strings))
+    if ordered:
+        size = max(max_results, queue_size // max(1, len(query_strings)))
+        queues = [queue.Queue(maxsize=size) for _ in query_strings]
+    else:
+        queues = [queue.Queue(maxsize=queue_size)] * len(query_strings)
+    todo = queue.Queue()
+    for index, query_string in enumerate(query_strings):
+        todo.put((index, query_string))
+    stop = threading.Event()
+
+    def put(index, item):
+        while not stop.is_set():
+            try:
+                queues[index].put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def producer():
+        while not stop.is_set():
+            try:
+                index, query_string = todo.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                for n, page in enumerate(search_pages(c_iot, query_string, max_results, index_name)):
+                    if verbose:
+                        print("query_string: {} page {}: {} things".format(query_string, n, len(page)))
+                    if stats:
+                        stats.page(query_string, len(page))
+                    for thing in page:
+                        if not put(index, thing):
+                            return
+            except Exception as e:
+                put(index, _Error(query_string, e))
+                return
+            if ordered:
+                put(index, _END)
+        if not ordered:
+            # all partitions share one queue
+            put(0, _END)
+
+    threads = [threading.Thread(target=producer, daemon=True)
+               for _ in range(min(max(1, workers), len(query_strings)))]
+    for thread in threads:
+        thread.start()
+
+    if ordered:
+        sources = [(q, 1) for q in queues]
+    else:
+        # every producer which took a query string ends with one _END
+        sources = [(queues[0], len(threads))] if threads else []
+
+    seen = set() if unique else None
+    try:
+        for things, running in sources:
+            while running:
+                item = things.get()
+                if item is _END:
+                    running -= 1
+                    continue
+                if isinstance(item, _Error):
+                    raise item.error
+                if unique:
+                    if item['thingName'] in seen:
+                        if stats:
+                            stats.duplicates += 1
+                        continue
+                    seen.add(item['thingName'])
+                if stats:
+                    stats.things += 1
+                yield item
+    finally:
+        stop.set()
+        if stats:
+            stats.end = time.perf_counter()
+
+
+def iter_thing_names(c_iot, query_strings, **kwargs):
+    for thing in iter_things(c_iot, query_strings, **kwargs):
+        yield thing['thingName']
@@ -0,0 +1,157 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# fleet_stats.py
+#
+# server side aggregations of the fleet index
+"""Fleet statistics with the fleet indexing aggregation APIs
+
+Counts, averages, percentiles, cardinalities and buckets are computed by
+AWS IoT in one call each instead of paging through search_index. Several
+aggregations of one query are sent concurrently and every result is
+cached for ttl seconds, optionally in a JSON file so that repeated runs
+of a dashboard script share it.
+"""
+
+import collections
+import json
+import os
+import threading
+import time
+
+from pool import bounded_map
+
+TTL = 60.0
+PERCENTS = [50.0, 90.0, 99.0]
+MAX_BUCKETS = 10
+WORKERS = 8
+
+Aggregation = collections.namedtuple('Aggregation', ['kind', 'field'])
+
+KINDS = ('statistics', 'cardinality', 'percentiles', 'buckets')
+
+# aggregations of the attributes written by fleet-indexing.py
+DEFAULT_AGGREGATIONS = [
+    Aggregation('statistics', 'shadow.reported.temperature'),
+    Aggregation('percentiles', 'shadow.reported.temperature'),
+    Aggregation('cardinality', 'attributes.room_number'),
+    Aggregation('buckets', 'attributes.building')
+]
+
+
+class TTLCache(object):
+    """thread safe cache whose entries expire after ttl seconds
+
+    With path the entries are loaded from and saved to a JSON file.
+    """
+
+    def __init__(self, ttl=TTL, path=None, clock=time.time):
+        self.ttl = ttl
+        self.path = path
+        self.clock = clock
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                self.entries = {}
+
+    @staticmethod
+    def key(*parts):
+        return json.dumps(parts)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or self.clock() - entry[0] > self.ttl:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (self.clock(), value)
+
+    def save(self):
+        if not self.path:
+            return
+        now = self.clock()
+        with self.lock:
+            entries = {k: v for k, v in self.entries.items() if now - v[0] <= self.ttl}
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp, self.path)
+
+
+def aggregate(c_iot, query_string, aggregation, percents=PERCENTS, max_buckets=MAX_BUCKETS,
+              index_name=None):
+    """runs one aggregation, returns the part of the response with the result"""
+    kwargs = {'queryString': query_string, 'aggregationField': aggregation.field}
+    if index_name:
+        kwargs['indexName'] = index_name
+    if aggregation.kind == 'statistics':
+        return c_iot.get_statistics(**kwargs)['statistics']
+    if aggregation.kind == 'cardinality':
+        return c_iot.get_cardinality(**kwargs)['cardinality']
+    if aggregation.kind == 'percentiles':
+        return c_iot.get_percentiles(percents=percents, **kwargs)['percentiles']
+    if aggregation.kind == 'buckets':
+        response = c_iot.get_buckets_aggregation(
+            bucketsAggregationType={'termsAggregation': {'maxBuckets': max_buckets}}, **kwargs)
+        return {'totalCount': response['totalCount'], 'buckets': response['buckets']}
+    raise ValueError("unknown aggregation: {}".format(aggregation.kind))
+
+
+def fleet_stats(c_iot, query_string, aggregations, cache=None, workers=WORKERS,
+                percents=PERCENTS, max_buckets=MAX_BUCKETS, index_name=None):
+    """runs all aggregations of query_string concurrently
+
+    Returns [(aggregation, result, error, cached)] in the order of
+    aggregations. Results are taken from and stored in cache.
+    """
+    results = {}
+    todo = []
+    for aggregation in aggregations:
+        key = TTLCache.key(index_name, query_string, aggregation.kind, aggregation.field,
+                           percents if aggregation.kind == 'percentiles' else None,
+                           max_buckets if aggregation.kind == 'buckets' else None)
+        value = cache.get(key) if cache else None
+        if value is not None:
+            results[aggregation] = (value, None, True)
+        else:
+            todo.append((aggregation, key))
+
+    def run(job):
+        return aggregate(c_iot, query_string, job[0], percents, max_buckets, index_name)
+
+    for (aggregation, key), result, error in bounded_map(run, todo, workers):
+        if error is None and cache:
+            cache.put(key, result)
+        results[aggregation] = (result, error, False)
+    return [(aggregation,) + results[aggregation] for aggregation in aggregations]
+
+
+def _number(value, spec=''):
+    """value formatted with spec, "-" for a missing value"""
+    return '-' if value is None else format(value, spec)
+
+
+def format_result(aggregation, result):
+    if aggregation.kind == 'statistics':
+        return "count {}, avg {}, min {}, max {}, stddev {}".format(
+            _number(result.get('count')), _number(result.get('average'), '.2f'),
+            _number(result.get('minimum')), _number(result.get('maximum')),
+            _number(result.get('stdDeviation'), '.2f'))
+    if aggregation.kind == 'cardinality':
+        return "{} distinct values".format(result)
+    if aggregation.kind == 'percentiles':
+        return ", ".join("p{:g} {}".format(p['percent'], p.get('value')) for p in result)
+    return "{} things: ".format(result['totalCount']) + ", ".join(
+        "{} {}".format(b['keyValue'], b['count']) for b in result['buckets'])
@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# gen-bulk.py
+#
+# creates keys, CSRs and the input file for bulk provisioning
+# using all cores
+"""Create keys, CSRs and bulk provisioning input"""
+
+import sys
+
+from bulk_keygen import main
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,32 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# lambda_source.py
+#
+# values read from the source of the provisioning Lambda
+"""Module level values of the provisioning Lambda
+
+The Lambda's source is parsed, not imported, so its AWS clients and
+other init code do not run in build steps and benchmarks.
+
+    regions = lambda_regions(LAMBDA_FILE)
+"""
+
+import ast
+import os
+
+LAMBDA_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                          '..', 'provisioning', 'lambda'))
+LAMBDA_FILE = os.path.join(LAMBDA_DIR, 'lambda_function.py')
+
+
+def lambda_regions(path=LAMBDA_FILE):
+    """returns the value of the module level regions list of the Lambda"""
+    with open(path) as f:
+        module = ast.parse(f.read(), path)
+    for node in module.body:
+        if isinstance(node, ast.Assign) and any(
+                isinstance(t, ast.Name) and t.id == 'regions' for t in node.targets):
+            return ast.literal_eval(node.value)
+    raise ValueError("no regions in {}".format(path))
@@ -3,18 +3,94 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0.
 
-import boto3
+"""Print a thing with its certificates and policies
+
+With several thing names, a file of thing names (-f) or a fleet index
+query (-q) the things are inspected concurrently and written as JSON
+lines: one line per thing and one line per policy the first time it is
+seen.
+"""
+
+import argparse
+import itertools
 import json
 import sys
+import time
 
-THING_NAME=None
-try:
-    THING_NAME=sys.argv[1]
-except IndexError:
+import boto3
+
+from fleet_inspect import Inspector, WORKERS
+from fleet_search import iter_thing_names
+from ratelimit import NO_RETRY_CONFIG, RateLimiter, ThrottledClient, MAX_RATE, RATE
+
+parser = argparse.ArgumentParser(description='Print things with their certificates and policies')
+parser.add_argument("thing_names", nargs="*", metavar="thing_name", help="names of the things")
+parser.add_argument("-f", "--file", action="store", dest="file",
+                    help="file with one thing name per line, - for stdin")
+parser.add_argument("-q", "--query", action="store", dest="query",
+                    help="inspect the things matching this fleet index query")
+parser.add_argument("-o", "--output", action="store", dest="output",
+                    help="write the JSON lines to this file instead of stdout")
+parser.add_argument("-w", "--workers", action="store", dest="workers", type=int, default=WORKERS,
+                    help="number of things inspected concurrently")
+parser.add_argument("-r", "--rate", action="store", dest="rate", type=float, default=RATE,
+                    help="initial calls/sec per API")
+parser.add_argument("-m", "--max-rate", action="store", dest="max_rate", type=float, default=MAX_RATE,
+                    help="maximum calls/sec per API")
+parser.add_argument("--jsonl", action="store_true", dest="jsonl", default=False,
+                    help="JSON lines output even for one thing")
+args = parser.parse_args()
+
+if not (args.thing_names or args.file or args.query):
     print('usage: {} <thing_name>'.format(sys.argv[0]))
     sys.exit(1)
 
 
+def read_names(path):
+    f = sys.stdin if path == '-' else open(path)
+    with f:
+        for line in f:
+            if line.strip():
+                yield line.strip()
+
+
+def inspect_fleet():
+    limiter = RateLimiter(rate=args.rate, max_rate=args.max_rate)
+    c_iot = ThrottledClient(boto3.client('iot', config=NO_RETRY_CONFIG), limiter)
+    names = iter(args.thing_names)
+    if args.file:
+        names = itertools.chain(names, read_names(args.file))
+    if args.query:
+        names = itertools.chain(names, iter_thing_names(c_iot, [args.query]))
+
+    inspector = Inspector(c_iot, args.workers)
+    out = open(args.output, 'w') if args.output else sys.stdout
+    start = time.perf_counter()
+    things = errors = 0
+    try:
+        for record in inspector.inspect_all(names):
+            if record['type'] == 'thing':
+                things += 1
+                errors += 'error' in record
+            out.write(json.dumps(record, default=str) + '\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    elapsed = time.perf_counter() - start
+    sys.stderr.write("{} things ({} errors) in {:.1f} secs., {:.1f} things/sec\n".format(
+        things, errors, elapsed, things / elapsed if elapsed > 0 else 0.0))
+    sys.stderr.write("calls: {}\n".format(dict(limiter.api_calls)))
+    sys.stderr.write("memoized: describe_thing_type {} calls/{} hits, get_policy {} calls/{} hits\n".format(
+        inspector.thing_type.calls, inspector.thing_type.hits,
+        inspector.policy.calls, inspector.policy.hits))
+    return 1 if errors else 0
+
+
+if args.jsonl or args.file or args.query or len(args.thing_names) > 1:
+    sys.exit(inspect_fleet())
+
+THING_NAME = args.thing_names[0]
+
 c_iot = boto3.client('iot')
 
 def print_response(response):
@@ -23,18 +23,13 @@ fi
 thing_name=$1
 num_things=$2
 
+real_dir=$(dirname $(realpath $0))
+
 date_time=$(date "+%Y-%m-%d_%H-%M-%S")
 
 out_dir=$thing_name-$date_time
 mkdir $out_dir || exit 1
 
 
-for i in $(seq 1 $num_things) ; do
-  openssl req -new -newkey rsa:2048 -nodes -keyout $out_dir/$thing_name$i.key -out $out_dir/$thing_name$i.csr -subj "/C=DE/ST=Berlin/L=Berlin/O=AWS/CN=Big Orchestra"
-
-  one_line_csr=$(awk 'NF {sub(/\r/, ""); printf "%s\\n",$0;}' $out_dir/$thing_name$i.csr)
-
-  echo "{\"ThingName\": \"$thing_name$i\", \"SerialNumber\": \"$i\", \"CSR\": \"$one_line_csr\"}" >> $out_dir/bulk.json
-done
+$real_dir/gen-bulk.py -o $out_dir -f bulk.json -n "Big Orchestra" -q $thing_name $num_things
 
-echo "output written to $out_dir/bulk.json"
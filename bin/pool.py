@@ -0,0 +1,46 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# pool.py
+#
+# bounded thread pool for API calls over large, lazily produced inputs
+"""Bounded concurrent map
+
+bounded_map() consumes its input lazily and keeps at most in_flight calls
+queued in the pool, so a generator over a whole fleet can be processed
+without materializing it.
+"""
+
+import concurrent.futures
+
+WORKERS = 16
+
+
+def bounded_map(fn, items, workers=WORKERS, in_flight=None):
+    """calls fn(item) for every item in a thread pool
+
+    Yields (item, result, error) in completion order; error is the
+    exception raised by fn or None. At most in_flight (default
+    2 * workers) items are submitted and not finished at any time.
+    """
+    in_flight = in_flight or workers * 2
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+
+        def finished(futures):
+            for future in futures:
+                item = pending.pop(future)
+                error = future.exception()
+                yield item, None if error else future.result(), error
+
+        for item in items:
+            if len(pending) >= in_flight:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                yield from finished(done)
+            pending[executor.submit(fn, item)] = item
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            yield from finished(done)
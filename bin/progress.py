@@ -0,0 +1,78 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# progress.py
+#
+# live progress and throughput of long running fleet operations
+"""Progress line with throughput and ETA"""
+
+import sys
+import threading
+import time
+
+
+class Progress(object):
+    """thread safe counter which prints a progress line at most every interval secs
+
+    On a terminal the line is updated in place, otherwise a new line is
+    printed. total may be None when the amount of work is not known yet.
+    """
+
+    def __init__(self, label, total=None, limiter=None, interval=1.0, out=None):
+        self.label = label
+        self.total = total
+        self.limiter = limiter
+        self.interval = interval
+        self.out = out or sys.stderr
+        self.tty = hasattr(self.out, 'isatty') and self.out.isatty()
+        self.done = 0
+        self.failed = 0
+        self.start = time.perf_counter()
+        self.last = 0.0
+        self.lock = threading.Lock()
+
+    def update(self, ok=True, n=1):
+        with self.lock:
+            if ok:
+                self.done += n
+            else:
+                self.failed += n
+            now = time.perf_counter()
+            if now - self.last >= self.interval:
+                self.last = now
+                self._show(now)
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def rate(self):
+        elapsed = self.elapsed()
+        return (self.done + self.failed) / elapsed if elapsed > 0 else 0.0
+
+    def line(self, now=None):
+        elapsed = (now or time.perf_counter()) - self.start
+        count = self.done + self.failed
+        rate = count / elapsed if elapsed > 0 else 0.0
+        text = "{} {}{} done, {} failed, {:.1f}/sec".format(
+            count, self.label, "/{}".format(self.total) if self.total is not None else "",
+            self.failed, rate)
+        if self.total is not None and rate > 0:
+            text += ", eta {:.0f}s".format(max(0, self.total - count) / rate)
+        if self.limiter is not None:
+            text += ", throttled {}x".format(self.limiter.throttles)
+        return text
+
+    def _show(self, now):
+        if self.tty:
+            self.out.write("\r" + self.line(now) + "\033[K")
+        else:
+            self.out.write(self.line(now) + "\n")
+        self.out.flush()
+
+    def close(self):
+        with self.lock:
+            self._show(time.perf_counter())
+            if self.tty:
+                self.out.write("\n")
+            self.out.flush()
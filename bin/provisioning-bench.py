@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# provisioning-bench.py
+#
+# latency of the provisioning Lambda against mocked AWS services
+"""Run the provisioning Lambda's handler in process against moto
+
+Every AWS call is delayed by --latency ms before moto answers it, which
+stands in for the round trip to the service. The script provisions
+--devices signed devices, spread over --regions regions through the
+region-latencies they report, and prints the latency percentiles of the
+invocations and the AWS calls per invocation.
+
+--batch N sends the devices in batch requests of N devices, the shape
+a gateway uses to provision its children.
+
+--cold drops the Lambda's module scope caches (clients, endpoints, policy
+existence, account id, verification key) before each invocation, which
+gives the call pattern of a cold container for every request; --compare
+runs both.
+
+--stub times provision_device alone against a local IoT stub which sleeps
+--latency ms per call and needs no moto: the IoT calls run one after the
+other, as provision_device used to run them, and as its dependency graph.
+
+--check asserts the outcomes of the claim protocol and the batch handler
+against moto instead: of concurrent requests for one device exactly one
+succeeds, stale claims are taken over and fresh ones are not, malformed
+devices of a batch fail alone, and failed or lost claims leave no
+certificate behind. It exits with 1 if a check fails.
+
+Needs moto and cryptography.
+"""
+
+import argparse
+import base64
+import collections
+import concurrent.futures
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import boto3
+from botocore.exceptions import ClientError
+
+LAMBDA_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                          '..', 'provisioning', 'lambda'))
+REGION = "eu-west-2"
+TABLE = "iot-global-provisioning"
+
+
+class Context(object):
+    def __init__(self):
+        self.aws_request_id = str(uuid.uuid4())
+
+
+class CallRecorder(object):
+    """delays and counts the AWS calls of all clients of the default session"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = collections.Counter()
+
+    def __call__(self, model, **kwargs):
+        self.calls["{}.{}".format(model.service_model.service_name, model.name)] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+def signer(directory):
+    """writes the public key file of the Lambda, returns a function signing thing names"""
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    with open(os.path.join(directory, 'global-provisioning.pub.key.pem'), 'wb') as f:
+        f.write(key.public_key().public_bytes(serialization.Encoding.PEM,
+                                              serialization.PublicFormat.SubjectPublicKeyInfo))
+    return lambda name: base64.b64encode(
+        key.sign(name.encode(), padding.PKCS1v15(), hashes.SHA256())).decode()
+
+
+class IoTStub(object):
+    """IoT client whose calls sleep latency secs and return canned responses"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = collections.Counter()
+
+    def _call(self, name, response):
+        self.calls[name] += 1
+        time.sleep(self.latency)
+        return response
+
+    def describe_endpoint(self, **kwargs):
+        return self._call('DescribeEndpoint', {'endpointAddress': 'stub-ats.iot.example.com'})
+
+    def get_policy(self, **kwargs):
+        return self._call('GetPolicy', {'policyName': kwargs['policyName']})
+
+    def create_thing(self, **kwargs):
+        return self._call('CreateThing', {'thingName': kwargs['thingName']})
+
+    def create_keys_and_certificate(self, **kwargs):
+        return self._call('CreateKeysAndCertificate', {
+            'certificateArn': 'arn:aws:iot:stub:000000000000:cert/stub', 'certificateId': 'stub',
+            'certificatePem': 'stub', 'keyPair': {'PrivateKey': 'stub'}})
+
+    def attach_policy(self, **kwargs):
+        return self._call('AttachPolicy', {})
+
+    def attach_thing_principal(self, **kwargs):
+        return self._call('AttachThingPrincipal', {})
+
+
+class InlineExecutor(object):
+    """runs what is submitted right away, in the calling thread"""
+
+    def submit(self, fn, *args):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+def stub_bench(lf, args):
+    """times provision_device against IoTStub, sequential and as dependency graph, cold and warm"""
+    stub = IoTStub(args.latency / 1000.0)
+    graph_executor = lf.iot_executor
+    for label, executor in (("sequential", InlineExecutor()), ("dependency graph", graph_executor)):
+        lf.iot_executor = executor
+        for cold in (True, False):
+            reset_caches(lf)
+            stub.calls.clear()
+            latencies = []
+            for i in range(args.devices):
+                if cold:
+                    reset_caches(lf)
+                lf.iot_clients[REGION] = stub
+                start = time.perf_counter()
+                lf.provision_device("stub-{:05d}".format(i), REGION, None)
+                latencies.append(time.perf_counter() - start)
+            print("{}, {} caches: p50 {:.1f} ms, p99 {:.1f} ms, {:.1f} IoT calls/device, "
+                  "{:.1f} call latencies on the critical path".format(
+                      label, "cold" if cold else "warm", percentile(latencies, 50) * 1000,
+                      percentile(latencies, 99) * 1000, sum(stub.calls.values()) / float(args.devices),
+                      percentile(latencies, 50) / stub.latency))
+    lf.iot_executor = graph_executor
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def events(names, sign, region_names, batch):
+    devices = []
+    for i, name in enumerate(names):
+        fastest = region_names[i % len(region_names)]
+        devices.append({
+            'thing-name': name,
+            'thing-name-sig': sign(name),
+            'region-latencies': dict((r, 0.01 if r == fastest else 0.05) for r in region_names)
+        })
+    for i in range(0, len(devices), batch):
+        source_ip = "10.{}.{}.1".format(i // 250, i % 250)
+        header = {'X-Forwarded-For': "{}, 10.0.0.1".format(source_ip)}
+        body = {'devices': devices[i:i + batch]} if batch > 1 else devices[i]
+        yield {'body-json': body, 'params': {'header': header}, 'context': {'source-ip': source_ip}}
+
+
+def succeeded(answer):
+    """number of devices provisioned by an invocation"""
+    if 'results' in answer:
+        return answer['provisioned']
+    return 1 if answer.get('status') == 'success' else 0
+
+
+def reset_caches(lf):
+    lf.iot_clients.clear()
+    lf.c_dynamo = None
+    lf.account_id = None
+    lf.pub_key = None
+    lf.endpoint_cache.clear()
+    lf.policy_cache.clear()
+    lf.latency_cache.cache.clear()
+
+
+def run(lf, recorder, args, sign, cold, prefix):
+    names = ["{}-{:05d}".format(prefix, i) for i in range(args.devices)]
+    c_dynamo = boto3.client('dynamodb')
+    for name in names:
+        c_dynamo.put_item(TableName=TABLE, Item={'thing_name': {'S': name},
+                                                  'prov_status': {'S': 'unprovisioned'}})
+    region_names = [r["name"] for r in lf.regions][:args.regions]
+
+    recorder.calls.clear()
+    latencies = []
+    failed = 0
+    start = time.perf_counter()
+    for event in events(names, sign, region_names, args.batch):
+        if cold:
+            reset_caches(lf)
+        invocation_start = time.perf_counter()
+        answer = lf.lambda_handler(event, Context())
+        latencies.append(time.perf_counter() - invocation_start)
+        failed += len(event['body-json'].get('devices', [None])) - succeeded(answer)
+    elapsed = time.perf_counter() - start
+    return latencies, collections.Counter(recorder.calls), failed, elapsed
+
+
+def report(label, latencies, calls, failed, devices, elapsed):
+    print("{}: {} invocations, {} devices failed, p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms, "
+          "{:.1f} devices/sec, {:.1f} AWS calls/device".format(
+              label, len(latencies), failed, percentile(latencies, 50) * 1000,
+              percentile(latencies, 90) * 1000, percentile(latencies, 99) * 1000,
+              devices / elapsed, sum(calls.values()) / float(devices)))
+    for api, n in sorted(calls.items()):
+        print("  {:<40} {:6.2f}".format(api, n / float(devices)))
+
+
+class Checks(object):
+    """outcomes of the Lambda's claim protocol and batch handler against moto"""
+
+    def __init__(self, lf, sign):
+        self.lf = lf
+        self.sign = sign
+        self.c_dynamo = boto3.client('dynamodb')
+        self.c_iot = boto3.client('iot', region_name=REGION)
+        self.failed = 0
+
+    def put_device(self, name, **attributes):
+        item = {'thing_name': {'S': name}, 'prov_status': {'S': 'unprovisioned'}}
+        item.update(attributes)
+        self.c_dynamo.put_item(TableName=TABLE, Item=item)
+
+    def status(self, name):
+        item = self.c_dynamo.get_item(TableName=TABLE, Key={'thing_name': {'S': name}})['Item']
+        return item['prov_status']['S']
+
+    def certificates(self):
+        return len(self.c_iot.list_certificates()['certificates'])
+
+    def device(self, name, sig=None):
+        return {'thing-name': name, 'thing-name-sig': sig or self.sign(name),
+                'region-latencies': {REGION: 0.01}}
+
+    def event(self, body):
+        return {'body-json': body, 'params': {'header': {'X-Forwarded-For': "10.99.0.1"}},
+                'context': {'source-ip': "10.99.0.1"}}
+
+    def invoke(self, body):
+        """returns the answer of the handler, or {"exception": ...} if it raised"""
+        try:
+            return self.lf.lambda_handler(self.event(body), Context())
+        except Exception as e:
+            return {'exception': e}
+
+    def expect(self, name, condition, message):
+        if not condition:
+            self.failed += 1
+            print("check {}: FAILED: {}".format(name, message))
+        return condition
+
+    def run(self):
+        for check in (self.concurrent_requests, self.stale_claim, self.fresh_claim,
+                      self.malformed_batch, self.failed_provisioning, self.lost_claim):
+            failed = self.failed
+            check()
+            if self.failed == failed:
+                print("check {}: ok".format(check.__name__))
+        return self.failed == 0
+
+    def concurrent_requests(self, requests=5):
+        name = 'check-concurrent'
+        self.put_device(name)
+        certificates = self.certificates()
+        start = threading.Barrier(requests)
+
+        def request(_):
+            start.wait()
+            return self.invoke(self.device(name))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=requests) as executor:
+            answers = list(executor.map(request, range(requests)))
+        statuses = [a.get('status') for a in answers]
+        self.expect('concurrent_requests', statuses.count('success') == 1,
+                    "{} of {} requests succeeded: {}".format(statuses.count('success'), requests, answers))
+        self.expect('concurrent_requests', self.status(name) == 'provisioned',
+                    "status {}".format(self.status(name)))
+        self.expect('concurrent_requests', self.certificates() == certificates + 1,
+                    "{} certificates created".format(self.certificates() - certificates))
+
+    def stale_claim(self):
+        name = 'check-stale'
+        claimed = int(time.time()) - self.lf.claim_timeout - 10
+        self.put_device(name, prov_status={'S': 'provisioning'}, prov_claimed={'N': str(claimed)},
+                        prov_claim_id={'S': 'died'})
+        answer = self.invoke(self.device(name))
+        self.expect('stale_claim', answer.get('status') == 'success', "answer {}".format(answer))
+        self.expect('stale_claim', self.status(name) == 'provisioned', "status {}".format(self.status(name)))
+
+    def fresh_claim(self):
+        name = 'check-fresh'
+        self.put_device(name, prov_status={'S': 'provisioning'}, prov_claimed={'N': str(int(time.time()))},
+                        prov_claim_id={'S': 'running'})
+        answer = self.invoke(self.device(name))
+        self.expect('fresh_claim', answer.get('message') == 'you not', "answer {}".format(answer))
+        self.expect('fresh_claim', self.status(name) == 'provisioning', "status {}".format(self.status(name)))
+
+    def malformed_batch(self):
+        for name in ('check-batch-1', 'check-batch-2', 'check-batch-nosig', 'check-batch-wrongsig'):
+            self.put_device(name)
+        devices = [
+            self.device('check-batch-1'),
+            "not a device",
+            dict(self.device('check-batch-list'), **{'thing-name': ['check-batch-list']}),
+            {'thing-name': 'check-batch-nosig'},
+            self.device('check-batch-wrongsig', sig=self.sign('another-thing')),
+            self.device('check-batch-1'),
+            dict(self.device('check-batch-2'), **{'region-latencies': [REGION]})
+        ]
+        answer = self.invoke({'devices': devices})
+        if not self.expect('malformed_batch', 'results' in answer, "answer {}".format(answer)):
+            return
+        statuses = [r.get('status') for r in answer['results']]
+        expected = ['success', 'error', 'error', 'error', 'error', 'error', 'success']
+        self.expect('malformed_batch', statuses == expected,
+                    "statuses {}, expected {}: {}".format(statuses, expected, answer['results']))
+        self.expect('malformed_batch', answer.get('provisioned') == 2,
+                    "{} devices provisioned".format(answer.get('provisioned')))
+
+    def _fail_call(self, api, fn):
+        """registers fn before every call of api of the Lambda's IoT client, returns the unregister"""
+        events = self.lf.get_iot_client(REGION).meta.events
+        event_name = 'before-call.iot.{}'.format(api)
+        events.register(event_name, fn)
+        return lambda: events.unregister(event_name, fn)
+
+    def failed_provisioning(self):
+        name = 'check-failed'
+        self.put_device(name)
+        certificates = self.certificates()
+
+        def fail(**kwargs):
+            raise ClientError({'Error': {'Code': 'InternalFailure', 'Message': 'check'}},
+                              'AttachPolicy')
+
+        # moto keeps the policy attachments of a force deleted certificate and then fails
+        # every later delete, so the policy is the call which fails here
+        unregister = self._fail_call('AttachPolicy', fail)
+        try:
+            answer = self.invoke(self.device(name))
+        finally:
+            unregister()
+        self.expect('failed_provisioning', 'exception' in answer, "answer {}".format(answer))
+        self.expect('failed_provisioning', self.status(name) == 'failed',
+                    "status {}".format(self.status(name)))
+        self.expect('failed_provisioning', self.certificates() == certificates,
+                    "{} certificates left behind".format(self.certificates() - certificates))
+
+    def lost_claim(self):
+        name = 'check-lost'
+        self.put_device(name)
+        certificates = self.certificates()
+
+        def take_over(**kwargs):
+            self.c_dynamo.update_item(
+                TableName=TABLE, Key={'thing_name': {'S': name}},
+                UpdateExpression="SET prov_claim_id = :id",
+                ExpressionAttributeValues={':id': {'S': 'another-request'}})
+
+        unregister = self._fail_call('AttachThingPrincipal', take_over)
+        try:
+            answer = self.invoke(self.device(name))
+        finally:
+            unregister()
+        self.expect('lost_claim', answer.get('message') == 'claim lost', "answer {}".format(answer))
+        self.expect('lost_claim', self.certificates() == certificates,
+                    "{} certificates left behind".format(self.certificates() - certificates))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the provisioning Lambda against moto')
+    parser.add_argument("-n", "--devices", action="store", dest="devices", type=int, default=100)
+    parser.add_argument("-l", "--latency", action="store", dest="latency", type=float, default=20,
+                        help="ms added to every AWS call")
+    parser.add_argument("-R", "--regions", action="store", dest="regions", type=int, default=3,
+                        help="number of regions the devices are spread over")
+    parser.add_argument("-b", "--batch", action="store", dest="batch", type=int, default=1,
+                        help="devices per batch request, 1 for single device requests")
+    parser.add_argument("--cold", action="store_true", dest="cold", default=False,
+                        help="drop the module scope caches before every invocation")
+    parser.add_argument("--stub", action="store_true", dest="stub", default=False,
+                        help="only time provision_device against a local stub, sequential and concurrent")
+    parser.add_argument("--compare", action="store_true", dest="compare", default=False,
+                        help="run with cold and with warm caches")
+    parser.add_argument("--check", action="store_true", dest="check", default=False,
+                        help="assert the outcomes of concurrent, stale, malformed and failed requests")
+    args = parser.parse_args(argv)
+
+    for var, value in (('AWS_ACCESS_KEY_ID', 'testing'), ('AWS_SECRET_ACCESS_KEY', 'testing'),
+                       ('AWS_DEFAULT_REGION', REGION)):
+        os.environ[var] = value
+    workdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        shutil.copy(os.path.join(LAMBDA_DIR, 'region_grid.npz'), workdir)
+        sign = signer(workdir)
+        if args.stub:
+            sys.path.insert(0, LAMBDA_DIR)
+            import lambda_function as lf
+            logging.getLogger().setLevel(logging.WARNING)
+            stub_bench(lf, args)
+            return
+
+        from moto import mock_aws
+
+        with mock_aws():
+            boto3.setup_default_session()
+            recorder = CallRecorder(args.latency / 1000.0)
+            boto3.DEFAULT_SESSION.events.register('before-call', recorder)
+            boto3.client('dynamodb').create_table(
+                TableName=TABLE, KeySchema=[{'AttributeName': 'thing_name', 'KeyType': 'HASH'}],
+                AttributeDefinitions=[{'AttributeName': 'thing_name', 'AttributeType': 'S'}],
+                BillingMode='PAY_PER_REQUEST')
+
+            sys.path.insert(0, LAMBDA_DIR)
+            import lambda_function as lf
+            logging.getLogger().setLevel(logging.WARNING)
+
+            if args.check:
+                # the checks provoke errors, which the Lambda logs
+                logging.getLogger().setLevel(logging.CRITICAL)
+                if not Checks(lf, sign).run():
+                    sys.exit(1)
+                return
+
+            modes = [True, False] if args.compare else [args.cold]
+            for cold in modes:
+                latencies, calls, failed, elapsed = run(lf, recorder, args, sign, cold,
+                                                        "bench-cold" if cold else "bench-warm")
+                report("cold caches" if cold else "warm caches", latencies, calls, failed,
+                       args.devices, elapsed)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,169 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# ratelimit.py
+#
+# client side rate limiting for AWS API calls
+"""Adaptive per API token buckets
+
+Every API name gets its own token bucket. A ThrottlingException halves
+the rate of the bucket and the call is retried with exponential backoff;
+every successful call raises the rate a little up to max_rate. This
+keeps a pool of worker threads close to the rate the account allows.
+
+Botocore's own retries are turned off with NO_RETRY_CONFIG, so the
+limiter also retries transient errors (5xx responses, connection errors
+and read timeouts) up to TRANSIENT_RETRIES times, with backoff but
+without lowering the rate.
+
+    limiter = RateLimiter(rate=10, max_rate=50)
+    c_iot = ThrottledClient(boto3.client('iot', config=NO_RETRY_CONFIG), limiter)
+    c_iot.delete_thing(thingName='my-thing')
+"""
+
+import collections
+import functools
+import random
+import threading
+import time
+
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+THROTTLING_ERRORS = (
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded'
+)
+# throttling and transient errors are retried by the rate limiter, not by botocore
+NO_RETRY_CONFIG = Config(retries={'mode': 'standard', 'max_attempts': 1})
+RATE = 10.0
+MAX_RATE = 100.0
+MIN_RATE = 0.5
+RETRIES = 8
+# like the max_attempts of 3 of botocore's standard retry mode
+TRANSIENT_RETRIES = 2
+BACKOFF_BASE = 0.2
+BACKOFF_MAX = 10.0
+
+
+def is_throttling(error):
+    return (isinstance(error, ClientError) and
+            error.response.get('Error', {}).get('Code') in THROTTLING_ERRORS)
+
+
+def is_transient(error):
+    """5xx responses, connection errors and read timeouts"""
+    if isinstance(error, ClientError):
+        return error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500
+    return isinstance(error, (ConnectionError, HTTPClientError))
+
+
+class TokenBucket(object):
+    """token bucket whose rate adapts to throttling (AIMD)"""
+
+    def __init__(self, rate=RATE, max_rate=MAX_RATE, min_rate=MIN_RATE, increase=0.05):
+        self.rate = float(rate)
+        self.max_rate = float(max_rate)
+        self.min_rate = float(min_rate)
+        self.increase = increase
+        self.tokens = 1.0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self._refill(time.monotonic())
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+
+class RateLimiter(object):
+    """token buckets per API name
+
+    rates maps API names to their initial rate, all other APIs start
+    with rate.
+    """
+
+    def __init__(self, rate=RATE, max_rate=MAX_RATE, rates=None, retries=RETRIES):
+        self.rate = rate
+        self.max_rate = max_rate
+        self.rates = rates or {}
+        self.retries = retries
+        self.buckets = {}
+        self.calls = 0
+        self.api_calls = collections.Counter()
+        self.throttles = 0
+        self.lock = threading.Lock()
+
+    def bucket(self, api):
+        with self.lock:
+            if api not in self.buckets:
+                self.buckets[api] = TokenBucket(self.rates.get(api, self.rate), self.max_rate)
+            return self.buckets[api]
+
+    def call(self, api, fn, *args, **kwargs):
+        bucket = self.bucket(api)
+        transient = 0
+        for attempt in range(self.retries + 1):
+            bucket.acquire()
+            try:
+                response = fn(*args, **kwargs)
+            except (ClientError, ConnectionError, HTTPClientError) as e:
+                if attempt == self.retries:
+                    raise
+                if is_throttling(e):
+                    bucket.throttled()
+                    with self.lock:
+                        self.throttles += 1
+                elif is_transient(e) and transient < TRANSIENT_RETRIES:
+                    transient += 1
+                else:
+                    raise
+                backoff = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+                time.sleep(backoff * random.uniform(0.5, 1.0))
+                continue
+            bucket.succeeded()
+            with self.lock:
+                self.calls += 1
+                self.api_calls[api] += 1
+            return response
+
+    def current_rates(self):
+        with self.lock:
+            return {api: round(bucket.rate, 1) for api, bucket in self.buckets.items()}
+
+
+class ThrottledClient(object):
+    """boto3 client wrapper which sends every API call through a RateLimiter"""
+
+    PASSTHROUGH = ('exceptions', 'meta', 'can_paginate', 'get_paginator', 'get_waiter')
+
+    def __init__(self, client, limiter):
+        self.client = client
+        self.limiter = limiter
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name in self.PASSTHROUGH or name.startswith('_') or not callable(attr):
+            return attr
+        return functools.partial(self.limiter.call, name, attr)
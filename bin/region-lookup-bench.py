@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# region-lookup-bench.py
+#
+# benchmark of the nearest region lookup of the provisioning Lambda
+"""Compare the per region great_circle loop with RegionTable and RegionGrid
+
+The loop is the former find_best_region of the Lambda: it parses the
+region table and calls geopy's great_circle once per region, with its
+debug log calls formatted but not emitted. It is skipped when geopy is
+not installed. The region table is read from
+provisioning/lambda/lambda_function.py without importing it.
+"""
+
+import argparse
+import logging
+import sys
+import time
+
+import numpy as np
+
+from lambda_source import LAMBDA_DIR, LAMBDA_FILE, lambda_regions
+
+sys.path.insert(0, LAMBDA_DIR)
+from region_lookup import RegionGrid, RegionTable
+
+logger = logging.getLogger("region-lookup-bench")
+logger.setLevel(logging.INFO)
+
+def loop_lookup(regions, lat, lon, great_circle):
+    min_distance = 40000
+    closest_region = None
+    for r in regions:
+        logger.debug("r: {}".format(r))
+        elat = float(r["lat"])
+        elon = float(r["lon"])
+        logger.debug("elat: {}, elon: {}".format(elat, elon))
+        distance = great_circle((lat, lon), (elat, elon)).km
+        logger.debug("distance: {}".format(distance))
+        if distance <= min_distance:
+            min_distance = distance
+            closest_region = r["name"]
+        logger.debug("min_distance: {}".format(min_distance))
+    return closest_region, min_distance
+
+
+def timed(fn, repeat):
+    """returns the best of repeat runs of fn in seconds"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        secs = time.perf_counter() - start
+        best = secs if best is None else min(best, secs)
+    return best
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the nearest region lookup')
+    parser.add_argument("-n", "--lookups", action="store", dest="lookups", type=int, default=10000,
+                        help="number of random coordinates")
+    parser.add_argument("-r", "--repeat", action="store", dest="repeat", type=int, default=5,
+                        help="runs per method, the best run is reported")
+    parser.add_argument("-s", "--seed", action="store", dest="seed", type=int, default=1)
+    parser.add_argument("-l", "--lambda-file", action="store", dest="lambda_file",
+                        default=LAMBDA_FILE)
+    args = parser.parse_args(argv)
+    regions = lambda_regions(args.lambda_file)
+
+    rng = np.random.default_rng(args.seed)
+    lats = np.degrees(np.arcsin(rng.uniform(-1, 1, args.lookups)))
+    lons = rng.uniform(-180, 180, args.lookups)
+    coords = list(zip(lats.tolist(), lons.tolist()))
+    table = RegionTable(regions)
+
+    results = []
+    try:
+        from geopy.distance import great_circle
+    except ImportError:
+        print("geopy not installed, skipping the great_circle loop")
+    else:
+        secs = timed(lambda: [loop_lookup(regions, lat, lon, great_circle) for lat, lon in coords],
+                     args.repeat)
+        results.append(("great_circle loop", secs))
+        expected = [loop_lookup(regions, lat, lon, great_circle) for lat, lon in coords]
+        names, km = table.nearest_batch(lats, lons)
+        mismatches = sum(1 for (name, dist), n, d in zip(expected, names, km)
+                         if name != n and abs(dist - d) > 1e-6)
+        max_diff = max(abs(dist - d) for (_, dist), d in zip(expected, km))
+        print("check against great_circle: {} different regions, max distance difference {:.2e} km".format(
+            mismatches, max_diff))
+
+    results.append(("RegionTable.nearest", timed(
+        lambda: [table.nearest(lat, lon) for lat, lon in coords], args.repeat)))
+    results.append(("RegionTable.nearest_batch", timed(
+        lambda: table.nearest_batch(lats, lons), args.repeat)))
+    grid = RegionGrid.build(table)
+    results.append(("RegionGrid.nearest", timed(
+        lambda: [grid.nearest(lat, lon) for lat, lon in coords], args.repeat)))
+    results.append(("RegionGrid.nearest_batch", timed(
+        lambda: grid.nearest_batch(lats, lons), args.repeat)))
+
+    base = results[0][1]
+    print("{} lookups, {} regions, best of {} runs".format(args.lookups, len(regions), args.repeat))
+    for name, secs in results:
+        print("  {:<28} {:9.3f} ms total {:9.3f} us/lookup {:8.1f}x".format(
+            name, secs * 1000, secs / args.lookups * 1e6, base / secs))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
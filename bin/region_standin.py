@@ -0,0 +1,122 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# region_standin.py
+#
+# local stand-ins for regional endpoints
+"""TLS listeners with injected handshake delays
+
+StandInEndpoint listens on 127.0.0.1 with a self-signed certificate and
+waits delay seconds after accepting a connection before it answers the
+TLS handshake, so region_probe.RegionProber can be run against regions
+with known latencies. A failed stand-in refuses connections.
+
+    endpoints, context = stand_ins({"eu-west-1": 0.03, "us-east-1": None})
+    RegionProber(endpoints, endpoints=endpoints, ssl_context=context)
+
+The certificate is generated with the cryptography package.
+"""
+
+import datetime
+import os
+import socket
+import ssl
+import tempfile
+import threading
+import time
+
+HOST = "127.0.0.1"
+
+
+def self_signed_context():
+    """returns a server SSLContext with a new self-signed certificate for HOST"""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, HOST)])
+    now = datetime.datetime.utcnow()
+    cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name)
+            .public_key(key.public_key()).serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=1))
+            .sign(key, hashes.SHA256()))
+    with tempfile.TemporaryDirectory() as tmp:
+        cert_file = os.path.join(tmp, "cert.pem")
+        key_file = os.path.join(tmp, "key.pem")
+        with open(cert_file, "wb") as f:
+            f.write(cert.public_bytes(serialization.Encoding.PEM))
+        with open(key_file, "wb") as f:
+            f.write(key.private_bytes(serialization.Encoding.PEM,
+                                      serialization.PrivateFormat.PKCS8,
+                                      serialization.NoEncryption()))
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert_file, key_file)
+    return context
+
+
+def client_context():
+    """client SSLContext which accepts the self-signed stand-in certificates"""
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class StandInEndpoint(object):
+    def __init__(self, delay, server_context):
+        self.delay = delay
+        self.context = server_context
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind((HOST, 0))
+        self.sock.listen(64)
+        self.port = self.sock.getsockname()[1]
+        self.handshakes = 0
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._handshake, args=(conn,), daemon=True).start()
+
+    def _handshake(self, conn):
+        time.sleep(self.delay)
+        try:
+            with self.context.wrap_socket(conn, server_side=True):
+                self.handshakes += 1
+        except (OSError, ssl.SSLError):
+            conn.close()
+
+    def close(self):
+        self.sock.close()
+
+
+def unused_port():
+    """a port nothing listens on"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def stand_ins(delays):
+    """starts a stand-in per region of {region: delay secs, or None for a failing endpoint}
+
+    returns ({region: (host, port)}, client SSLContext, [StandInEndpoint])
+    """
+    server_context = self_signed_context()
+    endpoints = {}
+    servers = []
+    for region, delay in delays.items():
+        if delay is None:
+            endpoints[region] = (HOST, unused_port())
+            continue
+        server = StandInEndpoint(delay, server_context)
+        servers.append(server)
+        endpoints[region] = (HOST, server.port)
+    return endpoints, client_context(), servers
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# registry-snapshot.py
+#
+# local SQLite snapshot of the thing registry
+"""Refresh and query a local snapshot of the thing registry
+
+    registry-snapshot.py                        # refresh changed things
+    registry-snapshot.py --no-refresh --report things-without-policy
+    registry-snapshot.py --no-refresh --sql "SELECT * FROM certificate LIMIT 10"
+"""
+
+import argparse
+import sys
+import time
+
+import boto3
+
+from fleet_inspect import WORKERS
+from progress import Progress
+from ratelimit import NO_RETRY_CONFIG, RateLimiter, ThrottledClient, MAX_RATE, RATE
+from registry_snapshot import REPORTS, SNAPSHOT_FILE, RegistrySnapshot
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Local snapshot of the thing registry')
+    parser.add_argument("-d", "--db", action="store", dest="db", default=SNAPSHOT_FILE,
+                        help="SQLite file of the snapshot")
+    parser.add_argument("--full", action="store_true", dest="full", default=False,
+                        help="inspect all things, not only those whose version changed")
+    parser.add_argument("--no-refresh", action="store_false", dest="refresh", default=True,
+                        help="only query the snapshot")
+    parser.add_argument("-t", "--thing-type", action="store", dest="thing_type",
+                        help="only refresh things of this type")
+    parser.add_argument("--report", action="store", dest="report", choices=sorted(REPORTS),
+                        help="print a predefined report")
+    parser.add_argument("--sql", action="store", dest="sql", help="print the result of a SQL query")
+    parser.add_argument("-w", "--workers", action="store", dest="workers", type=int, default=WORKERS,
+                        help="number of things inspected concurrently")
+    parser.add_argument("-r", "--rate", action="store", dest="rate", type=float, default=RATE,
+                        help="initial calls/sec per API")
+    parser.add_argument("-m", "--max-rate", action="store", dest="max_rate", type=float,
+                        default=MAX_RATE, help="maximum calls/sec per API")
+    args = parser.parse_args(argv)
+
+    snapshot = RegistrySnapshot(args.db)
+    if args.refresh:
+        limiter = RateLimiter(rate=args.rate, max_rate=args.max_rate)
+        c_iot = ThrottledClient(boto3.client('iot', config=NO_RETRY_CONFIG), limiter)
+        progress = Progress("things inspected", limiter=limiter)
+        try:
+            stats = snapshot.refresh(c_iot, full=args.full, workers=args.workers,
+                                     thing_type=args.thing_type, progress=progress)
+        finally:
+            progress.close()
+        print("{}, {} calls: {}".format(stats.line(), limiter.calls, dict(limiter.api_calls)))
+
+    for sql in ([REPORTS[args.report]] if args.report else []) + ([args.sql] if args.sql else []):
+        start = time.perf_counter()
+        columns, rows = snapshot.query(sql)
+        if columns:
+            print("\t".join(columns))
+        for row in rows:
+            print("\t".join("" if value is None else str(value) for value in row))
+        print("{} rows in {:.3f} secs.".format(len(rows), time.perf_counter() - start),
+              file=sys.stderr)
+    snapshot.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
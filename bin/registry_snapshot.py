@@ -0,0 +1,270 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# registry_snapshot.py
+#
+# local SQLite copy of the thing registry
+"""Indexed local snapshot of things, principals, certificates and policies
+
+refresh() pages through list_things, which returns the version of every
+thing, and inspects only the things which are new or whose version
+changed with fleet_inspect.Inspector; things which no longer exist are
+removed. Policy documents do not change the version of any thing, so
+every refresh lists all policies, fetches each of them once (through
+the Inspector's memo, shared with the inspected things) and removes the
+policies which no longer exist.
+
+Attaching or detaching a certificate does not change the version of a
+thing either, so refresh(full=True) re-inspects every thing; run it now
+and then to pick up such attachment changes.
+"""
+
+import json
+import sqlite3
+import time
+
+from fleet_inspect import Inspector, WORKERS
+from pool import bounded_map
+
+SNAPSHOT_FILE = "registry.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS thing (
+    thing_name TEXT PRIMARY KEY,
+    thing_arn TEXT,
+    thing_type TEXT,
+    version INTEGER,
+    attributes TEXT,
+    refreshed REAL
+);
+CREATE TABLE IF NOT EXISTS thing_principal (
+    thing_name TEXT NOT NULL,
+    principal TEXT NOT NULL,
+    PRIMARY KEY (thing_name, principal)
+);
+CREATE INDEX IF NOT EXISTS thing_principal_principal ON thing_principal (principal);
+CREATE TABLE IF NOT EXISTS certificate (
+    principal TEXT PRIMARY KEY,
+    certificate_id TEXT,
+    status TEXT,
+    creation_date TEXT,
+    not_before TEXT,
+    not_after TEXT,
+    certificate_mode TEXT
+);
+CREATE INDEX IF NOT EXISTS certificate_not_after ON certificate (not_after);
+CREATE TABLE IF NOT EXISTS principal_policy (
+    principal TEXT NOT NULL,
+    policy_name TEXT NOT NULL,
+    PRIMARY KEY (principal, policy_name)
+);
+CREATE INDEX IF NOT EXISTS principal_policy_policy ON principal_policy (policy_name);
+CREATE TABLE IF NOT EXISTS policy (
+    policy_name TEXT PRIMARY KEY,
+    policy_arn TEXT,
+    default_version_id TEXT,
+    document TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+REPORTS = {
+    'things-without-policy': """
+        SELECT t.thing_name FROM thing t
+        WHERE NOT EXISTS (
+            SELECT 1 FROM thing_principal tp JOIN principal_policy pp USING (principal)
+            WHERE tp.thing_name = t.thing_name)
+        ORDER BY t.thing_name""",
+    'things-without-certificate': """
+        SELECT t.thing_name FROM thing t
+        WHERE NOT EXISTS (SELECT 1 FROM thing_principal tp WHERE tp.thing_name = t.thing_name)
+        ORDER BY t.thing_name""",
+    'shared-certificates': """
+        SELECT principal, COUNT(*) AS things, GROUP_CONCAT(thing_name) AS thing_names
+        FROM thing_principal GROUP BY principal HAVING COUNT(*) > 1
+        ORDER BY things DESC""",
+    'policy-usage': """
+        SELECT p.policy_name, COUNT(DISTINCT pp.principal) AS principals,
+               COUNT(DISTINCT tp.thing_name) AS things
+        FROM policy p
+        LEFT JOIN principal_policy pp USING (policy_name)
+        LEFT JOIN thing_principal tp USING (principal)
+        GROUP BY p.policy_name ORDER BY things DESC""",
+    'inactive-certificates': """
+        SELECT tp.thing_name, c.certificate_id, c.status FROM certificate c
+        JOIN thing_principal tp USING (principal)
+        WHERE c.status != 'ACTIVE' ORDER BY tp.thing_name"""
+}
+
+
+class RefreshStats(object):
+    def __init__(self):
+        self.listed = 0
+        self.changed = 0
+        self.removed = 0
+        self.policies = 0
+        self.errors = 0
+        self.start = time.perf_counter()
+        self.elapsed = 0.0
+
+    def line(self):
+        return ("{} things listed, {} inspected, {} removed, {} policies, "
+                "{} errors in {:.1f} secs.".format(
+                    self.listed, self.changed, self.removed, self.policies, self.errors,
+                    self.elapsed))
+
+
+class RegistrySnapshot(object):
+    def __init__(self, path=SNAPSHOT_FILE):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def versions(self):
+        return dict(self.db.execute("SELECT thing_name, version FROM thing"))
+
+    def list_things(self, c_iot, thing_type=None):
+        """yields (thing_name, version) of all things in the registry"""
+        kwargs = {'maxResults': 250}
+        if thing_type:
+            kwargs['thingTypeName'] = thing_type
+        while True:
+            response = c_iot.list_things(**kwargs)
+            for thing in response['things']:
+                yield thing['thingName'], thing.get('version')
+            if not response.get('nextToken'):
+                return
+            kwargs['nextToken'] = response['nextToken']
+
+    def list_policies(self, c_iot):
+        """yields the names of all policies"""
+        kwargs = {'pageSize': 250}
+        while True:
+            response = c_iot.list_policies(**kwargs)
+            for policy in response['policies']:
+                yield policy['policyName']
+            if not response.get('nextMarker'):
+                return
+            kwargs['marker'] = response['nextMarker']
+
+    def refresh(self, c_iot, full=False, workers=WORKERS, thing_type=None, progress=None):
+        """brings the snapshot up to date, returns RefreshStats"""
+        stats = RefreshStats()
+        known = self.versions()
+        listed = set()
+        changed = []
+        for thing_name, version in self.list_things(c_iot, thing_type):
+            listed.add(thing_name)
+            if full or known.get(thing_name, -1) != version:
+                changed.append(thing_name)
+        stats.listed = len(listed)
+
+        inspector = Inspector(c_iot, workers)
+        for record in inspector.inspect_all(changed):
+            if record['type'] == 'policy':
+                self._store_policy(record)
+                continue
+            if 'error' in record:
+                stats.errors += 1
+            else:
+                self._store_thing(record)
+                stats.changed += 1
+            if progress:
+                progress.update('error' not in record)
+        self._refresh_policies(c_iot, inspector, workers, stats)
+
+        if thing_type is None:
+            removed = [name for name in known if name not in listed]
+            with self.db:
+                for thing_name in removed:
+                    self._delete_thing(thing_name)
+            stats.removed = len(removed)
+
+        with self.db:
+            self._delete_orphans()
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('refreshed', ?)",
+                            (str(time.time()),))
+        stats.elapsed = time.perf_counter() - stats.start
+        return stats
+
+    def _refresh_policies(self, c_iot, inspector, workers, stats):
+        """stores the policies the inspected things did not refer to, drops deleted ones"""
+        policy_names = list(self.list_policies(c_iot))
+        stats.policies = len(policy_names)
+        todo = [name for name in policy_names if name not in inspector.seen_policies]
+        for policy_name, policy, error in bounded_map(inspector.policy, todo, workers):
+            if error:
+                stats.errors += 1
+            else:
+                self._store_policy(dict({'type': 'policy'}, **policy))
+        with self.db:
+            self.db.execute("CREATE TEMP TABLE IF NOT EXISTS listed_policy "
+                            "(policy_name TEXT PRIMARY KEY)")
+            self.db.execute("DELETE FROM listed_policy")
+            self.db.executemany("INSERT OR IGNORE INTO listed_policy VALUES (?)",
+                                [(name,) for name in policy_names])
+            self.db.execute("DELETE FROM policy WHERE policy_name NOT IN "
+                            "(SELECT policy_name FROM listed_policy)")
+
+    def _delete_thing(self, thing_name):
+        self.db.execute("DELETE FROM thing WHERE thing_name = ?", (thing_name,))
+        self.db.execute("DELETE FROM thing_principal WHERE thing_name = ?", (thing_name,))
+
+    def _delete_orphans(self):
+        """removes certificates and policy attachments no thing refers to any more"""
+        self.db.execute("DELETE FROM certificate WHERE principal NOT IN "
+                        "(SELECT principal FROM thing_principal)")
+        self.db.execute("DELETE FROM principal_policy WHERE principal NOT IN "
+                        "(SELECT principal FROM thing_principal)")
+
+    def _store_thing(self, record):
+        thing = record['thing']
+        with self.db:
+            self._delete_thing(record['thingName'])
+            self.db.execute(
+                "INSERT INTO thing VALUES (?, ?, ?, ?, ?, ?)",
+                (record['thingName'], thing.get('thingArn'), thing.get('thingTypeName'),
+                 thing.get('version'), json.dumps(thing.get('attributes', {})), time.time()))
+            for entry in record['principals']:
+                principal = entry['principal']
+                self.db.execute("INSERT OR IGNORE INTO thing_principal VALUES (?, ?)",
+                                (record['thingName'], principal))
+                certificate = entry.get('certificate')
+                if certificate:
+                    validity = certificate.get('validity') or {}
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO certificate VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (principal, certificate['certificateId'], certificate['status'],
+                         str(certificate['creationDate']), _str(validity.get('notBefore')),
+                         _str(validity.get('notAfter')), certificate.get('certificateMode')))
+                self.db.execute("DELETE FROM principal_policy WHERE principal = ?", (principal,))
+                self.db.executemany("INSERT INTO principal_policy VALUES (?, ?)",
+                                    [(principal, name) for name in entry['policies']])
+
+    def _store_policy(self, record):
+        if 'error' in record:
+            return
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO policy VALUES (?, ?, ?, ?)",
+                            (record['policyName'], record.get('policyArn'),
+                             record.get('defaultVersionId'), record.get('policyDocument')))
+
+    def query(self, sql, params=()):
+        """returns (column names, rows) of a SQL query"""
+        cursor = self.db.execute(sql, params)
+        return [c[0] for c in cursor.description or ()], cursor.fetchall()
+
+    def report(self, name):
+        return self.query(REPORTS[name])
+
+    def close(self):
+        self.db.close()
+
+
+def _str(value):
+    return None if value is None else str(value)
@@ -0,0 +1,132 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# s3_stream.py
+#
+# file like writer which streams into an S3 multipart upload
+"""Streaming S3 multipart upload
+
+S3MultipartWriter buffers written data and uploads every full part from
+a small thread pool while the caller keeps writing. The number of parts
+in flight is bounded, so memory use is about (workers * 2 + 1) * part
+size. close() uploads the last part and completes the upload, abort()
+discards it.
+
+upload_secs is the time of all part uploads summed over the workers;
+busy_secs() the wall clock time during which at least one part was
+uploading, without the idle time between parts.
+"""
+
+import concurrent.futures
+import io
+import threading
+import time
+
+MIN_PART_SIZE = 5 * 1024 * 1024
+PART_SIZE = 8 * 1024 * 1024
+WORKERS = 4
+
+
+class S3MultipartWriter(object):
+    def __init__(self, c_s3, bucket, key, part_size=PART_SIZE, workers=WORKERS):
+        if part_size < MIN_PART_SIZE:
+            raise ValueError("part_size must be at least {} bytes".format(MIN_PART_SIZE))
+        self.c_s3 = c_s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.upload_id = c_s3.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+        self.buffer = io.BytesIO()
+        self.futures = []
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.in_flight = threading.BoundedSemaphore(workers * 2)
+        self.lock = threading.Lock()
+        self.size = 0
+        self.upload_secs = 0.0
+        self.part_times = []
+        self.closed = False
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.buffer.write(data)
+        self.size += len(data)
+        if self.buffer.tell() >= self.part_size:
+            self._flush()
+
+    def _flush(self):
+        body = self.buffer.getvalue()
+        self.buffer = io.BytesIO()
+        self.in_flight.acquire()
+        future = self.executor.submit(self._upload_part, len(self.futures) + 1, body)
+        future.add_done_callback(lambda _: self.in_flight.release())
+        self.futures.append(future)
+
+    def _upload_part(self, part_number, body):
+        start = time.perf_counter()
+        response = self.c_s3.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            PartNumber=part_number,
+            UploadId=self.upload_id,
+            Body=body
+        )
+        end = time.perf_counter()
+        with self.lock:
+            self.upload_secs += end - start
+            self.part_times.append((start, end))
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    def busy_secs(self, until=None):
+        """length of the union of the part upload intervals, up to until if given"""
+        with self.lock:
+            intervals = sorted(self.part_times)
+        busy = 0.0
+        covered = None
+        for start, end in intervals:
+            if until is not None:
+                end = min(end, until)
+            if covered is not None:
+                start = max(start, covered)
+            if end > start:
+                busy += end - start
+                covered = end
+        return busy
+
+    def close(self):
+        """uploads the remaining data and completes the upload"""
+        if self.closed:
+            return
+        try:
+            if self.buffer.tell() or not self.futures:
+                self._flush()
+            parts = [future.result() for future in self.futures]
+            self.c_s3.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self.executor.shutdown()
+        self.closed = True
+
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.executor.shutdown()
+        self.c_s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
@@ -0,0 +1,161 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# shadow_mqtt.py
+#
+# bulk shadow updates over persistent MQTT connections
+"""Pipelined shadow updates over MQTT
+
+MqttShadowWriter publishes shadow documents with QoS 1 to
+$aws/things/<thing>/shadow/update over one or a few already connected
+MQTT clients and does not wait for the response before it publishes the
+next one. Every document carries a clientToken; the responses on
+update/accepted and update/rejected are matched by that token. Up to
+in_flight updates may be unanswered at any time, updates which get no
+response within timeout count as failed.
+
+Only the first connection subscribes to the wildcard response topics
+and receives the responses to the updates of all connections, so each
+response is delivered once; additional connections add publish capacity
+(AWS IoT allows 100 publishes/sec per connection) without multiplying
+the inbound traffic.
+
+The clients are AWSIoTPythonSDK AWSIoTMQTTClient instances or anything
+with the same subscribe() and publishAsync() methods, e.g. the clients
+of shadow_standin.LocalBroker.
+"""
+
+import itertools
+import json
+import threading
+import time
+import uuid
+
+from ratelimit import TokenBucket
+
+UPDATE_TOPIC = "$aws/things/{}/shadow/update"
+ACCEPTED_TOPIC = "$aws/things/+/shadow/update/accepted"
+REJECTED_TOPIC = "$aws/things/+/shadow/update/rejected"
+IN_FLIGHT = 200
+TIMEOUT = 30.0
+# publishes/sec per connection allowed by AWS IoT
+CONNECTION_RATE = 100.0
+
+
+def connect_clients(endpoint, root_ca, key, cert, client_id, connections=1, port=8883):
+    """returns connections connected AWSIoTMQTTClient instances"""
+    from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
+
+    clients = []
+    for i in range(connections):
+        client = AWSIoTMQTTClient("{}-{}".format(client_id, i))
+        client.configureEndpoint(endpoint, port)
+        client.configureCredentials(root_ca, key, cert)
+        client.configureAutoReconnectBackoffTime(1, 32, 20)
+        client.configureOfflinePublishQueueing(-1)
+        client.configureDrainingFrequency(10)
+        client.configureConnectDisconnectTimeout(10)
+        client.configureMQTTOperationTimeout(5)
+        client.connect()
+        clients.append(client)
+    return clients
+
+
+class MqttShadowWriter(object):
+    def __init__(self, clients, in_flight=IN_FLIGHT, timeout=TIMEOUT,
+                 connection_rate=CONNECTION_RATE, on_result=None):
+        self.clients = clients
+        self.buckets = [TokenBucket(connection_rate, connection_rate) for _ in clients]
+        self.next_client = itertools.cycle(range(len(clients)))
+        self.timeout = timeout
+        self.on_result = on_result
+        self.slots = threading.BoundedSemaphore(in_flight)
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.accepted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.errors = []
+        self.start = None
+        self.end = None
+        clients[0].subscribe(ACCEPTED_TOPIC, 1, self._on_response)
+        clients[0].subscribe(REJECTED_TOPIC, 1, self._on_response)
+
+    def update(self, thing_name, document):
+        """publishes a shadow document, returns once it is sent
+
+        A failed publish is counted and reported to on_result like a
+        rejected update; it is not raised.
+        """
+        while not self.slots.acquire(timeout=1.0):
+            self.expire()
+        token = uuid.uuid4().hex
+        payload = json.dumps(dict(document, clientToken=token))
+        with self.lock:
+            if self.start is None:
+                self.start = time.perf_counter()
+            self.pending[token] = (thing_name, time.perf_counter())
+            index = next(self.next_client)
+        self.buckets[index].acquire()
+        try:
+            self.clients[index].publishAsync(UPDATE_TOPIC.format(thing_name), payload, 1)
+        except Exception as e:
+            self._finish(token, False, str(e))
+
+    def _on_response(self, client, userdata, message):
+        try:
+            payload = json.loads(message.payload)
+        except ValueError:
+            return
+        token = payload.get('clientToken')
+        if message.topic.endswith('/accepted'):
+            self._finish(token, True)
+        else:
+            self._finish(token, False, "{} {}".format(payload.get('code'), payload.get('message')))
+
+    def _finish(self, token, accepted, error=None):
+        with self.lock:
+            entry = self.pending.pop(token, None)
+            if entry is None:
+                # response to an update of another writer or a duplicate
+                return
+            if accepted:
+                self.accepted += 1
+            elif error == 'timeout':
+                self.timed_out += 1
+            else:
+                self.rejected += 1
+            if error:
+                self.errors.append((entry[0], error))
+            self.end = time.perf_counter()
+        self.slots.release()
+        if self.on_result:
+            self.on_result(entry[0], accepted, error)
+
+    def expire(self):
+        """fails updates without response for longer than timeout"""
+        now = time.perf_counter()
+        with self.lock:
+            expired = [token for token, (_, sent) in self.pending.items()
+                       if now - sent > self.timeout]
+        for token in expired:
+            self._finish(token, False, 'timeout')
+
+    def flush(self):
+        """waits until every update was answered or timed out"""
+        while True:
+            with self.lock:
+                if not self.pending:
+                    return
+            self.expire()
+            time.sleep(0.05)
+
+    def elapsed(self):
+        if self.start is None:
+            return 0.0
+        return (self.end or time.perf_counter()) - self.start
+
+    def rate(self):
+        elapsed = self.elapsed()
+        return self.accepted / elapsed if elapsed > 0 else 0.0
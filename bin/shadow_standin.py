@@ -0,0 +1,159 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# shadow_standin.py
+#
+# local stand-in for the AWS IoT MQTT broker and its shadow service
+"""Local MQTT broker stand-in
+
+LocalBroker keeps shadows in memory and answers publishes to
+$aws/things/<thing>/shadow/update on update/accepted or update/rejected
+like AWS IoT does, including the clientToken and the version check. Its
+clients implement the subset of AWSIoTMQTTClient used by
+shadow_mqtt.MqttShadowWriter, so the MQTT transport can be run and
+measured without an AWS account.
+
+    broker = LocalBroker(latency=0.02)
+    clients = [broker.client("fleet-{}".format(i)) for i in range(2)]
+"""
+
+import json
+import queue
+import threading
+import time
+
+SHADOW_TOPIC_PREFIX = "$aws/things/"
+
+
+class Message(object):
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+def topic_matches(topic_filter, topic):
+    filter_levels = topic_filter.split('/')
+    levels = topic.split('/')
+    for i, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if i >= len(levels) or (level != '+' and level != levels[i]):
+            return False
+    return len(filter_levels) == len(levels)
+
+
+class LocalBroker(object):
+    """in memory broker with the shadow update topics
+
+    latency is the delay between a publish and its response; messages are
+    handled by workers threads, so many publishes are processed at once.
+    """
+
+    def __init__(self, latency=0.02, workers=8):
+        self.latency = latency
+        self.shadows = {}
+        self.subscriptions = []
+        self.lock = threading.Lock()
+        self.inbox = queue.Queue()
+        self.published = 0
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def client(self, client_id):
+        return StandInClient(self, client_id)
+
+    def subscribe(self, client, topic_filter, callback):
+        with self.lock:
+            self.subscriptions.append((client, topic_filter, callback))
+
+    def publish(self, topic, payload):
+        with self.lock:
+            self.published += 1
+        self.inbox.put((time.monotonic() + self.latency, topic, payload))
+
+    def _work(self):
+        while True:
+            due, topic, payload = self.inbox.get()
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._handle(topic, payload)
+
+    def _handle(self, topic, payload):
+        levels = topic.split('/')
+        if not (topic.startswith(SHADOW_TOPIC_PREFIX) and levels[3:] == ['shadow', 'update']):
+            self._deliver(topic, payload)
+            return
+        thing_name = levels[2]
+        response_topic = topic + '/{}'
+        try:
+            request = json.loads(payload)
+            if not isinstance(request.get('state'), dict):
+                raise ValueError("missing state")
+        except ValueError as e:
+            self._deliver(response_topic.format('rejected'), json.dumps(
+                {'code': 400, 'message': "Payload contains invalid json: {}".format(e)}))
+            return
+
+        token = request.get('clientToken')
+        with self.lock:
+            shadow = self.shadows.setdefault(thing_name, {'state': {}, 'version': 0})
+            if 'version' in request and request['version'] != shadow['version']:
+                response = response_topic.format('rejected'), {
+                    'code': 409, 'message': "Version conflict", 'clientToken': token}
+            else:
+                for section, values in request['state'].items():
+                    shadow['state'].setdefault(section, {}).update(values or {})
+                shadow['version'] += 1
+                response = response_topic.format('accepted'), {
+                    'state': request['state'],
+                    'version': shadow['version'],
+                    'timestamp': int(time.time()),
+                    'clientToken': token
+                }
+        if token is None:
+            response[1].pop('clientToken')
+        self._deliver(response[0], json.dumps(response[1]))
+
+    def _deliver(self, topic, payload):
+        with self.lock:
+            targets = [(client, callback) for client, topic_filter, callback in self.subscriptions
+                       if client.connected and topic_matches(topic_filter, topic)]
+        message = Message(topic, payload.encode('utf-8'))
+        for client, callback in targets:
+            callback(client, None, message)
+
+
+class StandInClient(object):
+    """the part of AWSIoTMQTTClient used for shadow updates"""
+
+    def __init__(self, broker, client_id):
+        self.broker = broker
+        self.client_id = client_id
+        self.connected = False
+
+    def connect(self, keepAliveIntervalSecond=600):
+        self.connected = True
+        return True
+
+    def disconnect(self):
+        self.connected = False
+        return True
+
+    def subscribe(self, topic, QoS, callback):
+        self.connect()
+        self.broker.subscribe(self, topic, callback)
+        return True
+
+    def publishAsync(self, topic, payload, QoS, ackCallback=None):
+        if not self.connected:
+            raise RuntimeError("{} is not connected".format(self.client_id))
+        self.broker.publish(topic, payload)
+        if ackCallback:
+            ackCallback(0)
+        return 0
+
+    def publish(self, topic, payload, QoS):
+        self.publishAsync(topic, payload, QoS)
+        return True
@@ -0,0 +1,73 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# stages.py
+#
+# wall clock timings for the stages of a provisioning run
+"""Per-stage timings based on a monotonic high resolution clock"""
+
+import collections
+import contextlib
+import sys
+import time
+
+
+class StageTimer(object):
+    """Collects the duration of named stages
+
+    Durations are measured with time.perf_counter() so sub-second stages
+    are reported accurately. Running a stage with the same name several
+    times adds up its durations. Nested stages break down the time of
+    another stage and are not part of total().
+    """
+
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.counts = {}
+        self.nested = set()
+
+    @contextlib.contextmanager
+    def stage(self, name, count=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, count)
+
+    def add(self, name, secs, count=None, nested=False):
+        self.stages[name] = self.stages.get(name, 0.0) + secs
+        if nested:
+            self.nested.add(name)
+        if count is not None:
+            self.counts[name] = self.counts.get(name, 0) + count
+
+    def set_count(self, name, count):
+        self.counts[name] = count
+
+    def total(self):
+        return sum(secs for name, secs in self.stages.items() if name not in self.nested)
+
+    def as_dict(self):
+        result = collections.OrderedDict()
+        for name, secs in self.stages.items():
+            entry = {"secs": round(secs, 6)}
+            if name in self.nested:
+                entry["nested"] = True
+            count = self.counts.get(name)
+            if count is not None:
+                entry["count"] = count
+                entry["per_sec"] = round(count / secs, 3) if secs > 0 else None
+            result[name] = entry
+        return result
+
+    def report(self, out=None):
+        out = out or sys.stdout
+        for name, secs in self.stages.items():
+            indent = "  " if name in self.nested else ""
+            count = self.counts.get(name)
+            if count is not None and secs > 0:
+                print("{}time for {}: {:.3f} secs. ({} items, {:.1f}/sec)".format(
+                    indent, name, secs, count, count / secs), file=out)
+            else:
+                print("{}time for {}: {:.3f} secs.".format(indent, name, secs), file=out)
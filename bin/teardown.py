@@ -0,0 +1,253 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# teardown.py
+#
+# concurrent deletion of things, certificates, policies and thing groups
+"""Teardown engine for clean-up.py
+
+Things are deleted from a thread pool. Every thread runs the chain
+list_thing_principals, detach_thing_principal, update_certificate,
+list_principal_policies, detach_policy, delete_certificate and
+delete_thing for one thing. The IoT client is expected to be a
+ratelimit.ThrottledClient so the pool backs off on throttling instead of
+sleeping a fixed time after every thing.
+
+run_plan() executes a teardown_plan.TeardownPlan instead: the principals
+are already known, a certificate shared by several things is deleted
+once after the last thing was detached and every policy is handled once.
+With a teardown_journal.TeardownJournal every finished step is recorded,
+so an interrupted run can be resumed with plan.pending(journal).
+"""
+
+import threading
+
+from pool import bounded_map
+
+WORKERS = 16
+
+
+class Teardown(object):
+    def __init__(self, c_iot, workers=WORKERS, progress=None, verbose=False, journal=None):
+        self.c_iot = c_iot
+        self.workers = workers
+        self.progress = progress
+        self.verbose = verbose
+        self.journal = journal
+        # ordered set of the policies found on the certificates
+        self.policy_names = {}
+        self.failed = []
+        self.lock = threading.Lock()
+        self.plan = None
+        self.remaining = {}
+
+    def log(self, msg):
+        if self.verbose:
+            print(msg)
+
+    def mark_done(self, kind, name):
+        if self.journal:
+            self.journal.mark_done(kind, name)
+
+    def mark_failed(self, kind, name, error):
+        if self.journal:
+            self.journal.mark_failed(kind, name, error)
+
+    def delete_thing(self, thing_name):
+        """deletes a thing in AWS IoT Core with its certificates"""
+        c_iot = self.c_iot
+        self.log("  DELETING thing_name: {}".format(thing_name))
+
+        try:
+            r_principals = c_iot.list_thing_principals(thingName=thing_name)
+        except Exception as list_thing_principals_error:
+            print("ERROR listing thing principals of {}: {}".format(thing_name, list_thing_principals_error))
+            r_principals = {'principals': []}
+
+        for arn in r_principals['principals']:
+            cert_id = arn.split('/')[1]
+            self.log("  arn: {} cert_id: {}".format(arn, cert_id))
+
+            r_detach_thing = c_iot.detach_thing_principal(thingName=thing_name, principal=arn)
+            self.log("  DETACH THING: {}".format(r_detach_thing))
+
+            r_upd_cert = c_iot.update_certificate(certificateId=cert_id, newStatus='INACTIVE')
+            self.log("  INACTIVE: {}".format(r_upd_cert))
+
+            r_policies = c_iot.list_principal_policies(principal=arn)
+
+            for pol in r_policies['policies']:
+                pol_name = pol['policyName']
+                self.log("    pol_name: {}".format(pol_name))
+                with self.lock:
+                    self.policy_names[pol_name] = None
+                r_detach_pol = c_iot.detach_policy(policyName=pol_name, target=arn)
+                self.log("    DETACH POL: {}".format(r_detach_pol))
+
+            r_del_cert = c_iot.delete_certificate(certificateId=cert_id, forceDelete=True)
+            self.log("  DEL CERT: {}".format(r_del_cert))
+
+        r_del_thing = c_iot.delete_thing(thingName=thing_name)
+        self.log("  DELETE THING: {}\n".format(r_del_thing))
+
+    def delete_planned_thing(self, thing_name):
+        """deletes a thing of the plan, its certificates once they are detached from all things"""
+        c_iot = self.c_iot
+        self.log("  DELETING thing_name: {}".format(thing_name))
+
+        for arn in self.plan.things[thing_name]:
+            try:
+                r_detach_thing = c_iot.detach_thing_principal(thingName=thing_name, principal=arn)
+                self.log("  DETACH THING: {}".format(r_detach_thing))
+            except c_iot.exceptions.ResourceNotFoundException:
+                # detached by an interrupted run which could not journal it
+                self.log("  ALREADY DETACHED: {}".format(arn))
+            self.mark_done('detach', "{} {}".format(thing_name, arn))
+            with self.lock:
+                self.remaining[arn] -= 1
+                last = self.remaining[arn] == 0
+            if last:
+                self.delete_certificate(arn)
+
+        r_del_thing = c_iot.delete_thing(thingName=thing_name)
+        self.log("  DELETE THING: {}\n".format(r_del_thing))
+
+    def delete_certificate(self, arn):
+        """deactivates and deletes a certificate which is not attached to a thing"""
+        c_iot = self.c_iot
+        cert_id = arn.split('/')[1]
+        try:
+            r_upd_cert = c_iot.update_certificate(certificateId=cert_id, newStatus='INACTIVE')
+            self.log("  INACTIVE: {}".format(r_upd_cert))
+            # forceDelete drops the policy attachments of the certificate
+            r_del_cert = c_iot.delete_certificate(certificateId=cert_id, forceDelete=True)
+            self.log("  DEL CERT: {}".format(r_del_cert))
+        except c_iot.exceptions.ResourceNotFoundException:
+            self.log("  ALREADY DELETED: {}".format(arn))
+        self.mark_done('certificate', arn)
+
+    def _delete_thing(self, thing_name):
+        try:
+            if self.plan:
+                self.delete_planned_thing(thing_name)
+            else:
+                self.delete_thing(thing_name)
+            self.mark_done('thing', thing_name)
+            ok = True
+        except Exception as delete_thing_error:
+            print("ERROR deleting thing {}: {}".format(thing_name, delete_thing_error))
+            self.mark_failed('thing', thing_name, delete_thing_error)
+            with self.lock:
+                self.failed.append(thing_name)
+            ok = False
+        if self.progress:
+            self.progress.update(ok)
+        return ok
+
+    def delete_things(self, thing_names):
+        """deletes all things concurrently, returns the number of deleted things
+
+        thing_names may be any iterable; at most 2 * workers things are
+        queued in the pool at any time.
+        """
+        results = bounded_map(self._delete_thing, thing_names, self.workers)
+        return sum(1 for _, ok, _ in results if ok)
+
+    def delete_thing_group(self, thing_group):
+        r_del_grp = self.c_iot.delete_thing_group(thingGroupName=thing_group)
+        print("DELETE THING GROUP {}: {}".format(thing_group, r_del_grp))
+
+    def detach_policy_targets(self, policy_name):
+        """detaches a policy from all its targets
+
+        Detaching invalidates the marker of list_targets_for_policy, so the
+        first page is listed again after targets were detached. Targets
+        detached before may still be listed for a while; they are not
+        detached again, and a page with only such targets is followed to
+        the next one, so the listing ends with the last page.
+        """
+        kwargs = {'policyName': policy_name, 'pageSize': 250}
+        detached = set()
+        while True:
+            r_targets = self.c_iot.list_targets_for_policy(**kwargs)
+            targets = [arn for arn in r_targets['targets'] if arn not in detached]
+            for arn in targets:
+                self.log("DETACH: {}".format(arn))
+                r_detach_pol = self.c_iot.detach_policy(policyName=policy_name, target=arn)
+                self.log("r_detach_pol: {}\n".format(r_detach_pol))
+                detached.add(arn)
+            if targets:
+                kwargs.pop('marker', None)
+            elif r_targets.get('nextMarker'):
+                kwargs['marker'] = r_targets['nextMarker']
+            else:
+                return
+
+    def delete_policy(self, policy_name, keep=False):
+        """detaches and deletes a policy with all its versions
+
+        With keep the policy is detached and its versions are deleted but
+        the policy itself is kept. Returns False on errors.
+        """
+        c_iot = self.c_iot
+        print("DELETE policy: {}".format(policy_name))
+        try:
+            self.detach_policy_targets(policy_name)
+
+            r_versions = c_iot.list_policy_versions(policyName=policy_name)
+            self.log('policy_name: {} versions: {}'.format(
+                policy_name, r_versions['policyVersions']))
+
+            for version in r_versions["policyVersions"]:
+                if not version['isDefaultVersion']:
+                    self.log(
+                        'policy_name: {} deleting policy version: {}'.format(
+                            policy_name, version['versionId']
+                        )
+                    )
+                    c_iot.delete_policy_version(policyName=policy_name,
+                        policyVersionId=version['versionId'])
+
+            if not keep:
+                r_del_pol = c_iot.delete_policy(policyName=policy_name)
+                print("r_del_pol: {}".format(r_del_pol))
+        except c_iot.exceptions.ResourceNotFoundException:
+            print("policy_name \"{}\" does not exist".format(policy_name))
+        except Exception as delete_policy_error:
+            print("ERROR: {}".format(delete_policy_error))
+            self.mark_failed('policy', policy_name, delete_policy_error)
+            return False
+        self.mark_done('policy', policy_name)
+        return True
+
+    def run_plan(self, plan):
+        """deletes the things, thing groups and policies of a TeardownPlan
+
+        Returns the number of deleted things.
+        """
+        for arn in plan.orphan_certificates:
+            try:
+                self.delete_certificate(arn)
+            except Exception as delete_certificate_error:
+                print("ERROR deleting certificate {}: {}".format(arn, delete_certificate_error))
+                self.mark_failed('certificate', arn, delete_certificate_error)
+
+        self.plan = plan
+        self.remaining = {arn: len(things) for arn, things in plan.principal_things.items()}
+        try:
+            deleted = self.delete_things(plan.things)
+        finally:
+            self.plan = None
+
+        for thing_group in plan.thing_groups:
+            try:
+                self.delete_thing_group(thing_group)
+                self.mark_done('thing_group', thing_group)
+            except Exception as delete_thing_group_error:
+                print("ERROR deleting thing group {}: {}".format(thing_group, delete_thing_group_error))
+                self.mark_failed('thing_group', thing_group, delete_thing_group_error)
+
+        for policy_name, policy in plan.policies.items():
+            self.delete_policy(policy_name, keep=policy['keep'])
+        return deleted
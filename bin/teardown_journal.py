@@ -0,0 +1,132 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# teardown_journal.py
+#
+# SQLite journal of a clean-up run
+"""Journal for resumable teardowns
+
+The journal keeps the TeardownPlan of a run and the state of every step
+of it in a local SQLite database. A step is identified by its kind and
+name:
+
+    thing        thing name
+    detach       "<thing name> <principal arn>"
+    certificate  principal arn
+    thing_group  thing group name
+    policy       policy name
+
+and is either "done" or "failed". Every state change is committed right
+away (WAL mode), so a crashed or interrupted run loses no finished step.
+A restarted run loads the plan from the journal, skips done steps and
+retries the failed and missing ones.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from urllib.request import pathname2url
+
+from teardown_plan import TeardownPlan
+
+JOURNAL_FILE = "clean-up.db"
+
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS run (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    started REAL NOT NULL,
+    finished REAL,
+    plan TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS step (
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    state TEXT NOT NULL,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 1,
+    updated REAL NOT NULL,
+    PRIMARY KEY (kind, name)
+);
+"""
+
+
+class TeardownJournal(object):
+    def __init__(self, path=JOURNAL_FILE, read_only=False):
+        """opens or creates the journal at path
+
+        A read_only journal never writes to path: an existing journal is
+        opened read-only, a missing one is replaced by an empty one in
+        memory.
+        """
+        self.path = path
+        if read_only and os.path.exists(path):
+            self.db = sqlite3.connect("file:{}?mode=ro".format(pathname2url(path)), uri=True,
+                                      check_same_thread=False)
+        else:
+            self.db = sqlite3.connect(":memory:" if read_only else path,
+                                      check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.done = set(self.db.execute(
+            "SELECT kind, name FROM step WHERE state = ?", (DONE,)))
+
+    def load_plan(self):
+        """returns the plan of an unfinished run or None"""
+        row = self.db.execute("SELECT plan FROM run WHERE finished IS NULL").fetchone()
+        return TeardownPlan.from_dict(json.loads(row[0])) if row else None
+
+    def start(self, plan):
+        """starts a new run with plan, forgets the previous run"""
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM run")
+            self.db.execute("DELETE FROM step")
+            self.db.execute("INSERT INTO run (id, started, plan) VALUES (1, ?, ?)",
+                            (time.time(), json.dumps(plan.as_dict())))
+            self.done = set()
+
+    def finish(self):
+        with self.lock, self.db:
+            self.db.execute("UPDATE run SET finished = ?", (time.time(),))
+
+    def is_done(self, kind, name):
+        return (kind, name) in self.done
+
+    def _set(self, kind, name, state, error=None):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO step (kind, name, state, error, updated) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (kind, name) DO UPDATE SET state = excluded.state, "
+                "error = excluded.error, updated = excluded.updated, attempts = attempts + 1",
+                (kind, name, state, error, time.time()))
+            if state == DONE:
+                self.done.add((kind, name))
+
+    def mark_done(self, kind, name):
+        self._set(kind, name, DONE)
+
+    def mark_failed(self, kind, name, error):
+        self._set(kind, name, FAILED, str(error))
+
+    def counts(self):
+        """returns {(kind, state): number of steps}"""
+        with self.lock:
+            return {(kind, state): n for kind, state, n in self.db.execute(
+                "SELECT kind, state, COUNT(*) FROM step GROUP BY kind, state")}
+
+    def failures(self, limit=20):
+        with self.lock:
+            return self.db.execute(
+                "SELECT kind, name, error, attempts FROM step WHERE state = ? "
+                "ORDER BY updated LIMIT ?", (FAILED, limit)).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
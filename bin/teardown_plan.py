@@ -0,0 +1,261 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+#
+# teardown_plan.py
+#
+# dependency graph of the resources removed by clean-up.py
+"""Teardown planner
+
+build_plan() reads the graph thing -> principal -> policy with read only
+calls before anything is deleted. Principals attached to several things
+and policies attached to many principals are kept once, so every
+certificate is deleted once and every policy is looked at once no matter
+how many certificates share it.
+
+Deletions are ordered so that no call is spent on an edge which goes away
+anyway: certificates are deleted with forceDelete, which drops their
+policy attachments, so policies are not detached per certificate. A
+policy is detached only from the targets outside of the plan before it is
+deleted.
+"""
+
+import collections
+import concurrent.futures
+import math
+import sys
+
+TARGETS_PAGE_SIZE = 250
+LATENCY = 0.1
+
+
+def _map(fn, items, workers):
+    """calls fn for every item in a thread pool, yields (item, result)"""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(fn, item): item for item in items}
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.result()
+
+
+class TeardownPlan(object):
+    """deduplicated resources to delete and the calls needed to delete them"""
+
+    def __init__(self):
+        self.things = collections.OrderedDict()
+        self.principal_things = collections.OrderedDict()
+        self.principal_policies = {}
+        self.policies = collections.OrderedDict()
+        self.thing_groups = []
+        self.missing_things = []
+        self.missing_policies = []
+        self.discovery_calls = collections.Counter()
+        self.orphan_certificates = []
+
+    def add_thing(self, thing_name, principals):
+        self.things[thing_name] = list(principals)
+        for arn in principals:
+            self.principal_things.setdefault(arn, []).append(thing_name)
+
+    def add_policy(self, policy_name, versions, outside_targets, keep=False):
+        """versions: number of non default versions, outside_targets: targets not in the plan"""
+        self.policies[policy_name] = {
+            'keep': keep,
+            'versions': versions,
+            'outside_targets': outside_targets
+        }
+
+    def as_dict(self):
+        return {
+            'things': self.things,
+            'principal_policies': {arn: sorted(p) for arn, p in self.principal_policies.items()},
+            'policies': self.policies,
+            'thing_groups': self.thing_groups,
+            'missing_things': self.missing_things,
+            'missing_policies': self.missing_policies
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        plan = cls()
+        for thing_name, principals in data['things'].items():
+            plan.add_thing(thing_name, principals)
+        plan.principal_policies = {arn: set(p) for arn, p in data['principal_policies'].items()}
+        plan.policies = collections.OrderedDict(data['policies'])
+        plan.thing_groups = data['thing_groups']
+        plan.missing_things = data['missing_things']
+        plan.missing_policies = data['missing_policies']
+        return plan
+
+    def pending(self, journal):
+        """returns the part of the plan which is not done according to journal"""
+        plan = TeardownPlan()
+        for thing_name, principals in self.things.items():
+            if journal.is_done('thing', thing_name):
+                continue
+            plan.add_thing(thing_name, [
+                arn for arn in principals
+                if not journal.is_done('detach', "{} {}".format(thing_name, arn))])
+        plan.principal_policies = self.principal_policies
+        plan.policies = collections.OrderedDict(
+            (name, policy) for name, policy in self.policies.items()
+            if not journal.is_done('policy', name))
+        plan.thing_groups = [g for g in self.thing_groups if not journal.is_done('thing_group', g)]
+        plan.missing_things = self.missing_things
+        plan.missing_policies = self.missing_policies
+        # certificates whose things were all detached before the run was interrupted
+        plan.orphan_certificates = [
+            arn for arn, things in self.principal_things.items()
+            if arn not in plan.principal_things and not journal.is_done('certificate', arn)]
+        return plan
+
+    def calls(self):
+        """number of calls per API needed to execute the plan"""
+        calls = collections.OrderedDict()
+        calls['detach_thing_principal'] = sum(len(p) for p in self.things.values())
+        certificates = len(self.principal_things) + len(self.orphan_certificates)
+        calls['update_certificate'] = certificates
+        calls['delete_certificate'] = certificates
+        calls['delete_thing'] = len(self.things)
+        calls['delete_thing_group'] = len(self.thing_groups)
+        calls['list_targets_for_policy'] = sum(
+            math.ceil(p['outside_targets'] / TARGETS_PAGE_SIZE) + 1 for p in self.policies.values())
+        calls['detach_policy'] = sum(p['outside_targets'] for p in self.policies.values())
+        calls['list_policy_versions'] = len(self.policies)
+        calls['delete_policy_version'] = sum(p['versions'] for p in self.policies.values())
+        calls['delete_policy'] = sum(1 for p in self.policies.values() if not p['keep'])
+        return calls
+
+    def unplanned_calls(self):
+        """calls the serial clean-up without a plan would have made
+
+        It made four calls per thing/certificate edge, detached every
+        policy from every certificate and appended the policy name once
+        per attachment; every duplicate cost another failing
+        list_targets_for_policy.
+        """
+        edges = [arn for principals in self.things.values() for arn in principals]
+        attachments = sum(len(self.principal_policies.get(arn, ())) for arn in edges)
+        calls = self.calls()
+        policy_calls = (calls['list_targets_for_policy'] + calls['detach_policy'] +
+                        calls['list_policy_versions'] + calls['delete_policy_version'] +
+                        calls['delete_policy'])
+        duplicates = attachments - len(set().union(*self.principal_policies.values()))
+        return (2 * len(self.things) + 4 * len(edges) + attachments +
+                len(self.thing_groups) + policy_calls + duplicates)
+
+    def estimate_secs(self, rate, workers, latency=LATENCY):
+        """rough duration of the plan
+
+        The things are deleted in parallel; that phase is limited either by
+        the API with the most calls at its initial rate or by the number of
+        calls every worker makes one after the other. Policies and thing
+        groups are deleted one after the other.
+        """
+        calls = self.calls()
+        thing_apis = ('detach_thing_principal', 'update_certificate',
+                      'delete_certificate', 'delete_thing')
+        thing_calls = sum(calls[api] for api in thing_apis)
+        parallel = max([calls[api] / rate for api in thing_apis] +
+                       [thing_calls * latency / workers])
+        serial_calls = sum(n for api, n in calls.items() if api not in thing_apis)
+        return parallel + serial_calls * max(latency, 1.0 / rate)
+
+    def report(self, rate, workers, out=None):
+        out = out or sys.stdout
+        shared = sum(1 for things in self.principal_things.values() if len(things) > 1)
+        out.write("things: {} ({} not found), certificates: {} ({} shared), "
+                  "policies: {} ({} not found), thing groups: {}\n".format(
+                      len(self.things), len(self.missing_things), len(self.principal_things),
+                      shared, len(self.policies), len(self.missing_policies),
+                      len(self.thing_groups)))
+        out.write("read calls made for the plan: {}\n".format(sum(self.discovery_calls.values())))
+        calls = self.calls()
+        for api, n in calls.items():
+            if n:
+                out.write("  {:<24} {:>8}\n".format(api, n))
+        total = sum(calls.values())
+        out.write("calls to execute the plan: {} (about {} without the plan)\n".format(
+            total, self.unplanned_calls()))
+        out.write("estimated time: {:.0f} secs. at {} calls/sec per API with {} workers\n".format(
+            self.estimate_secs(rate, workers), rate, workers))
+
+
+def _list_all(fn, key, **kwargs):
+    """follows nextMarker, returns (items, calls)"""
+    items = []
+    calls = 0
+    while True:
+        calls += 1
+        response = fn(**kwargs)
+        items.extend(response[key])
+        if not response.get('nextMarker'):
+            return items, calls
+        kwargs['marker'] = response['nextMarker']
+
+
+def build_plan(c_iot, thing_names, policy_names=(), thing_groups=(), keep_policies=(),
+               workers=16, progress=None):
+    """reads the resource graph of thing_names and returns a TeardownPlan
+
+    policy_names are deleted in addition to the policies found on the
+    certificates, keep_policies are detached but not deleted. Things and
+    policies which do not exist are recorded as missing.
+    """
+    plan = TeardownPlan()
+    plan.thing_groups = list(dict.fromkeys(thing_groups))
+    not_found = c_iot.exceptions.ResourceNotFoundException
+
+    def thing_principals(thing_name):
+        try:
+            return c_iot.list_thing_principals(thingName=thing_name)['principals']
+        except not_found:
+            return None
+
+    unique_things = list(dict.fromkeys(thing_names))
+    plan.discovery_calls['list_thing_principals'] = len(unique_things)
+    found = {}
+    for thing_name, principals in _map(thing_principals, unique_things, workers):
+        found[thing_name] = principals
+        if progress:
+            progress.update(principals is not None)
+    for thing_name in unique_things:
+        if found[thing_name] is None:
+            plan.missing_things.append(thing_name)
+        else:
+            plan.add_thing(thing_name, found[thing_name])
+
+    def principal_policies(arn):
+        return _list_all(c_iot.list_principal_policies, 'policies', principal=arn)
+
+    for arn, (policies, calls) in _map(principal_policies, list(plan.principal_things), workers):
+        plan.principal_policies[arn] = {pol['policyName'] for pol in policies}
+        plan.discovery_calls['list_principal_policies'] += calls
+
+    policy_names = list(dict.fromkeys(
+        sorted(set().union(*plan.principal_policies.values())) + list(policy_names)))
+
+    def inspect_policy(policy_name):
+        try:
+            versions = c_iot.list_policy_versions(policyName=policy_name)['policyVersions']
+            targets, calls = _list_all(c_iot.list_targets_for_policy, 'targets',
+                                       policyName=policy_name, pageSize=TARGETS_PAGE_SIZE)
+        except not_found:
+            return None
+        return versions, targets, calls
+
+    for policy_name, result in _map(inspect_policy, policy_names, workers):
+        if result is None:
+            plan.missing_policies.append(policy_name)
+            continue
+        versions, targets, calls = result
+        plan.discovery_calls['list_policy_versions'] += 1
+        plan.discovery_calls['list_targets_for_policy'] += calls
+        plan.add_policy(
+            policy_name,
+            versions=sum(1 for v in versions if not v.get('isDefaultVersion')),
+            outside_targets=sum(1 for arn in targets if arn not in plan.principal_things),
+            keep=policy_name in keep_policies
+        )
+    plan.policies = collections.OrderedDict(
+        (name, plan.policies[name]) for name in policy_names if name in plan.policies)
+    return plan
@@ -0,0 +1,175 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""Location of device IP addresses
+
+GeoLocator asks its backends in order and caches the answers:
+
+  - LRUCache: in process LRU cache with TTL, keyed by the IP address or
+    by its network (/24 for IPv4, /48 for IPv6 by default), so devices
+    behind the same network share one lookup. Created at module scope of
+    the Lambda it survives warm invocations.
+  - MMDBLocator: offline lookup in a MaxMind DB file (e.g.
+    GeoLite2-City.mmdb shipped with the Lambda), needs the maxminddb
+    package.
+  - IpstackLocator: ipstack over a pooled HTTP session with short
+    timeouts.
+
+A location is a dict with latitude and longitude, which are None when
+no backend knows the address.
+"""
+
+import collections
+import ipaddress
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger()
+
+CACHE_SIZE = 10000
+CACHE_TTL = 24 * 3600
+NEGATIVE_TTL = 300
+IPV4_PREFIX = 24
+IPV6_PREFIX = 48
+CONNECT_TIMEOUT = 1.0
+READ_TIMEOUT = 2.0
+
+UNKNOWN = {'latitude': None, 'longitude': None}
+
+
+def cache_key(ip, ipv4_prefix=IPV4_PREFIX, ipv6_prefix=IPV6_PREFIX):
+    """the network of ip with the given prefix length, or ip itself for invalid addresses"""
+    try:
+        address = ipaddress.ip_address(ip.strip())
+    except ValueError:
+        return ip
+    prefix = ipv4_prefix if address.version == 4 else ipv6_prefix
+    return str(ipaddress.ip_network("{}/{}".format(address, prefix), strict=False))
+
+
+class LRUCache(object):
+    """least recently used cache whose entries expire after their ttl"""
+
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL, clock=time.monotonic):
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < self.clock():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, ttl=None):
+        with self.lock:
+            self.entries[key] = (self.clock() + (self.ttl if ttl is None else ttl), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class MMDBLocator(object):
+    name = 'mmdb'
+
+    def __init__(self, path):
+        import maxminddb
+
+        self.reader = maxminddb.open_database(path)
+
+    def locate(self, ip):
+        record = self.reader.get(ip)
+        location = (record or {}).get('location') or {}
+        if location.get('latitude') is None:
+            return None
+        return {'latitude': location['latitude'], 'longitude': location['longitude']}
+
+
+class IpstackLocator(object):
+    name = 'ipstack'
+
+    def __init__(self, api_url, api_key, session=None, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)):
+        self.api_url = api_url.rstrip('/')
+        self.api_key = api_key
+        self.session = session or pooled_session()
+        self.timeout = timeout
+
+    def locate(self, ip):
+        r = self.session.get("{}/{}".format(self.api_url, ip),
+                             params={'access_key': self.api_key}, timeout=self.timeout)
+        r.raise_for_status()
+        j = r.json()
+        logger.debug("j: {}".format(j))
+        if j.get('latitude') is None or j.get('longitude') is None:
+            return None
+        return j
+
+
+def pooled_session(pool_size=10):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class GeoLocator(object):
+    def __init__(self, backends, cache=None, key=cache_key, negative_ttl=NEGATIVE_TTL):
+        self.backends = backends
+        self.cache = cache if cache is not None else LRUCache()
+        self.key = key
+        self.negative_ttl = negative_ttl
+
+    def locate(self, ip):
+        """returns the location of ip, UNKNOWN when no backend knows it
+
+        Backend errors are logged and the next backend is asked. Unknown
+        addresses are cached for negative_ttl only; failed lookups are not
+        cached.
+        """
+        key = self.key(ip)
+        location = self.cache.get(key)
+        if location is not None:
+            return location
+
+        failed = False
+        for backend in self.backends:
+            start = time.perf_counter()
+            try:
+                location = backend.locate(ip)
+            except Exception as e:
+                logger.warning("{} lookup of {} failed: {}".format(backend.name, ip, e))
+                failed = True
+                continue
+            logger.info("{} lookup of {}: {:.1f} ms".format(
+                backend.name, ip, (time.perf_counter() - start) * 1000))
+            if location is not None:
+                location = dict(location, source=backend.name)
+                self.cache.put(key, location)
+                return location
+
+        if not failed:
+            self.cache.put(key, UNKNOWN, ttl=self.negative_ttl)
+        return UNKNOWN
@@ -16,26 +16,46 @@
 
 import base64
 import boto3
-import json
+import collections
+import concurrent.futures
 import logging
 import os
 import re
-import requests
-import string
 import sys
+import threading
 import time
-from OpenSSL import crypto
-from OpenSSL.crypto import X509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, padding
 from time import gmtime, strftime
-from geopy.distance import great_circle
+
+from geolocation import GeoLocator, IpstackLocator, LRUCache, MMDBLocator, cache_key
+from region_lookup import RegionGrid, RegionTable
+from region_probe import LatencyCache
 
 # globals
 ipstack_api_url = 'http://api.ipstack.com/'
-ipstack_api_key = os.environ['IPSTACK_API_KEY']
+ipstack_api_key = os.environ.get('IPSTACK_API_KEY')
+geoip_db_file = os.environ.get('GEOIP_DB_FILE', 'GeoLite2-City.mmdb')
+geo_cache_size = int(os.environ.get('GEO_CACHE_SIZE', '10000'))
+geo_cache_ttl = int(os.environ.get('GEO_CACHE_TTL', '86400'))
+geo_cache_prefix = int(os.environ.get('GEO_CACHE_PREFIX', '24'))
+# latency: fastest region reported by the device or its network, distance otherwise
+region_selection = os.environ.get('REGION_SELECTION', 'latency')
+latency_cache_ttl = int(os.environ.get('LATENCY_CACHE_TTL', '3600'))
+# seconds the IoT endpoint and the existence of the IoT policy per region are cached
+endpoint_cache_ttl = int(os.environ.get('ENDPOINT_CACHE_TTL', '86400'))
+policy_cache_ttl = int(os.environ.get('POLICY_CACHE_TTL', '3600'))
+# devices per batch request and devices provisioned concurrently
+batch_max_devices = int(os.environ.get('BATCH_MAX_DEVICES', '100'))
+batch_workers = int(os.environ.get('BATCH_WORKERS', '16'))
+# secs after which the claim of a device by a request which did not finish can be taken over
+claim_timeout = int(os.environ.get('CLAIM_TIMEOUT', '300'))
 
 iot_policy_name = 'GlobalDevicePolicy'
 dynamodb_table_name = 'iot-global-provisioning'
 pub_key_file = 'global-provisioning.pub.key.pem'
+# built by bin/build-region-grid.py
+region_grid_file = 'region_grid.npz'
 
 # Configure logging
 logger = logging.getLogger()
@@ -49,6 +69,7 @@ h.setFormatter(logging.Formatter(FORMAT))
 
 logger.addHandler(h)
 logger.setLevel(logging.INFO)
+root_logger = logger
 
 class RequestIdAdapter(logging.LoggerAdapter):
     def process(self, msg, kwargs):
@@ -68,49 +89,154 @@ regions = [
     {"name": "eu-west-2", "lat": "51.7", "lon": "0.1"}
 ]
 
+region_table = RegionTable(regions)
+# nearest region per cell, built here if the file is missing or stale
+region_grid = RegionGrid.load_or_build(region_grid_file, region_table)
+
 default_region = "eu-west-2"
 
+# kept across warm invocations
+iot_clients = {}
+clients_lock = threading.Lock()
+c_dynamo = None
+account_id = None
+endpoint_cache = LRUCache(size=len(regions), ttl=endpoint_cache_ttl)
+policy_cache = LRUCache(size=len(regions), ttl=policy_cache_ttl)
+pub_key = None
+# runs the IoT calls of provision_device; batch_handler has its own pool
+iot_executor = concurrent.futures.ThreadPoolExecutor(max_workers = max(8, 4 * batch_workers))
+
+# handshake times reported by devices, per source network
+latency_cache = LatencyCache(
+    [r["name"] for r in regions],
+    size=geo_cache_size,
+    ttl=latency_cache_ttl,
+    key=lambda ip: cache_key(ip, ipv4_prefix=geo_cache_prefix)
+)
+
+def create_geo_locator():
+    backends = []
+    if geoip_db_file and os.path.exists(geoip_db_file):
+        try:
+            backends.append(MMDBLocator(geoip_db_file))
+            logger.info("using GeoIP database {}".format(geoip_db_file))
+        except ImportError:
+            logger.warning("maxminddb not installed, ignoring GeoIP database {}".format(geoip_db_file))
+        except (IOError, ValueError, RuntimeError) as e:
+            # maxminddb.InvalidDatabaseError is a RuntimeError
+            logger.error("can not read GeoIP database {}, ignoring it: {}".format(geoip_db_file, e))
+    if ipstack_api_key:
+        backends.append(IpstackLocator(ipstack_api_url, ipstack_api_key))
+    if not backends:
+        logger.error("no GeoIP database and no IPSTACK_API_KEY, devices go to {}".format(default_region))
+    return GeoLocator(
+        backends,
+        cache=LRUCache(size=geo_cache_size, ttl=geo_cache_ttl),
+        key=lambda ip: cache_key(ip, ipv4_prefix=geo_cache_prefix)
+    )
+
+# created once per container, the cache survives warm invocations
+geo_locator = create_geo_locator()
+
 def get_ip_location(ip):
-    request_url = ipstack_api_url + '/' + ip + '?access_key=' + ipstack_api_key
-    logger.debug("request_url: {}".format(request_url))
-    r = requests.get(request_url)
-    j = json.loads(r.text)
-    logger.debug("j: {}".format(j))
-    return j
+    location = geo_locator.locate(ip)
+    logger.info("location of {}: {}, cache hits: {}, misses: {}".format(
+        ip, location, geo_locator.cache.hits, geo_locator.cache.misses))
+    return location
 
 
 def find_best_region(lat, lon):
-    min_distance = 40000
-    closest_region = None
-
-    for r in regions:
-        logger.debug("r: {}".format(r))
-        elat = float(r["lat"])
-        elon = float(r["lon"])
-        logger.debug("elat: {}, elon: {}".format(elat, elon))
-        distance = great_circle((lat, lon), (elat, elon)).km
-        logger.debug("distance: {}".format(distance))
-        if distance <= min_distance:
-            min_distance = distance
-            closest_region = r["name"]
-        logger.debug("min_distance: {}".format(min_distance))
+    closest_region, min_distance = region_grid.nearest(lat, lon)
 
     logger.info("closest_region: {}, distance: {}".format(closest_region, min_distance))
 
     return {"region": closest_region, "distance": min_distance}
 
 
+def find_fastest_region(ip, latencies):
+    """fastest region of the latencies reported by the device, or measured before in its network"""
+    if latencies is not None and not isinstance(latencies, dict):
+        logger.warn("ignoring region-latencies which are not a dict: {}".format(latencies))
+        latencies = None
+    region, secs = latency_cache.fastest(ip, latencies)
+    if region:
+        logger.info("fastest_region: {}, handshake: {:.1f} ms".format(region, secs * 1000))
+        return {"region": region, "latency": secs}
+    return None
+
+
+def select_region(ip, latencies, source_ip):
+    """returns {"region": ...} plus the latency or distance it was chosen by, or a message
+
+    Latencies are cached for the network of source_ip, the address API
+    Gateway received the request from, not for ip which the device can
+    set in X-Forwarded-For.
+    """
+    if region_selection == 'latency':
+        fastest_region = find_fastest_region(source_ip, latencies)
+        if fastest_region:
+            return fastest_region
+
+    location = get_ip_location(ip)
+    if location['latitude'] == None or location['longitude'] == None:
+        message = "no latitude or longitude for IP {}, using default region {}".format(ip, default_region)
+        logger.warn(message)
+        return {"region": default_region, "message": message}
+
+    lat = float(location['latitude'])
+    lon = float(location['longitude'])
+    logger.info("lat: {}, lon: {}".format(lat, lon))
+    return find_best_region(lat, lon)
+
+
+def get_iot_client(region):
+    c_iot = iot_clients.get(region)
+    if c_iot is None:
+        # creating clients from the default session is not thread safe
+        with clients_lock:
+            c_iot = iot_clients.get(region)
+            if c_iot is None:
+                c_iot = boto3.client('iot', region_name = region)
+                iot_clients[region] = c_iot
+    return c_iot
+
+
+def get_dynamodb_client():
+    global c_dynamo
+    if c_dynamo is None:
+        with clients_lock:
+            if c_dynamo is None:
+                c_dynamo = boto3.client('dynamodb')
+    return c_dynamo
+
+
 def get_account_id():
-    client = boto3.client('sts')
-    response = client.get_caller_identity()
-    logger.info("response: {}".format(response))
-    return response['Account']
+    global account_id
+    if account_id is None:
+        client = boto3.client('sts')
+        response = client.get_caller_identity()
+        logger.info("response: {}".format(response))
+        account_id = response['Account']
+    return account_id
+
+
+def get_iot_endpoint(c_iot, region):
+    endpoint = endpoint_cache.get(region)
+    if endpoint is None:
+        response = c_iot.describe_endpoint(endpointType='iot:Data-ATS')
+        logger.info("response: {}".format(response))
+        endpoint = response['endpointAddress']
+        endpoint_cache.put(region, endpoint)
+    return endpoint
 
 
 def create_iot_policy_if_missing(c_iot, region):
+    if policy_cache.get(region):
+        return
     try:
         response = c_iot.get_policy(policyName = iot_policy_name)
         logger.info("policy exists already: response: {}".format(response))
+        policy_cache.put(region, True)
     except Exception as e:
         if re.match('.*ResourceNotFoundException.*', str(e)):
             logger.info("creating iot policy {}".format(iot_policy_name))
@@ -139,27 +265,51 @@ def create_iot_policy_if_missing(c_iot, region):
                 policyDocument = policy_document
             )
             logger.info("response: {}".format(response))
+            policy_cache.put(region, True)
         else:
             logger.error("unknown error: {}".format(e))
 
 
-def provision_device(thing_name, region, CSR):
-    answer = {}
-    logger.info("thing_name: {}, region {}".format(thing_name, region))
-    c_iot = boto3.client('iot', region_name = region)
-
-    # endpoint
-    response = c_iot.describe_endpoint(endpointType='iot:Data-ATS')
-    logger.info("response: {}".format(response))
-    answer['endpointAddress'] = response['endpointAddress']
-
-    # create policy if missing
-    create_iot_policy_if_missing(c_iot, region)
-
-    # create thing
+def run_steps(steps, executor, results = None):
+    """runs steps {name: (fn, [names of the steps it depends on])} as a dependency graph
+
+    Each step starts as soon as the steps it depends on are done and is
+    called with the results of the steps done so far. Returns {name:
+    result}, also stored in results if given. After a step fails no
+    further steps are started; the first error is raised once the running
+    steps are done, results then holds the steps which succeeded.
+    """
+    pending = dict(steps)
+    running = {}
+    results = {} if results is None else results
+    error = None
+    while pending or running:
+        if error is None:
+            for name, (fn, dependencies) in list(pending.items()):
+                if all(d in results for d in dependencies):
+                    running[executor.submit(fn, dict(results))] = name
+                    del pending[name]
+        if not running:
+            break
+        done, _ = concurrent.futures.wait(running, return_when = concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            name = running.pop(future)
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                if error is None:
+                    error = e
+    if error is not None:
+        raise error
+    return results
+
+
+def create_thing(c_iot, thing_name):
     response = c_iot.create_thing(thingName = thing_name)
     logger.info("response: {}".format(response))
 
+
+def create_certificate(c_iot, CSR):
     if CSR:
         logger.info("CSR received: create_certificate_from_csr")
         # create cert from csr
@@ -167,108 +317,256 @@ def provision_device(thing_name, region, CSR):
             certificateSigningRequest = CSR,
             setAsActive = True
         )
-        logger.debug("response: {}".format(response))
-        certificate_arn = response['certificateArn']
-        certificate_id = response['certificateId']
-        logger.info("certificate_arn: {}, certificate_id: {}".format(certificate_arn, certificate_id))
-        answer['certificatePem'] = response['certificatePem']
     else:
         logger.info("no CSR received: create_keys_and_certificate")
         # create key/cert
         response = c_iot.create_keys_and_certificate(setAsActive = True)
-        logger.debug("response: {}".format(response))
-        certificate_arn = response['certificateArn']
-        certificate_id = response['certificateId']
-        logger.info("certificate_arn: {}, certificate_id: {}".format(certificate_arn, certificate_id))
-        answer['certificatePem'] = response['certificatePem']
-        answer['PrivateKey'] = response['keyPair']['PrivateKey']
-
-    # attach policy to certificate
-    response = c_iot.attach_policy(
-        policyName = iot_policy_name,
-        target = certificate_arn
-    )
+    logger.debug("response: {}".format(response))
+    logger.info("certificate_arn: {}, certificate_id: {}".format(response['certificateArn'], response['certificateId']))
+    return response
+
+
+def attach_policy(c_iot, region, certificate_arn):
+    try:
+        response = c_iot.attach_policy(
+            policyName = iot_policy_name,
+            target = certificate_arn
+        )
+    except Exception:
+        # the cached policy may have been deleted, check again next time
+        policy_cache.delete(region)
+        raise
     logger.info("response: {}".format(response))
 
+
+def attach_thing_principal(c_iot, thing_name, certificate_arn):
     response = c_iot.attach_thing_principal(
         thingName = thing_name,
         principal = certificate_arn
     )
     logger.info("response: {}".format(response))
 
+
+def delete_certificate(c_iot, thing_name, certificate_arn, certificate_id):
+    """detaches, deactivates and deletes a certificate created for a device which was not provisioned"""
+    try:
+        c_iot.detach_thing_principal(thingName = thing_name, principal = certificate_arn)
+    except Exception as e:
+        logger.info("detaching certificate {} from {}: {}".format(certificate_id, thing_name, e))
+    try:
+        c_iot.update_certificate(certificateId = certificate_id, newStatus = 'INACTIVE')
+        c_iot.delete_certificate(certificateId = certificate_id, forceDelete = True)
+        logger.info("deleted certificate {}".format(certificate_id))
+    except Exception as e:
+        logger.error("deleting certificate {} failed: {}".format(certificate_id, e))
+
+
+def provision_device(thing_name, region, CSR):
+    """creates the thing and its certificate in region
+
+    Only the attach calls have to wait: the policy for the certificate and
+    the policy, the thing principal for the thing and the certificate.
+    Everything else runs concurrently, so a device takes two rounds of IoT
+    calls instead of up to six. If any call fails after the certificate was
+    created, the certificate is deleted so retries do not leave active
+    certificates behind.
+    """
+    answer = {}
+    logger.info("thing_name: {}, region {}".format(thing_name, region))
+    c_iot = get_iot_client(region)
+
+    results = {}
+    steps = {
+        'endpoint': (lambda r: get_iot_endpoint(c_iot, region), []),
+        'policy': (lambda r: create_iot_policy_if_missing(c_iot, region), []),
+        'thing': (lambda r: create_thing(c_iot, thing_name), []),
+        'certificate': (lambda r: create_certificate(c_iot, CSR), []),
+        'attach_policy': (lambda r: attach_policy(
+            c_iot, region, r['certificate']['certificateArn']), ['certificate', 'policy']),
+        'attach_thing_principal': (lambda r: attach_thing_principal(
+            c_iot, thing_name, r['certificate']['certificateArn']), ['certificate', 'thing'])
+    }
+    try:
+        run_steps(steps, iot_executor, results)
+    except Exception:
+        if 'certificate' in results:
+            delete_certificate(c_iot, thing_name, results['certificate']['certificateArn'],
+                               results['certificate']['certificateId'])
+        raise
+
+    answer['endpointAddress'] = results['endpoint']
+    answer['certificateArn'] = results['certificate']['certificateArn']
+    answer['certificateId'] = results['certificate']['certificateId']
+    answer['certificatePem'] = results['certificate']['certificatePem']
+    if 'keyPair' in results['certificate']:
+        answer['PrivateKey'] = results['certificate']['keyPair']['PrivateKey']
+
     return answer
 
 
-def device_marked_for_provisioning(thing_name):
-    c_dynamo = boto3.client('dynamodb')
+def claim_device(thing_name, claim_id):
+    """moves the device to provisioning in one conditional update
+
+    A device can be claimed when it is unprovisioned or failed, or when
+    its claim is older than claim_timeout secs, i.e. the request holding it
+    died. Returns None if claimed, otherwise the reason it was not.
+    """
+    c_dynamo = get_dynamodb_client()
+    now = int(time.time())
     key = {"thing_name": {"S": thing_name}}
     logger.info("key {}".format(key))
 
-    response = c_dynamo.get_item(TableName = dynamodb_table_name, Key = key)
-    logger.info("response: {}".format(response))
+    try:
+        response = c_dynamo.update_item(
+            TableName = dynamodb_table_name,
+            Key = key,
+            UpdateExpression = "SET prov_status = :provisioning, prov_claimed = :now, prov_claim_id = :id",
+            ConditionExpression = "prov_status IN (:unprovisioned, :failed) OR "
+                                  "(prov_status = :provisioning AND prov_claimed < :stale)",
+            ExpressionAttributeValues = {
+                ":provisioning": {"S": "provisioning"},
+                ":unprovisioned": {"S": "unprovisioned"},
+                ":failed": {"S": "failed"},
+                ":now": {"N": str(now)},
+                ":stale": {"N": str(now - claim_timeout)},
+                ":id": {"S": claim_id}
+            },
+            ReturnValues = "ALL_OLD",
+            ReturnValuesOnConditionCheckFailure = "ALL_OLD"
+        )
+    except c_dynamo.exceptions.ConditionalCheckFailedException as e:
+        item = e.response.get('Item')
+        if item is None:
+            logger.error("thing {} not found in DynamoDB".format(thing_name))
+            return "not found"
+        status = item.get('prov_status', {}).get('S')
+        logger.error("thing {} can not be claimed, status: {}".format(thing_name, status))
+        return "provisioning in progress" if status == "provisioning" else "status {}".format(status)
+
+    old_status = response.get('Attributes', {}).get('prov_status', {}).get('S')
+    if old_status == "provisioning":
+        logger.warn("recovered stale claim of thing {}".format(thing_name))
+    logger.info("claimed thing {}, previous status: {}".format(thing_name, old_status))
+    return None
+
+
+def finish_claim(thing_name, claim_id, region = None, error = None):
+    """records the outcome of a claim in one conditional update: provisioned in region, or failed
+
+    Returns False if the claim was taken over in the meantime.
+    """
+    c_dynamo = get_dynamodb_client()
+    datetime = time.strftime("%Y-%m-%dT%H:%M:%S", gmtime())
 
-    if 'Item' in response:
-        if 'prov_status' in response['Item']:
-            status = response['Item']['prov_status']['S']
-            logger.info("status: {}".format(status))
-            if status == "unprovisioned":
-                return True
-        else:
-            logger.warn("no status in result")
-            return False
+    key = {"thing_name": {"S": thing_name}}
+    if error is None:
+        update_expression = "SET prov_status = :s, prov_datetime = :d, aws_region = :r REMOVE prov_claimed, prov_claim_id, prov_error"
+        expression_attribute_values = {":s": {"S": "provisioned"}, ":d": {"S": datetime}, ":r": {"S": region}}
     else:
-        logger.error("thing {} not found in DynamoDB".format(thing_name))
+        update_expression = "SET prov_status = :s, prov_datetime = :d, prov_error = :e REMOVE prov_claimed, prov_claim_id"
+        expression_attribute_values = {":s": {"S": "failed"}, ":d": {"S": datetime}, ":e": {"S": str(error)}}
+    expression_attribute_values[":id"] = {"S": claim_id}
 
-    return False
+    try:
+        response = c_dynamo.update_item(
+            TableName = dynamodb_table_name,
+            Key = key,
+            UpdateExpression = update_expression,
+            ConditionExpression = "prov_claim_id = :id",
+            ExpressionAttributeValues = expression_attribute_values
+        )
+    except c_dynamo.exceptions.ConditionalCheckFailedException:
+        logger.error("claim {} of thing {} was taken over".format(claim_id, thing_name))
+        return False
+    logger.info("response: {}".format(response))
+    return True
 
 
-def update_device_provisioning_status(thing_name, region):
-    c_dynamo = boto3.client('dynamodb')
-    datetime = time.strftime("%Y-%m-%dT%H:%M:%S", gmtime())
+def provision_claimed_device(thing_name, region, CSR, claim_id):
+    """provisions a claimed device and records the outcome, failures are recorded and re-raised
 
-    key = {"thing_name": {"S": thing_name}}
-    logger.info("key {}".format(key))
-    update_expression = "SET prov_status = :s, prov_datetime = :d, aws_region = :r"
-    expression_attribute_values = {":s": {"S": "provisioned"}, ":d": {"S": datetime}, ":r": {"S": region}}
-
-    response = c_dynamo.update_item(
-        TableName = dynamodb_table_name,
-        Key = key,
-        UpdateExpression = update_expression,
-        ExpressionAttributeValues = expression_attribute_values
-    )
-    logger.info("response: {}".format(response))
+    Returns None if the claim was taken over by another request meanwhile;
+    that request records the outcome, so the certificate created here is
+    deleted.
+    """
+    try:
+        answer = provision_device(thing_name, region, CSR)
+    except Exception as e:
+        logger.error("provisioning {} failed: {}".format(thing_name, e))
+        finish_claim(thing_name, claim_id, error = e)
+        raise
+    if not finish_claim(thing_name, claim_id, region = region):
+        delete_certificate(get_iot_client(region), thing_name, answer['certificateArn'],
+                           answer['certificateId'])
+        return None
+    return answer
 
 
-def sig_verified(message, sig):
-    f = open(pub_key_file, 'r')
-    pub_key_pem = f.read()
-    f.close()
+def get_verification_key():
+    global pub_key
+    if pub_key is None:
+        f = open(pub_key_file, 'rb')
+        pub_key_pem = f.read()
+        f.close()
+
+        pub_key = serialization.load_pem_public_key(pub_key_pem)
+    return pub_key
 
-    pub_key = crypto.load_publickey(crypto.FILETYPE_PEM, pub_key_pem)
-    sig = base64.b64decode(sig)
-    pub_key_x509 = X509()
-    pub_key_x509.set_pubkey(pub_key)
 
+def sig_verified(message, sig):
     try:
-        crypto.verify(pub_key_x509, sig, message, 'sha256')
+        sig = base64.b64decode(sig)
+        key = get_verification_key()
+        # the signatures pyOpenSSL's crypto.verify checked: PKCS#1 v1.5 for RSA, ECDSA for EC keys
+        if isinstance(key, ec.EllipticCurvePublicKey):
+            key.verify(sig, message.encode(), ec.ECDSA(hashes.SHA256()))
+        else:
+            key.verify(sig, message.encode(), padding.PKCS1v15(), hashes.SHA256())
         logger.info("signature verified for message {}".format(message))
         return True
     except Exception as e:
         logger.error("verifying signature failed for message {}: {}".format(message, e))
+        return False
+
+
+# load the key during init rather than in the first invocation
+if os.path.exists(pub_key_file):
+    get_verification_key()
+
+
+def get_device_addrs(event):
+    if 'params' in event and 'header' in event['params'] and 'X-Forwarded-For' in event['params']['header']:
+        device_addrs = ''.join(str(event['params']['header']['X-Forwarded-For']).split()).split(',')
+        logger.info(device_addrs)
+        return device_addrs
+    logger.warn("can not find X-Forwarded-For")
+    return None
+
+
+def get_source_addr(event, device_addrs):
+    """the address API Gateway received the request from, the last X-Forwarded-For entry if unknown"""
+    context = event.get('context')
+    if isinstance(context, dict) and context.get('source-ip'):
+        return context['source-ip']
+    return device_addrs[-1]
 
 
 def lambda_handler(event, context):
     global logger
-    logger = RequestIdAdapter(logger, {'request_id': context.aws_request_id})
+    # wrap the root logger, not the adapter of the previous warm invocation
+    logger = RequestIdAdapter(root_logger, {'request_id': context.aws_request_id})
 
     logger.info("event: {}".format(event))
 
     thing_name = None
     thing_name_sig = None
     CSR = None
+    latencies = None
     answer = {}
 
+    if 'body-json' in event and 'devices' in event['body-json']:
+        return batch_handler(event, context)
+
     if 'body-json' in event:
         if 'thing-name' in event['body-json']:
             thing_name = event['body-json']['thing-name']
@@ -278,6 +576,9 @@ def lambda_handler(event, context):
 
         if 'CSR' in event['body-json']:
             CSR = event['body-json']['CSR']
+
+        if 'region-latencies' in event['body-json']:
+            latencies = event['body-json']['region-latencies']
     else:
         logger.error("invalid request: key body-json not found in event")
         return {"status": "error", "message": "invalid request"}
@@ -299,34 +600,149 @@ def lambda_handler(event, context):
         logger.error("signature could not be verified")
         return {"status": "error", "message": "wrong sig"}
 
-    if not device_marked_for_provisioning(thing_name):
-        logger.error("device is not marked for provisioning")
-        return {"status": "error", "message": "you not"}
-
-    if 'params' in event and 'header' in event['params'] and 'X-Forwarded-For' in event['params']['header']:
-        device_addrs = str(event['params']['header']['X-Forwarded-For']).translate(None, string.whitespace).split(',')
-        logger.info(device_addrs)
-    else:
-        logger.warn("can not find X-Forwarded-For")
+    device_addrs = get_device_addrs(event)
+    if not device_addrs:
         return {"status": "error", "message": "no location"}
 
-    location = get_ip_location(device_addrs[0])
-    if location['latitude'] == None or location['longitude'] == None:
-        logger.warn("no latitude or longitude for IP {}, using default region {}".format(device_addrs[0], default_region))
-        answer = provision_device(thing_name, default_region, CSR)
-        answer['region'] = default_region
-        answer['message'] = "no latitude or longitude for IP {}, using default region {}".format(device_addrs[0], default_region)
-        answer['status'] = 'success'
-    else:
-        lat = float(location['latitude'])
-        lon = float(location['longitude'])
-        logger.info("lat: {}, lon: {}".format(lat, lon))
-        best_region = find_best_region(lat, lon)
-        answer = provision_device(thing_name, best_region['region'], CSR)
-        answer['region'] = best_region['region']
-        answer['distance'] = best_region['distance']
-        answer['status'] = 'success'
+    claim_id = context.aws_request_id
+    reason = claim_device(thing_name, claim_id)
+    if reason:
+        logger.error("device is not marked for provisioning: {}".format(reason))
+        return {"status": "error", "message": "you not"}
 
-    update_device_provisioning_status(thing_name, best_region['region'])
+    try:
+        selected = select_region(device_addrs[0], latencies, get_source_addr(event, device_addrs))
+    except Exception as e:
+        finish_claim(thing_name, claim_id, error = e)
+        raise
+    region = selected['region']
+    answer = provision_claimed_device(thing_name, region, CSR, claim_id)
+    if answer is None:
+        return {"status": "error", "message": "claim lost"}
+    answer.update(selected)
+    answer['status'] = 'success'
 
     return answer
+
+
+def prepare_region(region):
+    """looks up the endpoint and the policy once before the devices of a region are provisioned"""
+    c_iot = get_iot_client(region)
+    get_iot_endpoint(c_iot, region)
+    create_iot_policy_if_missing(c_iot, region)
+
+
+def claim_and_provision(thing_name, region, CSR, claim_id):
+    """returns (error message, None) if the device was not provisioned, otherwise (None, answer)"""
+    reason = claim_device(thing_name, claim_id)
+    if reason:
+        logger.error("device {} is not marked for provisioning: {}".format(thing_name, reason))
+        return "you not", None
+    answer = provision_claimed_device(thing_name, region, CSR, claim_id)
+    if answer is None:
+        return "claim lost", None
+    return None, answer
+
+
+def batch_handler(event, context):
+    """provisions the devices of a batch request, e.g. a gateway and its children
+
+    body-json: {"devices": [{"thing-name", "thing-name-sig", "CSR", "region-latencies"}, ...],
+                "region-latencies": ...}
+
+    Devices without region-latencies use those of the batch. The devices
+    are grouped by region; each device is claimed, provisioned and its
+    outcome recorded on its own, concurrently. The answer has a result per
+    device in the order of the request.
+    """
+    body = event['body-json']
+    devices = body['devices']
+    if not isinstance(devices, list) or not devices:
+        logger.error("no devices in batch request")
+        return {"status": "error", "message": "no devices"}
+    if len(devices) > batch_max_devices:
+        logger.error("batch of {} devices, at most {} allowed".format(len(devices), batch_max_devices))
+        return {"status": "error", "message": "at most {} devices per batch".format(batch_max_devices)}
+
+    device_addrs = get_device_addrs(event)
+    if not device_addrs:
+        return {"status": "error", "message": "no location"}
+
+    source_addr = get_source_addr(event, device_addrs)
+    results = [None] * len(devices)
+    pending = []
+    seen = set()
+    for i, device in enumerate(devices):
+        thing_name = device.get('thing-name') if isinstance(device, dict) else None
+        if thing_name == None:
+            results[i] = {"status": "error", "message": "no thing name"}
+        elif not isinstance(thing_name, str):
+            results[i] = {"status": "error", "message": "invalid thing name"}
+        elif thing_name in seen:
+            results[i] = {"thing-name": thing_name, "status": "error", "message": "duplicate thing name"}
+        elif device.get('thing-name-sig') == None:
+            results[i] = {"thing-name": thing_name, "status": "error", "message": "no sig"}
+        elif not sig_verified(thing_name, device['thing-name-sig']):
+            results[i] = {"thing-name": thing_name, "status": "error", "message": "wrong sig"}
+        else:
+            pending.append(i)
+        if isinstance(thing_name, str):
+            seen.add(thing_name)
+
+    groups = collections.OrderedDict()
+    selected = {}
+    for i in pending:
+        try:
+            selected[i] = select_region(device_addrs[0],
+                                        devices[i].get('region-latencies', body.get('region-latencies')),
+                                        source_addr)
+        except Exception as e:
+            logger.error("selecting the region of {} failed: {}".format(devices[i]['thing-name'], e))
+            results[i] = {"thing-name": devices[i]['thing-name'], "status": "error", "message": "no region"}
+            continue
+        groups.setdefault(selected[i]['region'], []).append(i)
+    logger.info("devices per region: {}".format(dict((r, len(g)) for r, g in groups.items())))
+
+    provisioned = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers = batch_workers) as executor:
+        prepared = dict((executor.submit(prepare_region, region), region) for region in groups)
+        futures = {}
+        for future in concurrent.futures.as_completed(prepared):
+            region = prepared[future]
+            try:
+                future.result()
+            except Exception as e:
+                logger.error("preparing region {} failed: {}".format(region, e))
+                for i in groups[region]:
+                    results[i] = {"thing-name": devices[i]['thing-name'], "region": region,
+                                  "status": "error", "message": "region {} not available".format(region)}
+                continue
+            for i in groups[region]:
+                futures[executor.submit(claim_and_provision, devices[i]['thing-name'], region,
+                                        devices[i].get('CSR'), context.aws_request_id)] = i
+        for future in concurrent.futures.as_completed(futures):
+            i = futures[future]
+            thing_name = devices[i]['thing-name']
+            try:
+                message, answer = future.result()
+            except Exception as e:
+                logger.error("provisioning {} failed: {}".format(thing_name, e))
+                results[i] = {"thing-name": thing_name, "region": selected[i]['region'],
+                              "status": "error", "message": "provisioning failed"}
+                continue
+            if message:
+                results[i] = {"thing-name": thing_name, "status": "error", "message": message}
+                continue
+            answer.update(selected[i])
+            answer['thing-name'] = thing_name
+            answer['status'] = 'success'
+            results[i] = answer
+            provisioned[thing_name] = selected[i]['region']
+
+    failed = len(devices) - len(provisioned)
+    return {
+        "status": "success" if not failed else "partial" if provisioned else "error",
+        "provisioned": len(provisioned),
+        "failed": failed,
+        "results": results
+    }
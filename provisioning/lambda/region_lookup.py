@@ -0,0 +1,170 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""Nearest AWS region for coordinates
+
+RegionTable parses a region table like the one in lambda_function.py
+once into NumPy arrays of radians. Distances to all regions are computed
+with the haversine formula in one vectorized expression, for a single
+coordinate or for a whole batch of coordinates.
+
+The earth radius is the one geopy.distance.great_circle uses, so the
+distances match the former per region great_circle calls.
+
+RegionGrid precomputes the nearest region of every cell of a lat/lon
+grid, so a lookup is an array index. A cell gets a region only if that
+region is the nearest for every point of the cell: the distance from the
+cell centre to each region is off by at most the cell radius, so the
+nearest region is certain when the two closest regions differ by more
+than twice the radius. Other cells, near the boundaries between regions,
+fall back to the exact RegionTable lookup.
+"""
+
+import math
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.009
+CELL_DEGREES = 0.5
+# added to the cell radius against rounding
+RADIUS_MARGIN_KM = 1.0
+
+
+class RegionTable(object):
+    def __init__(self, regions):
+        """regions: [{"name": ..., "lat": "<degrees>", "lon": "<degrees>"}, ...]"""
+        self.names = [r["name"] for r in regions]
+        self.lat = np.radians(np.array([float(r["lat"]) for r in regions]))
+        self.lon = np.radians(np.array([float(r["lon"]) for r in regions]))
+        self.cos_lat = np.cos(self.lat)
+
+    def distances(self, lat, lon):
+        """km from (lat, lon) in degrees to every region
+
+        lat and lon may be scalars, giving an array with one distance per
+        region, or arrays of n coordinates, giving an n x regions array.
+        """
+        lat = np.radians(np.asarray(lat, dtype=float))[..., np.newaxis]
+        lon = np.radians(np.asarray(lon, dtype=float))[..., np.newaxis]
+        a = (np.sin((self.lat - lat) / 2) ** 2 +
+             np.cos(lat) * self.cos_lat * np.sin((self.lon - lon) / 2) ** 2)
+        return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+    def nearest(self, lat, lon):
+        """returns (region name, km) of the region closest to (lat, lon)"""
+        distances = self.distances(lat, lon)
+        i = int(np.argmin(distances))
+        return self.names[i], float(distances[i])
+
+    def nearest_batch(self, lats, lons):
+        """returns (region names, km) of the closest regions of n coordinates"""
+        distances = self.distances(lats, lons)
+        i = np.argmin(distances, axis=-1)
+        return [self.names[k] for k in i], np.take_along_axis(distances, i[..., np.newaxis], -1)[..., 0]
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(1.0, max(0.0, a))))
+
+
+class RegionGrid(object):
+    """nearest region per grid cell, -1 for cells which need the exact lookup"""
+
+    def __init__(self, table, cells, cell_degrees):
+        self.table = table
+        self.cells = cells
+        self.cell_degrees = cell_degrees
+        self.rows, self.cols = cells.shape
+        self.lat_deg = np.degrees(table.lat)
+        self.lon_deg = np.degrees(table.lon)
+        self.hits = 0
+        self.fallbacks = 0
+
+    @classmethod
+    def build(cls, table, cell_degrees=CELL_DEGREES):
+        rows = int(round(180 / cell_degrees))
+        cols = int(round(360 / cell_degrees))
+        lat0 = -90 + cell_degrees * np.arange(rows)
+        lon0 = -180 + cell_degrees * np.arange(cols)
+        lat0, lon0 = np.meshgrid(lat0, lon0, indexing='ij')
+        lat_c = lat0 + cell_degrees / 2
+        lon_c = lon0 + cell_degrees / 2
+
+        # the farthest point of a cell from its centre: corners and edge midpoints
+        radius = np.zeros(lat_c.shape)
+        for dlat in (0, 0.5, 1):
+            for dlon in (0, 0.5, 1):
+                lat_p = lat0 + dlat * cell_degrees
+                lon_p = lon0 + dlon * cell_degrees
+                radius = np.maximum(radius, _haversine(lat_c, lon_c, lat_p, lon_p))
+        radius += RADIUS_MARGIN_KM
+
+        distances = table.distances(lat_c, lon_c)
+        two = np.partition(distances, 1, axis=-1)[..., :2] if len(table.names) > 1 else None
+        cells = np.argmin(distances, axis=-1).astype(np.int16)
+        if two is not None:
+            cells[two[..., 1] - two[..., 0] <= 2 * radius] = -1
+        return cls(table, cells, cell_degrees)
+
+    def save(self, path):
+        np.savez_compressed(path, cells=self.cells, cell_degrees=self.cell_degrees,
+                            names=np.array(self.table.names), lat=self.table.lat, lon=self.table.lon)
+
+    @classmethod
+    def load(cls, path, table):
+        """returns the grid saved at path, None if it was built for another region table"""
+        with np.load(path) as data:
+            if (list(data['names']) != table.names or
+                    not np.array_equal(data['lat'], table.lat) or
+                    not np.array_equal(data['lon'], table.lon)):
+                return None
+            return cls(table, data['cells'], float(data['cell_degrees']))
+
+    @classmethod
+    def load_or_build(cls, path, table, cell_degrees=CELL_DEGREES):
+        try:
+            grid = cls.load(path, table)
+        except (IOError, KeyError, ValueError):
+            grid = None
+        return grid if grid is not None else cls.build(table, cell_degrees)
+
+    def coverage(self):
+        """fraction of the cells with a precomputed region"""
+        return float(np.mean(self.cells >= 0))
+
+    def _cell(self, lat, lon):
+        row = min(max(int((lat + 90) // self.cell_degrees), 0), self.rows - 1)
+        col = int(((lon + 180) % 360) // self.cell_degrees) % self.cols
+        return self.cells[row, col]
+
+    def nearest(self, lat, lon):
+        """returns (region name, km) like RegionTable.nearest"""
+        i = int(self._cell(lat, lon))
+        if i < 0:
+            self.fallbacks += 1
+            return self.table.nearest(lat, lon)
+        self.hits += 1
+        return self.table.names[i], haversine_km(lat, lon, self.lat_deg[i], self.lon_deg[i])
+
+    def nearest_batch(self, lats, lons):
+        """returns (region names, km) like RegionTable.nearest_batch"""
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        rows = np.clip(((lats + 90) // self.cell_degrees).astype(int), 0, self.rows - 1)
+        cols = (((lons + 180) % 360) // self.cell_degrees).astype(int) % self.cols
+        i = self.cells[rows, cols].astype(int)
+        missing = i < 0
+        if missing.any():
+            i[missing] = np.argmin(self.table.distances(lats[missing], lons[missing]), axis=-1)
+        km = _haversine(lats, lons, self.lat_deg[i], self.lon_deg[i])
+        return [self.table.names[k] for k in i], km
+
+
+def _haversine(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(x) for x in (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
@@ -0,0 +1,127 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""Region selection by measured connect latency
+
+RegionProber opens a TCP connection and does the TLS handshake with the
+endpoint of every candidate region concurrently and returns the seconds
+each took. Probes which fail or do not finish within the timeout are
+None. The fastest region is the one with the lowest handshake time;
+callers fall back to the distance based RegionTable when no probe
+succeeded.
+
+LatencyCache keeps measurements per source network (see
+geolocation.cache_key), so a measurement reported by one device is used
+for the other devices behind the same network.
+"""
+
+import concurrent.futures
+import math
+import socket
+import ssl
+import time
+
+from geolocation import LRUCache, cache_key
+
+ENDPOINT = "iot.{}.amazonaws.com"
+PORT = 443
+TIMEOUT = 2.0
+LATENCY_TTL = 3600
+
+
+def probe(host, port=PORT, timeout=TIMEOUT, tls=True, ssl_context=None):
+    """returns the seconds to connect to host:port and, if tls, to do the TLS handshake"""
+    start = time.perf_counter()
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        if tls:
+            context = ssl_context or ssl.create_default_context()
+            with context.wrap_socket(sock, server_hostname=host):
+                pass
+    return time.perf_counter() - start
+
+
+def fastest(latencies):
+    """returns (region, secs) with the lowest latency, (None, None) if none succeeded"""
+    measured = [(secs, region) for region, secs in latencies.items() if secs is not None]
+    if not measured:
+        return None, None
+    secs, region = min(measured)
+    return region, secs
+
+
+class RegionProber(object):
+    def __init__(self, regions, endpoints=None, timeout=TIMEOUT, tls=True, ssl_context=None):
+        """regions: region names; endpoints: {region: (host, port)}, defaults to ENDPOINT:PORT"""
+        self.endpoints = dict((r, (ENDPOINT.format(r), PORT)) for r in regions)
+        self.endpoints.update(endpoints or {})
+        self.timeout = timeout
+        self.tls = tls
+        self.ssl_context = ssl_context
+        self.errors = {}
+
+    def measure(self):
+        """returns {region: handshake secs or None}, all regions probed concurrently
+
+        Returns after timeout at the latest; probes still running then
+        count as failed.
+        """
+        latencies = dict.fromkeys(self.endpoints)
+        self.errors = {}
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.endpoints) or 1)
+        futures = dict(
+            (executor.submit(probe, host, port, self.timeout, self.tls, self.ssl_context), region)
+            for region, (host, port) in self.endpoints.items())
+        done, not_done = concurrent.futures.wait(futures, timeout=self.timeout)
+        for future in done:
+            region = futures[future]
+            try:
+                latencies[region] = future.result()
+            except Exception as e:
+                self.errors[region] = e
+        for future in not_done:
+            self.errors[futures[future]] = socket.timeout("no handshake within {} secs".format(self.timeout))
+        executor.shutdown(wait=False)
+        return latencies
+
+    def fastest(self):
+        """returns (region, secs, latencies) of a new measurement"""
+        latencies = self.measure()
+        region, secs = fastest(latencies)
+        return region, secs, latencies
+
+
+class LatencyCache(object):
+    """latency measurements per source network"""
+
+    def __init__(self, regions, size=10000, ttl=LATENCY_TTL, key=cache_key):
+        self.regions = set(regions)
+        self.cache = LRUCache(size=size, ttl=ttl)
+        self.key = key
+
+    def put(self, ip, latencies):
+        """stores the valid measurements of known regions, returns them
+
+        latencies must be {region: secs or None}; anything else, e.g. a list
+        sent by a device, is ignored, as are negative and non-finite secs.
+        """
+        valid = {}
+        if not isinstance(latencies, dict):
+            return valid
+        for region, secs in latencies.items():
+            if not isinstance(region, str) or region not in self.regions:
+                continue
+            if isinstance(secs, bool) or not isinstance(secs, (int, float)):
+                continue
+            if math.isfinite(secs) and secs >= 0:
+                valid[region] = float(secs)
+        if valid:
+            self.cache.put(self.key(ip), valid)
+        return valid
+
+    def get(self, ip):
+        return self.cache.get(self.key(ip))
+
+    def fastest(self, ip, latencies=None):
+        """returns (region, secs) of the given or cached measurements of ip's network"""
+        valid = self.put(ip, latencies) if latencies else None
+        return fastest(valid or self.get(ip) or {})